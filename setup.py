@@ -55,7 +55,7 @@ setup(
         ]
     },
 
-    install_requires=['numpy', 'scipy', 'h5py', 'h5writer', 'mulpro>=0.1.3'],
+    install_requires=['numpy', 'scipy', 'h5py', 'h5writer'],
 
     extras_require={'mpi': 'mpi4py>=1.3.1',
                     'gui': ['PyQt4', 'pyqtgraph']},
@@ -38,6 +38,9 @@ def analyse_particles(input, saturation_mask, i_labels, labels, x, y, merged, n_
     psize = np.zeros(N) - 1 
     pecc  = np.zeros(N) - 1 
     pcir  = np.zeros(N) - 1 
+
+    # Bounding boxes of all labels, every particle is analysed only within its own box
+    objects = get_label_slices(labels, i_labels)
     
     for i, i_label, x_i, y_i, m in zip(range(N), i_labels, x, y, merged): 
 
@@ -45,18 +48,14 @@ def analyse_particles(input, saturation_mask, i_labels, labels, x, y, merged, n_
             continue 
         
         # Analyse
-        pixels = i_label == labels 
-        psat[i]  = (pixels * saturation_mask).any() 
-        psize[i] = pixels.sum() 
-        pecc[i] = measure_eccentricity(intensity=input*pixels, mask=pixels) 
-        pcir[i] = measure_circumference(pixels) 
+        psat[i], psize[i], pecc[i], pcir[i] = measure_label(input, saturation_mask, labels, i_label, objects[i])
         
         if conf_analysis["integration_mode"] == "windows": 
             values = get_values_window(input, int(round(x_i)), int(round(y_i)), window_size=conf_analysis["window_size"], circle_window=conf_analysis["circle_window"], i=i, 
                                        masked_image=masked_image, thumbnails=thumbnails) 
         elif conf_analysis["integration_mode"] == "labels":    
             values = get_values_label(input, labels, i_label, 
-                                      masked_image=masked_image, thumbnails=thumbnails) 
+                                      masked_image=masked_image, thumbnails=thumbnails, slices=objects[i]) 
         else:
             log_and_raise_error(logger, "%s is not a valid integration_mode!" % conf_analysis["integration_mode"]) 
 
@@ -102,14 +101,23 @@ def get_values_window(image, x_i, y_i, window_size, circle_window, i, masked_ima
 
     return values
     
-def get_values_label(image, labels, i_label, masked_image=None, thumbnails=None):
+def get_values_label(image, labels, i_label, masked_image=None, thumbnails=None, slices=None):
 
-    pixels = i_label==labels
-    values = image[pixels]
+    if slices is None:
+        slices = (slice(None), slice(None))
+    pixels = i_label==labels[slices]
+    values = image[slices][pixels]
     if masked_image is not None:
-        masked_image[pixels] = values[:]
+        masked_image[slices][pixels] = values[:]
     if thumbnails is not None:
-        i = (image * pixels).argmax()
+        tmp = image[slices] * pixels
+        i_box = tmp.argmax()
+        if tmp.flat[i_box] > 0:
+            # First maximum in the box is also the first maximum in the full frame
+            y_box, x_box = np.unravel_index(i_box, tmp.shape)
+            i = (y_box + slices[0].indices(image.shape[0])[0]) * image.shape[1] + x_box + slices[1].indices(image.shape[1])[0]
+        else:
+            i = (image * (i_label==labels)).argmax()
         x = i % image.shape[1]
         y = i // image.shape[1]
         n = thumbnails.shape[1]
@@ -128,6 +136,79 @@ def get_values_label(image, labels, i_label, masked_image=None, thumbnails=None)
     return values
     
 
+def get_label_slices(labels, i_labels, pad=1):
+    """
+    Return for every label in i_labels the bounding box slices padded by pad pixels (None if the label is absent).
+    The padding keeps the result of the 3x3 Sobel filter in measure_circumference identical to the full frame.
+    """
+    if len(i_labels) == 0:
+        return []
+    objects = scipy.ndimage.find_objects(labels, max_label=int(max(i_labels)))
+    slices = []
+    for i_label in i_labels:
+        o = objects[int(i_label)-1]
+        if o is None:
+            slices.append(None)
+        else:
+            slices.append(tuple([slice(max([s.start-pad, 0]), min([s.stop+pad, n])) for s, n in zip(o, labels.shape)]))
+    return slices
+
+def measure_label(image, saturation_mask, labels, i_label, slices):
+    """
+    Return saturation flag, size, eccentricity and circumference of the label i_label within the bounding box slices.
+    """
+    if slices is None:
+        return False, 0, -1, 0
+    pixels = i_label == labels[slices]
+    sat = (pixels * saturation_mask[slices]).any()
+    size = pixels.sum()
+    ecc = measure_eccentricity_box(intensity=image[slices]*pixels, mask=pixels, slices=slices, shape=image.shape)
+    cir = measure_circumference(pixels)
+    return sat, size, ecc, cir
+
+def measure_eccentricity_box(intensity, mask, slices, shape):
+    """
+    Return the same value as measure_eccentricity on the full frame of the given shape that is zero outside the bounding box slices.
+    The intensity sums are formed in the order of numpy's pairwise summation over the full frame, which makes the result bit-identical.
+    """
+    y0 = slices[0].indices(shape[0])[0]
+    x0 = slices[1].indices(shape[1])[0]
+    y, x = np.nonzero(intensity)
+    index = (y + y0) * shape[1] + (x + x0)
+    values = intensity[y, x]
+    n = shape[0] * shape[1]
+    normalizer = _sum_sparse(index, values, n)
+    if normalizer > 0 and mask.sum() > 0:
+        com_intensity = [_sum_sparse(index, values * (y + y0).astype(float), n) / normalizer,
+                         _sum_sparse(index, values * (x + x0).astype(float), n) / normalizer]
+        # Sums of integer coordinates are exact in any order
+        ym, xm = np.nonzero(mask)
+        com_mask = [(ym + y0).astype(float).sum() / ym.size, (xm + x0).astype(float).sum() / xm.size]
+        off = np.sqrt((com_intensity[0]-com_mask[0])**2+(com_intensity[1]-com_mask[1])**2)
+        return off
+    else:
+        return -1
+
+PAIRWISE_BLOCKSIZE = 128
+
+def _sum_sparse(index, values, n):
+    """
+    Sum an array of length n that is zero except for values at the sorted flat index, grouping the terms like numpy's pairwise summation.
+    """
+    zero = values.dtype.type(0)
+    def _sum(lo, m):
+        i0, i1 = np.searchsorted(index, [lo, lo + m])
+        if i0 == i1:
+            return zero
+        if m <= PAIRWISE_BLOCKSIZE:
+            block = np.zeros(m, dtype=values.dtype)
+            block[index[i0:i1] - lo] = values[i0:i1]
+            return np.add.reduce(block, initial=zero)
+        m2 = m // 2
+        m2 -= m2 % 8
+        return _sum(lo, m2) + _sum(lo + m2, m - m2)
+    return _sum(0, n)
+
 def measure_eccentricity(intensity, mask):
     if intensity.sum() > 0 and mask.sum() > 0:
         com_intensity = scipy.ndimage.measurements.center_of_mass(intensity)
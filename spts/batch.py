@@ -0,0 +1,205 @@
+import os, time, collections
+import concurrent.futures
+
+import logging
+logger = logging.getLogger(__name__)
+
+import spts
+import spts.log
+from spts.log import log_and_raise_error,log_warning,log_info,log_debug
+
+import spts.worker
+import spts.writer
+
+# Number of work units per process that the frames of all files are split into (if they are large enough)
+UNITS_PER_PROCESS = 4
+
+# Number of Workers (with open input files) that every process keeps for later units of the same file
+WORKERS_PER_PROCESS = 2
+
+# Memory for the results of the units that are processed or wait to be written at the same time, units are made
+# smaller if their output would not fit (e.g. with images of every frame at high output levels)
+RESULTS_NBYTES = 1<<30
+
+# Workers of this process, by job key (least recently used first)
+_workers = collections.OrderedDict()
+
+def _get_worker(key, conf):
+    W = _workers.pop(key, None)
+    if W is None:
+        W = spts.worker.Worker(conf)
+        while len(_workers) >= WORKERS_PER_PROCESS:
+            _workers.popitem(last=False)[1].close()
+    _workers[key] = W
+    return W
+
+def process_unit(key, conf, i0, i1, batch_size=1):
+    """
+    Analyse the frames i0, ..., i1-1 of the file of the configuration conf and return the output packages. The Worker
+    is kept for the next unit of the same job (key) that is processed by this process.
+    """
+    W = _get_worker(key, conf)
+    out = []
+    i = i0
+    while i < i1:
+        n = min([batch_size, i1 - i])
+        if n > 1:
+            out += W.work_batch({"i": i, "n": n})
+        else:
+            out.append(W.work({"i": i}))
+        i += n
+    return [l for l in out if l is not None]
+
+
+def get_units(jobs, n_processes, unit_frames=None, unit_nbytes=None):
+    """
+    Split the frame ranges of all jobs into work units (k, i0, i1), k being the index of the job. Units have about
+    unit_frames frames (default: the number of frames of all jobs divided by UNITS_PER_PROCESS times the number of
+    processes) and are aligned with the blocks of frames that are read at once. If unit_nbytes is given, units are made
+    smaller such that their output (estimated by Worker.get_output_nbytes) does not exceed unit_nbytes, if
+    necessary shorter than a block. Sets "start", "stop" and "frame_nbytes" of every job.
+    """
+    for job in jobs:
+        W = spts.worker.Worker(job["conf"], i_start=job.get("i_start"))
+        job["start"], job["stop"] = W.get_frame_range()
+        job["block_length"] = W.get_block_length()
+        job["frame_nbytes"] = W.get_output_nbytes() if unit_nbytes is not None else 0
+        W.close()
+    if unit_frames is None:
+        n_frames = sum([job["stop"] - job["start"] for job in jobs])
+        unit_frames = max([1, n_frames // (UNITS_PER_PROCESS * n_processes)])
+    units = []
+    for k, job in enumerate(jobs):
+        L = job["block_length"]
+        n = max([1, unit_frames // L]) * L
+        if job["frame_nbytes"] > 0:
+            n = max([1, min([n, unit_nbytes // job["frame_nbytes"]])])
+        # Units end at multiples of u (a multiple of the block length) or, if they are shorter than a block, do not
+        # cross the end of a block
+        u = n // L * L if n >= L else L
+        i0 = job["start"]
+        while i0 < job["stop"]:
+            i1 = min([(i0 // u + 1) * u, i0 + n, job["stop"]])
+            units.append((k, i0, i1))
+            i0 = i1
+    return units
+
+
+class _Output:
+    """
+    Output file of a job and the results of its units that wait to be written.
+    """
+    def __init__(self, job, n_units):
+        self.job = job
+        self.n_units = n_units
+        self.results = {}
+        self.H = None
+        self.failed = False
+
+    def write(self, result):
+        if self.H is None:
+            self.H = spts.writer.H5Writer(self.job["out_file"], resume=self.job.get("i_start") is not None)
+        for l in result:
+            self.H.write_slice(l)
+
+    def close(self, complete=True):
+        if self.H is None:
+            self.H = spts.writer.H5Writer(self.job["out_file"], resume=self.job.get("i_start") is not None)
+        if complete:
+            self.H.write_solo({'__version__': spts.__version__})
+        self.H.close(complete=complete)
+
+
+def prepare_resume(job):
+    """
+    Set the first frame (i_start) of a job whose output file is incomplete from an interrupted run. Raises an error if
+    the committed frames do not belong to the configuration of the job.
+    """
+    out_file = job["out_file"]
+    if spts.writer.get_output_status(out_file)[0] == "incomplete":
+        n = spts.writer.get_resume_position(out_file, job["conf"]["general"]["i0"])
+        if n > 0:
+            job["i_start"] = job["conf"]["general"]["i0"] + n
+            log_info(logger, "Resume %s at frame %i" % (out_file, job["i_start"]))
+
+
+def run_batch(jobs, n_processes=None, batch_size=1, unit_frames=None, on_done=None, on_error=None, results_nbytes=RESULTS_NBYTES):
+    """
+    Analyse the files of many jobs in a pool of n_processes processes (default: one per core). A job is a dictionary
+    with the configuration ("conf") and the output filename ("out_file"), with "resume": True an incomplete output is
+    continued. All frames are split into units (see get_units) that are processed in any order, every process keeps the
+    Workers of the last files it worked on. Results are written by this process, in order, to one output file per job.
+    The units that are processed or wait to be written at the same time hold at most about results_nbytes of output.
+    on_done(job) is called when the output of a job is complete, on_error(job, exception) if it failed.
+    """
+    n_processes = n_processes if n_processes is not None else os.cpu_count()
+    window = 2 * n_processes
+    resumable = []
+    for job in jobs:
+        if job.get("resume"):
+            try:
+                prepare_resume(job)
+            except Exception as e:
+                if on_error is not None:
+                    on_error(job, e)
+                continue
+        resumable.append(job)
+    jobs = resumable
+    units = get_units(jobs, n_processes, unit_frames, unit_nbytes=max([1, results_nbytes // window]))
+    outputs = [_Output(job, len([u for u in units if u[0] == k])) for k, job in enumerate(jobs)]
+    # Jobs without frames to process
+    for k, out in enumerate(outputs):
+        if out.n_units == 0:
+            out.close()
+            if on_done is not None:
+                on_done(jobs[k])
+    log_info(logger, "%i frames of %i files in %i units" % (sum([u[2] - u[1] for u in units]), len(jobs), len(units)))
+    # Units of a job are written in order, the units of a job that follow a slow one wait in memory
+    expected = [[u[1] for u in units if u[0] == k] for k in range(len(jobs))]
+    t_start = time.time()
+    n_frames_done = 0
+    n_frames = sum([u[2] - u[1] for u in units])
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_processes) as executor:
+        todo = list(units)
+        running = {}
+        n_waiting = 0
+        while len(todo) > 0 or len(running) > 0:
+            while len(todo) > 0 and len(running) + n_waiting < window:
+                k, i0, i1 = todo.pop(0)
+                if outputs[k].failed:
+                    continue
+                f = executor.submit(process_unit, jobs[k]["out_file"], jobs[k]["conf"], i0, i1, batch_size)
+                running[f] = (k, i0, i1)
+            if len(running) == 0:
+                break
+            finished, _ = concurrent.futures.wait(list(running), return_when=concurrent.futures.FIRST_COMPLETED)
+            for f in finished:
+                k, i0, i1 = running.pop(f)
+                out = outputs[k]
+                if out.failed:
+                    continue
+                try:
+                    result = f.result()
+                except Exception as e:
+                    out.failed = True
+                    n_waiting -= len(out.results)
+                    out.results = {}
+                    out.close(complete=False)
+                    log_warning(logger, "Processing of %s failed (%s)" % (jobs[k]["out_file"], str(e)))
+                    if on_error is not None:
+                        on_error(jobs[k], e)
+                    continue
+                n_frames_done += i1 - i0
+                # Write the results that are next in order
+                out.results[i0] = result
+                n_waiting += 1
+                while len(expected[k]) > 0 and expected[k][0] in out.results:
+                    out.write(out.results.pop(expected[k].pop(0)))
+                    n_waiting -= 1
+                if len(expected[k]) == 0:
+                    out.close()
+                    if on_done is not None:
+                        on_done(jobs[k])
+                elapsed = time.time() - t_start
+                log_info(logger, "%i/%i frames (%.1f Hz), ETA %.0f sec" % (n_frames_done, n_frames, n_frames_done / elapsed,
+                                                                           elapsed / n_frames_done * (n_frames - n_frames_done)))
@@ -0,0 +1,389 @@
+import os, json, hashlib
+import numpy as np
+import scipy.ndimage
+import h5py
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+import spts.log
+from spts.log import log_and_raise_error,log_warning,log_info,log_debug
+
+from spts.camera import CXDReader
+
+# Increment if the computation of a calibration changes, cached results of older versions are then ignored
+VERSIONS = {"bg": 2, "ff": 2}
+
+# Number of bytes at the beginning and at the end of the input file that enter the fingerprint
+FINGERPRINT_NBYTES = 1<<20
+
+# Number of frames read at once for the background
+BLOCK_FRAMES = 16
+
+# Maximum size of the bands of rows (of all frames) held in memory for the median of the flatfield
+BAND_NBYTES = 128<<20
+
+class CalibrationStore:
+    """
+    Cache of calibrations (background, flatfield) computed from an input file. Every entry is stored in its own HDF5
+    file whose name contains a key derived from the fingerprint of the input file (size, modification time and hash of
+    its first and last MB), the kind and version of the calibration and all parameters of the computation. Entries are
+    written to a temporary file and renamed once complete, and a lock file ensures that processes working on the same
+    calibration concurrently compute it only once.
+
+    directory:  Directory of the cache files (default: next to the input file)
+    """
+    def __init__(self, directory=None):
+        self.directory = directory
+        # Files of the entries read or written through this store (e.g. for rendering reports)
+        self.paths = []
+
+    def get_key(self, kind, filename, params):
+        D = {"kind": kind, "version": VERSIONS.get(kind, 0), "input": _get_fingerprint(filename), "params": _get_params(params)}
+        return hashlib.sha1(json.dumps(D, sort_keys=True).encode()).hexdigest()
+
+    def get_path(self, kind, filename, params):
+        d = self.directory if self.directory is not None else os.path.dirname(os.path.abspath(filename))
+        stem = os.path.splitext(os.path.basename(filename))[0]
+        return os.path.join(d, "%s_%s_%s.h5" % (stem, kind, self.get_key(kind, filename, params)[:16]))
+
+    def get(self, kind, filename, params, compute):
+        """
+        Return the calibration (dictionary of arrays) of kind for the input file and parameters. If it is not in the
+        store compute(filename, **params) is called and its result is stored.
+        """
+        key = self.get_key(kind, filename, params)
+        path = self.get_path(kind, filename, params)
+        D = self._read(path, key)
+        if D is not None:
+            self.paths.append(path)
+            return D
+        try:
+            lock = open(path + ".lock", "a")
+        except OSError:
+            log_warning(logger, "Cannot write to calibration store at %s, computing %s without caching" % (path, kind))
+            return compute(filename, **params)
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            # Another process may have finished the calibration while we were waiting for the lock
+            D = self._read(path, key)
+            if D is not None:
+                self.paths.append(path)
+                return D
+            log_info(logger, "Computing %s from %s" % (kind, filename))
+            D = compute(filename, **params)
+            if self._write(path, key, kind, filename, params, D):
+                self.paths.append(path)
+            return D
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+    def _read(self, path, key):
+        if not os.path.exists(path):
+            return None
+        try:
+            with h5py.File(path, "r") as f:
+                if f.attrs.get("key") != key:
+                    log_warning(logger, "Ignoring calibration %s, key does not match" % path)
+                    return None
+                log_info(logger, "Reading cached calibration from %s" % path)
+                return {name: f[name][()] for name in f.keys()}
+        except (OSError, KeyError) as e:
+            log_warning(logger, "Ignoring unreadable calibration %s (%s)" % (path, str(e)))
+            return None
+
+    def _write(self, path, key, kind, filename, params, D):
+        tmp = "%s.tmp.%i" % (path, os.getpid())
+        try:
+            with h5py.File(tmp, "w") as f:
+                for name, data in D.items():
+                    f.create_dataset(name, data=data)
+                f.attrs["key"] = key
+                f.attrs["kind"] = kind
+                f.attrs["source"] = os.path.abspath(filename)
+                f.attrs["params"] = json.dumps(_get_params(params), sort_keys=True)
+            # Readers either see the complete file or none
+            os.replace(tmp, path)
+            return True
+        except OSError as e:
+            log_warning(logger, "Could not store calibration %s (%s)" % (path, str(e)))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return False
+
+
+def _get_fingerprint(filename):
+    st = os.stat(filename)
+    h = hashlib.sha1()
+    with open(filename, "rb") as f:
+        h.update(f.read(FINGERPRINT_NBYTES))
+        if st.st_size > 2*FINGERPRINT_NBYTES:
+            f.seek(-FINGERPRINT_NBYTES, os.SEEK_END)
+            h.update(f.read(FINGERPRINT_NBYTES))
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha1": h.hexdigest()}
+
+def _get_params(params):
+    # Arrays enter the key by their content
+    P = {}
+    for k, v in params.items():
+        if isinstance(v, np.ndarray):
+            v = np.ascontiguousarray(v)
+            P[k] = "%s%s:%s" % (v.dtype.str, str(v.shape), hashlib.sha1(v.tobytes()).hexdigest())
+        elif isinstance(v, np.generic):
+            P[k] = v.item()
+        else:
+            P[k] = v
+    return P
+
+
+class RunningStats:
+    """
+    Per-pixel mean and variance of a stream of frames, added in blocks of shape (N, Y, X). The blocks are merged with
+    the parallel form of Welford's algorithm (Chan et al.), memory does not depend on the number of frames. Moments of
+    blocks of 8 or 16 bit integers are computed exactly with integer arithmetic.
+
+    band_rows:  Number of rows processed at once (small bands stay in the CPU cache)
+    """
+    MAX_EXACT_FRAMES = 4096
+
+    def __init__(self, band_rows=4):
+        self.band_rows = band_rows
+        self.n = 0
+        self.mean = None
+        self._m2 = None
+
+    def add(self, frames):
+        frames = np.asarray(frames)
+        nb = frames.shape[0]
+        if nb == 0:
+            return
+        if self.mean is None:
+            self.mean = np.zeros(frames.shape[1:])
+            self._m2 = np.zeros(frames.shape[1:])
+        exact = frames.dtype.kind in "ui" and frames.dtype.itemsize <= 2
+        if exact and nb > self.MAX_EXACT_FRAMES:
+            # Integer sums of larger blocks could overflow
+            for i in range(0, nb, self.MAX_EXACT_FRAMES):
+                self.add(frames[i:i+self.MAX_EXACT_FRAMES])
+            return
+        n = self.n + nb
+        for y0 in range(0, frames.shape[1], self.band_rows):
+            band = frames[:, y0:y0+self.band_rows]
+            if exact:
+                b = band.astype(np.int64)
+                s = b.sum(axis=0)
+                b *= b
+                m2_b = b.sum(axis=0) * nb
+                m2_b -= s*s
+                m2_b = m2_b / float(nb)
+                mean_b = s / float(nb)
+            else:
+                mean_b = band.sum(axis=0, dtype=np.float64)
+                mean_b /= nb
+                d = band - mean_b
+                d *= d
+                m2_b = d.sum(axis=0)
+            mean = self.mean[y0:y0+self.band_rows]
+            delta = mean_b - mean
+            mean += delta * (nb / n)
+            delta *= delta
+            delta *= self.n * nb / n
+            delta += m2_b
+            self._m2[y0:y0+self.band_rows] += delta
+        self.n = n
+
+    def merge(self, other):
+        """
+        Add the statistics of another RunningStats instance (e.g. of frames that were added in another process).
+        """
+        if other.n == 0:
+            return
+        if self.n == 0:
+            self.n, self.mean, self._m2 = other.n, other.mean.copy(), other._m2.copy()
+            return
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean += delta * (other.n / n)
+        delta *= delta
+        delta *= self.n * other.n / n
+        delta += other._m2
+        self._m2 += delta
+        self.n = n
+
+    def get_variance(self):
+        return self._m2 / self.n
+
+    def get_std(self):
+        return np.sqrt(self.get_variance())
+
+
+def compute_background(filename, n_frames=100, bad_pixel_threshold=6.):
+    """
+    Mean and standard deviation of the first n_frames frames of a CXD file. Pixels with a mean above the mean of the
+    middle 50% of all pixel means plus bad_pixel_threshold times their standard deviation are marked as bad and set to 0
+    in the background. Frames are read in blocks of BLOCK_FRAMES.
+    """
+    R = CXDReader(filename)
+    N = min([n_frames, R.get_number_of_frames()])
+    S = RunningStats()
+    frame_mean = np.zeros(N)
+    for i0 in range(0, N, BLOCK_FRAMES):
+        frames = R.get_frames(i0, min([i0+BLOCK_FRAMES, N]))  # dtype: uint16
+        S.add(frames)
+        frame_mean[i0:i0+len(frames)] = frames.mean(axis=(1, 2))
+    R.close()
+    bg = S.mean
+    bg_std = S.get_std()
+    # Use the standard deviation of the 50% middle values to find bad pixels
+    n = bg.size
+    q = round(n/4)
+    middle_bg = np.partition(bg.ravel(), (q, n-q-1))[q:n-q]
+    middle_std = np.std(middle_bg)
+    good_pixels = bg < np.mean(middle_bg)+middle_std*bad_pixel_threshold
+    bg *= good_pixels
+    return {"bg": bg, "bg_std": bg_std, "good_pixels": good_pixels, "frame_mean": frame_mean}
+
+def compute_flatfield(filename, n_frames=100, bg=None, good_pixels=None):
+    """
+    Median and standard deviation of the first n_frames frames of a CXD file after subtraction of the background bg
+    and masking with good_pixels. If bg is None the median of the first frame is subtracted. The frames are read in
+    bands of rows (at most BAND_NBYTES for all frames) in which the exact median is found by sorting the raw values of
+    every pixel. Subtraction of the background and masking are applied to the middle values only.
+    """
+    R = CXDReader(filename)
+    N = min([n_frames, R.get_number_of_frames()])
+    frame = R.get_frame(0)  # dtype: uint16
+    if good_pixels is None:
+        log_warning(logger, "Good pixels information is missing. Using all the pixels.")
+        good_pixels = np.ones_like(frame)
+    if bg is None:
+        log_warning(logger, "Background information is missing. Using median of the 1st frame as background.")
+        bg = np.median(frame.flatten())
+    Y, X = frame.shape
+    bg = np.broadcast_to(bg, (Y, X))
+    ff = np.zeros((Y, X), dtype=np.float32)
+    ff_std = np.zeros((Y, X), dtype=np.float32)
+    # Intensity and first moments of the (masked) raw frames, the background is subtracted at the end
+    mass = np.zeros(N)
+    moment_y = np.zeros(N)
+    moment_x = np.zeros(N)
+    band_rows = max([1, BAND_NBYTES // (N * X * frame.dtype.itemsize)])
+    for y0 in range(0, Y, band_rows):
+        y1 = min([y0+band_rows, Y])
+        band = R.get_frames(0, N, rows=slice(y0, y1))
+        gp = good_pixels[y0:y1]
+        S = RunningStats()
+        S.add(band)
+        ff_std[y0:y1] = S.get_std() * gp
+        for i in range(N):
+            masked = band[i] * gp
+            rows = masked.sum(axis=1, dtype=np.float64)
+            mass[i] += rows.sum()
+            moment_y[i] += rows @ np.arange(y0, y1, dtype=np.float64)
+            moment_x[i] += masked.sum(axis=0, dtype=np.float64) @ np.arange(X, dtype=np.float64)
+        # Sort the values of every pixel (contiguous in memory after the transposition, which is done row by row
+        # to stay in the CPU cache)
+        values = np.empty((y1-y0, X, N), dtype=band.dtype)
+        for r in range(y1-y0):
+            values[r] = band[:, r].T
+        del band
+        values.sort(axis=-1)
+        lo = ((values[:, :, (N-1)//2].astype(np.float32) - bg[y0:y1])*gp).astype(np.float32)
+        hi = ((values[:, :, N//2].astype(np.float32) - bg[y0:y1])*gp).astype(np.float32)
+        ff[y0:y1] = (lo + hi) / np.float32(2.)
+        del values
+    R.close()
+    bgm = bg * good_pixels
+    mass -= bgm.sum()
+    moment_y -= bgm.sum(axis=1) @ np.arange(Y, dtype=np.float64)
+    moment_x -= bgm.sum(axis=0) @ np.arange(X, dtype=np.float64)
+    com_stack = np.stack([moment_y / mass, moment_x / mass], axis=1)
+    return {"ff": ff, "ff_std": ff_std, "frame_mean": mass / (Y*X), "center_of_mass": com_stack}
+
+def find_roi(ff, ff_low_limit, roi_fraction, pad=20):
+    """
+    Region of interest around the beam spot on the flatfield ff. Pixels below ff_low_limit are ignored. In each
+    dimension the ROI is centred on the centre of mass of the projection. Its half width is the smallest one that
+    contains roi_fraction of the projected intensity, plus pad pixels. Returns (ymin, ymax, xmin, xmax).
+    """
+    ff_thres = ff.copy()
+    ff_thres[ff < ff_low_limit] = 0
+    ymin, ymax = _find_extent(np.sum(ff_thres, axis=1), roi_fraction, pad)
+    xmin, xmax = _find_extent(np.sum(ff_thres, axis=0), roi_fraction, pad)
+    return ymin, ymax, xmin, xmax
+
+def find_rois(ff, ff_low_limit, roi_fraction, n_spots, pad=20):
+    """
+    Regions of interest (ymin, ymax, xmin, xmax) around the n_spots brightest beam spots on the flatfield ff. Spots are
+    the connected regions of pixels at or above ff_low_limit. The ROI of every spot is found as in find_roi,
+    with only the pixels of that spot taken into account. The ROIs are ordered by decreasing intensity of their spots.
+    """
+    ff_thres = ff.copy()
+    ff_thres[ff < ff_low_limit] = 0
+    labels, n = scipy.ndimage.label(ff_thres > 0, structure=np.ones((3, 3)))
+    if n == 0:
+        return []
+    intensities = scipy.ndimage.sum(ff_thres, labels, index=np.arange(1, n+1))
+    rois = []
+    for k in np.argsort(intensities)[::-1][:n_spots]:
+        spot = np.where(labels == k+1, ff_thres, 0)
+        ymin, ymax = _find_extent(np.sum(spot, axis=1), roi_fraction, pad)
+        xmin, xmax = _find_extent(np.sum(spot, axis=0), roi_fraction, pad)
+        rois.append((ymin, ymax, xmin, xmax))
+    return rois
+
+def _find_extent(p, fraction, pad):
+    # Window p[c-w:c+w] (Python slicing) around the rounded centre of mass c with the smallest w >= 1 that holds the
+    # given fraction of the sum of p. All windows are summed at once from the cumulative sum, the first w that
+    # reaches the target is found by bisection on the running maximum of the window sums.
+    n = len(p)
+    com = np.sum(p * np.arange(n, dtype=float)) / np.sum(p)
+    c = round(com)
+    target = p.sum()*fraction
+    C = np.zeros(n+1)
+    np.cumsum(p, dtype=np.float64, out=C[1:])
+    # Beyond w = c + n the window is the full array
+    w = np.arange(1, c + n + 2)
+    a = c - w
+    a = np.clip(np.where(a < 0, a + n, a), 0, None)
+    b = np.minimum(c + w, n)
+    S = np.where(a < b, C[b] - C[np.minimum(a, n)], 0.)
+    if target > C[-1] + 1E-6*abs(C[-1]):
+        log_and_raise_error(logger, "No window holds a fraction of %f of the intensity." % fraction)
+    # The cumulative sum rounds differently than the sum of the window, the search starts slightly below the target
+    # and the boundary is then checked on the sums of the windows
+    k = np.searchsorted(np.maximum.accumulate(S), target - 1E-6*abs(target), side="left")
+    width = int(w[min([k, len(S)-1])])
+    while width > 1 and not target > p[c-width+1:c+width-1].sum():
+        width -= 1
+    while target > p[c-width:c+width].sum():
+        width += 1
+    vmin = max([c - width - pad, 0])
+    vmax = min([c + width + pad, n])
+    return vmin, vmax
+
+def get_background(filename, n_frames=100, bad_pixel_threshold=6., store=None, compute=compute_background):
+    """
+    Background of a CXD file from the calibration store (default: CalibrationStore()). compute can be replaced by a
+    function with the signature of compute_background, e.g. to report on newly computed backgrounds.
+    """
+    if store is None:
+        store = CalibrationStore()
+    return store.get("bg", filename, {"n_frames": n_frames, "bad_pixel_threshold": bad_pixel_threshold}, compute)
+
+def get_flatfield(filename, n_frames=100, bg=None, good_pixels=None, store=None, compute=compute_flatfield):
+    """
+    Flatfield of a CXD file from the calibration store (default: CalibrationStore()). Background and good pixels enter
+    the key by their content.
+    """
+    if store is None:
+        store = CalibrationStore()
+    return store.get("ff", filename, {"n_frames": n_frames, "bg": bg, "good_pixels": good_pixels}, compute)
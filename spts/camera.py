@@ -1,35 +1,173 @@
+import mmap
 import olefile
 from struct import unpack
 import numpy as np
 
+import logging
+logger = logging.getLogger(__name__)
+
+import spts.log
+from spts.log import log_and_raise_error,log_warning,log_info,log_debug
+
+# Special sector numbers of the file allocation table
+_ENDOFCHAIN = 0xFFFFFFFE
+
+_DTYPES = {8: np.uint8, 16: np.uint16}
+
 class CXDReader:
-    def __init__(self, filename):
+    """
+    Reader for Hamamatsu CXD files (OLE2 compound files with one storage per frame). When the file is opened the shape,
+    dtype and the file offsets of the sector runs of every bitmap are indexed once. Frames are then read directly from
+    the file (or from a memory map of the file with use_mmap=True) without going through the OLE streams.
+    """
+    def __init__(self, filename, use_mmap=False):
         self._ole = olefile.OleFileIO(filename)
         self._n = unpack('i',self._ole.openstream('File Info/Field Count').read())[0]
-        self._closed = False 
-        
+        self._closed = False
+        self._fp = open(filename, "rb", buffering=0)
+        self._mm = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ) if use_mmap else None
+        self._build_index()
+
+    def _build_index(self):
+        # Per frame: (height, width), dtype and list of (file offset, number of bytes) of the bitmap data
+        self._shapes = []
+        self._dtypes = []
+        self._runs = []
+        sectorsize = self._ole.sectorsize
+        for i in range(self._n):
+            prefix = 'Field Data/Field %d' % (i+1)
+            bits = unpack('d',self._ole.openstream(prefix+'/Details/Image_Depth').read())[0]
+            if bits not in _DTYPES:
+                log_and_raise_error(logger, "Image depth of %i bits (frame %i) is not supported." % (bits, i))
+            height = int(np.round(unpack('d',self._ole.openstream(prefix+'/Details/Image_Height').read())[0]))
+            width = int(np.round(unpack('d',self._ole.openstream(prefix+'/Details/Image_Width').read())[0]))
+            self._shapes.append((height, width))
+            self._dtypes.append(np.dtype(_DTYPES[bits]))
+            entry = self._ole.direntries[self._ole._find(prefix+'/i_Image1/Bitmap 1')]
+            if entry.size < self._ole.minisectorcutoff:
+                # Small streams live in the mini stream, these are read through olefile
+                self._runs.append(None)
+                continue
+            runs = []
+            sect = entry.isectStart
+            remaining = entry.size
+            while remaining > 0 and sect != _ENDOFCHAIN:
+                offset = (sect+1) * sectorsize
+                n = min([sectorsize, remaining])
+                if len(runs) > 0 and runs[-1][0] + runs[-1][1] == offset:
+                    runs[-1][1] += n
+                else:
+                    runs.append([offset, n])
+                remaining -= n
+                sect = self._ole.fat[sect]
+            if remaining > 0:
+                log_and_raise_error(logger, "Sector chain of frame %i is shorter than the bitmap." % i)
+            self._runs.append(runs)
+
     def get_number_of_frames(self):
         return self._n
-        
+
+    def get_frame_shape(self, i):
+        return self._shapes[i]
+
+    def get_frame_dtype(self, i):
+        return self._dtypes[i]
+
     def get_frame(self, i):
         if not i < self._n:
             return None
         else:
-            prefix = 'Field Data/Field %d' % (i+1)
-            bits = unpack('d',self._ole.openstream(prefix+'/Details/Image_Depth').read())[0]
-            dtype = None
-            if(bits == 16):
-                dtype = np.uint16
-            height = int(np.round(unpack('d',self._ole.openstream(prefix+'/Details/Image_Height').read())[0]))
-            width = int(np.round(unpack('d',self._ole.openstream(prefix+'/Details/Image_Width').read())[0]))
-            data = self._ole.openstream(prefix+'/i_Image1/Bitmap 1').read()
-            img = np.frombuffer(data, dtype=dtype).reshape((height,width))
+            runs = self._runs[i]
+            if runs is None:
+                data = self._ole.openstream('Field Data/Field %d/i_Image1/Bitmap 1' % (i+1)).read()
+                return np.frombuffer(data, dtype=self._dtypes[i]).reshape(self._shapes[i])
+            if self._mm is not None and len(runs) == 1:
+                # No copy, the frame is a read-only view of the memory map
+                return np.frombuffer(self._mm, dtype=self._dtypes[i], count=int(np.prod(self._shapes[i])), offset=runs[0][0]).reshape(self._shapes[i])
+            img = np.empty(self._shapes[i], dtype=self._dtypes[i])
+            self._read_runs(runs, memoryview(img).cast("B"))
             return img
 
+    def get_frames(self, start, stop, rows=None):
+        """
+        Return the frames start, ..., stop-1 as an array of shape (N, Y, X). Sector runs that continue from one frame
+        to the next are read at once. If rows (slice) is given only these rows of every frame are read.
+        """
+        stop = min([stop, self._n])
+        if stop <= start:
+            return None
+        shape = self._shapes[start]
+        dtype = self._dtypes[start]
+        for i in range(start, stop):
+            if self._shapes[i] != shape or self._dtypes[i] != dtype:
+                log_and_raise_error(logger, "Frames %i to %i differ in shape or dtype." % (start, stop-1))
+        y0, y1 = 0, shape[0]
+        if rows is not None:
+            y0, y1, step = rows.indices(shape[0])
+            if step != 1:
+                log_and_raise_error(logger, "Only contiguous rows can be read.")
+            y1 = max([y0, y1])
+        row_nbytes = shape[1] * dtype.itemsize
+        out = np.empty((stop-start, y1-y0, shape[1]), dtype=dtype)
+        if out.size == 0:
+            return out
+        buf = memoryview(out).cast("B")
+        frame_nbytes = (y1-y0) * row_nbytes
+        runs = []
+        for k, i in enumerate(range(start, stop)):
+            if self._runs[i] is None:
+                out[k] = self.get_frame(i)[y0:y1]
+                continue
+            pos = k * frame_nbytes
+            for offset, n in _clip_runs(self._runs[i], y0*row_nbytes, y1*row_nbytes):
+                # Merge with the previous run if both file and output buffer continue
+                if len(runs) > 0 and runs[-1][0] + runs[-1][1] == offset and runs[-1][2] + runs[-1][1] == pos:
+                    runs[-1][1] += n
+                else:
+                    runs.append([offset, n, pos])
+                pos += n
+        for offset, n, pos in runs:
+            self._read_runs([(offset, n)], buf[pos:pos+n])
+        return out
+
+    def _read_runs(self, runs, buf):
+        pos = 0
+        for offset, n in runs:
+            if self._mm is not None:
+                with memoryview(self._mm) as m:
+                    buf[pos:pos+n] = m[offset:offset+n]
+            else:
+                self._fp.seek(offset)
+                m = 0
+                while m < n:
+                    r = self._fp.readinto(buf[pos+m:pos+n])
+                    if not r:
+                        log_and_raise_error(logger, "Unexpected end of file.")
+                    m += r
+            pos += n
+
     def close(self):
+        if self._mm is not None:
+            try:
+                self._mm.close()
+            except BufferError:
+                # Frames that are views of the map are still in use, the map is closed once they are released
+                pass
+            self._mm = None
+        self._fp.close()
         self._ole.close()
         self._closed = True
 
     def is_closed(self):
         return self._closed
-        
+
+
+def _clip_runs(runs, begin, end):
+    # Sector runs of the bytes begin, ..., end-1 of a stream
+    p = 0
+    for offset, n in runs:
+        a = max([p, begin])
+        b = min([p+n, end])
+        if b > a:
+            yield offset + a - p, b - a
+        p += n
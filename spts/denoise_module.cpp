@@ -1,94 +1,333 @@
+#define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
 #include <Python.h>
 #include <numpy/arrayobject.h>
-#include <math.h>
-#include <stdio.h>
+#include <stdint.h>
+#include <vector>
+#include <thread>
+#include <algorithm>
 
-PyDoc_STRVAR(calc_hists__doc__, "calc_hists(images, vmin, vmax, window_size, dx=1)\nRun this function on a stack of background images. vmin and vmax are the expected lowest and largest value that are within the noise. The window_size should not exceed the smallest feature that shall be detected from the denoised images.\n");
+// Window sums are computed with running sums: for every output row the column sums over the window height are
+// updated by one row at the top and one row at the bottom and every output pixel is obtained from its left neighbour
+// by adding one column and removing another. The cost per pixel therefore does not depend on the window size.
+// Windows that do not fit completely into the image are skipped (as before), i.e. their sums are left untouched.
+
+// Run func(y_begin, y_end) for bands of rows on n_threads threads
+template <typename F>
+static void run_rows(int N_y, int n_threads, F func)
+{
+  if (n_threads <= 0) {
+    n_threads = (int) std::thread::hardware_concurrency();
+  }
+  n_threads = std::max(1, std::min(n_threads, N_y));
+  if (n_threads == 1) {
+    func(0, N_y);
+    return;
+  }
+  std::vector<std::thread> threads;
+  int band = (N_y + n_threads - 1) / n_threads;
+  for (int y0 = 0; y0 < N_y; y0 += band) {
+    threads.push_back(std::thread(func, y0, std::min(y0 + band, N_y)));
+  }
+  for (size_t t = 0; t < threads.size(); t++) {
+    threads[t].join();
+  }
+}
+
+// Sums of the C channels of the input (N_y, N_x, C) over all windows with the upper left corner at
+// (y - window_size/2, x - window_size/2) for the output rows y_begin, ..., y_end-1.
+// emit(j, c, sum) is called for every pixel index j whose window lies within the image.
+template <typename T, typename F>
+static void window_sums(const T *in, int N_y, int N_x, int C, int window_size, int y_begin, int y_end, F emit)
+{
+  int h = window_size / 2;
+  int y_lo = std::max(y_begin, h);
+  int y_hi = std::min(y_end, N_y - window_size + h + 1);
+  int x_hi = N_x - window_size + h + 1;
+  if ((y_lo >= y_hi) || (h >= x_hi)) {
+    return;
+  }
+  std::vector<int64_t> col((size_t) N_x * C, 0);
+  std::vector<int64_t> acc(C);
+  int x, y, c, r;
+  for (r = y_lo - h; r < y_lo - h + window_size; r++) {
+    for (x = 0; x < N_x * C; x++) {
+      col[x] += in[(size_t) r * N_x * C + x];
+    }
+  }
+  for (y = y_lo; y < y_hi; y++) {
+    if (y > y_lo) {
+      const T *row_out = in + (size_t) (y - 1 - h) * N_x * C;
+      const T *row_in = in + (size_t) (y - h + window_size - 1) * N_x * C;
+      for (x = 0; x < N_x * C; x++) {
+	col[x] += row_in[x] - row_out[x];
+      }
+    }
+    std::fill(acc.begin(), acc.end(), 0);
+    for (x = 0; x < window_size; x++) {
+      for (c = 0; c < C; c++) {
+	acc[c] += col[x * C + c];
+      }
+    }
+    for (x = h; x < x_hi; x++) {
+      if (x > h) {
+	for (c = 0; c < C; c++) {
+	  acc[c] += col[(x - h + window_size - 1) * C + c] - col[(x - 1 - h) * C + c];
+	}
+      }
+      for (c = 0; c < C; c++) {
+	emit((size_t) y * N_x + x, c, acc[c]);
+      }
+    }
+  }
+}
+
+PyDoc_STRVAR(calc_hists__doc__, "calc_hists(images, vmin, vmax, window_size, dx=1, n_threads=0)\nRun this function on a stack of background images. vmin and vmax are the expected lowest and largest value that are within the noise. The window_size should not exceed the smallest feature that shall be detected from the denoised images. n_threads=0 uses all cores.\n");
 static PyObject *calc_hists(PyObject *self, PyObject *args, PyObject *kwargs)
 {
   PyObject *images_obj;
   int vmin;
   int vmax;
   int window_size;
-  int v;
-  int i,j,k,l;
-  int i_hist;
-  int x_corner,y_corner;
-  int i_x, i_y;
-  int N_x, N_y, N_pix, N_images, hist_len;
   int dx = 1;
-  
-  static char *kwlist[] = {"images", "vmin", "vmax", "window_size", "dx", NULL};
+  int n_threads = 0;
 
-  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "Oiii|i", kwlist, &images_obj, &vmin, &vmax, &window_size, &dx)) {
+  static char *kwlist[] = {(char *)"images", (char *)"vmin", (char *)"vmax", (char *)"window_size", (char *)"dx", (char *)"n_threads", NULL};
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "Oiii|ii", kwlist, &images_obj, &vmin, &vmax, &window_size, &dx, &n_threads)) {
     return NULL;
   }
-  
-  PyObject * images_array = PyArray_FROM_OTF(images_obj, NPY_INT, NPY_IN_ARRAY);
-  if (images_array == NULL) {
-    Py_XDECREF(images_array);
+  if ((window_size < 1) || (dx < 1) || (vmax < vmin)) {
+    PyErr_SetString(PyExc_ValueError, "Invalid parameters (window_size >= 1, dx >= 1 and vmax >= vmin required)\n");
     return NULL;
   }
-  int * images = (int *)PyArray_DATA(images_array);
 
-  int ndim = PyArray_NDIM(images_array);
-  if (ndim != 3) {
+  PyArrayObject *images_array = (PyArrayObject *)PyArray_FROM_OTF(images_obj, NPY_INT32, NPY_ARRAY_IN_ARRAY);
+  if (images_array == NULL) {
+    return NULL;
+  }
+  if (PyArray_NDIM(images_array) != 3) {
     PyErr_SetString(PyExc_ValueError, "Input array must be 3-dimensional\n");
-    Py_XDECREF(images_array);
+    Py_DECREF(images_array);
+    return NULL;
+  }
+  const int32_t *images = (const int32_t *)PyArray_DATA(images_array);
+
+  int N_x      = (int) PyArray_DIM(images_array, 2);
+  int N_y      = (int) PyArray_DIM(images_array, 1);
+  int N_images = (int) PyArray_DIM(images_array, 0);
+  size_t N_pix = (size_t) N_x * N_y;
+  int hist_len = (vmax - vmin + dx) / dx;
+
+  npy_intp out_dim[] = {N_y, N_x, hist_len};
+  PyArrayObject *window_hists_array = (PyArrayObject *)PyArray_ZEROS(3, out_dim, NPY_DOUBLE, 0);
+  if (window_hists_array == NULL) {
+    Py_DECREF(images_array);
     return NULL;
   }
+  double *window_hists = (double *)PyArray_DATA(window_hists_array);
+
+  Py_BEGIN_ALLOW_THREADS
 
-  N_x      = (int) PyArray_DIM(images_array, 2);
-  N_y      = (int) PyArray_DIM(images_array, 1);
-  N_pix    = N_x * N_y;
-  N_images = (int) PyArray_DIM(images_array, 0);
-  hist_len = (vmax - vmin + dx) / dx;
- 
   // Build pixel histograms
-  int * pixel_hists = (int *) calloc(N_pix*hist_len, sizeof(int));
-  for (i = 0; i < N_images; i++) {
-    for (j = 0; j < N_pix; j++) {
-      v = images[i*N_pix+j];
+  std::vector<int32_t> pixel_hists(N_pix * hist_len, 0);
+  run_rows(N_y, n_threads, [&](int y_begin, int y_end) {
+      for (int i = 0; i < N_images; i++) {
+	for (size_t j = (size_t) y_begin * N_x; j < (size_t) y_end * N_x; j++) {
+	  int v = images[i * N_pix + j];
+	  if ((v >= vmin) && (v <= vmax)) {
+	    pixel_hists[j * hist_len + (v - vmin) / dx] += 1;
+	  }
+	}
+      }
+    });
+
+  // Combine to window histograms and normalise to one frame
+  run_rows(N_y, n_threads, [&](int y_begin, int y_end) {
+      window_sums(pixel_hists.data(), N_y, N_x, hist_len, window_size, y_begin, y_end, [&](size_t j, int k, int64_t n) {
+	  window_hists[j * hist_len + k] = (double) n / N_images;
+	});
+    });
+
+  Py_END_ALLOW_THREADS
+
+  Py_DECREF(images_array);
+  return (PyObject *)window_hists_array;
+}
+
+// Sum over all bins of the background histogram of bin value times (truncated) bin count
+static void scores_bg_rows(const double *hists_bg, double *scores_bg, int N_x, int y_begin, int y_end,
+			   int vmin, int vmax, int vmin_full, int full_hist_len, int hist_len, int dx)
+{
+  for (size_t j = (size_t) y_begin * N_x; j < (size_t) y_end * N_x; j++) {
+    int64_t s = 0;
+    for (int k = 0; k < full_hist_len; k++) {
+      int v = vmin_full + k * dx;
       if ((v >= vmin) && (v <= vmax)) {
-	l = (v-vmin) / dx;
-	pixel_hists[j*hist_len+l] += 1;
-      } 
+	int n_bg = (int) hists_bg[j * hist_len + (v - vmin) / dx];
+	s += (int64_t) v * n_bg;
+      }
     }
+    scores_bg[j] = (double) s;
   }
+}
 
-  // Combine to window histograms
-  int out_dim[] = {N_y, N_x, hist_len};
-  PyObject *window_hists_array = (PyObject *)PyArray_FromDims(3, out_dim, NPY_DOUBLE);
-  double * window_hists = (double *)PyArray_DATA(window_hists_array);
-  for (j = 0; j < N_pix; j++) {
-    x_corner = j % N_x - window_size/2;
-    y_corner = j / N_x - window_size/2;
-    if ((x_corner >= 0) && ((x_corner+window_size) <= N_x) && \
-	(y_corner >= 0) && ((y_corner+window_size) <= N_y)) {
-      for (i_x = 0; i_x < window_size; i_x++) {
-	for (i_y = 0; i_y < window_size; i_y++) {
-	  i_hist = (y_corner + i_y) * N_x + (x_corner + i_x);
-	  for (k = 0; k < hist_len; k++) {
-	    window_hists[j*hist_len+k] += pixel_hists[i_hist*hist_len+k];
-	  }
+// Image score = sum over the window of the binned pixel values minus the background score
+static void scores_rows(const int32_t *image, const double *scores_bg, double *scores, int32_t *binned,
+			int N_y, int N_x, int n_threads, int window_size, int vmin_full, int vmax_full, int dx)
+{
+  int full_hist_len = (vmax_full - vmin_full + dx) / dx;
+  int v_last = vmin_full + (full_hist_len - 1) * dx;
+  run_rows(N_y, n_threads, [&](int y_begin, int y_end) {
+      for (size_t j = (size_t) y_begin * N_x; j < (size_t) y_end * N_x; j++) {
+	int v = image[j];
+	if (v < vmin_full) {
+	  // Below range pixels are not counted
+	  binned[j] = 0;
+	} else if (v <= vmax_full) {
+	  binned[j] = vmin_full + ((v - vmin_full) / dx) * dx;
+	} else {
+	  // If above range add to last bin
+	  binned[j] = v_last;
 	}
+	scores[j] = -scores_bg[j];
       }
-    }
+    });
+  run_rows(N_y, n_threads, [&](int y_begin, int y_end) {
+      window_sums(binned, N_y, N_x, 1, window_size, y_begin, y_end, [&](size_t j, int c, int64_t s) {
+	  scores[j] = (double) (s - (int64_t) scores_bg[j]);
+	});
+    });
+}
+
+static PyArrayObject *get_image(PyObject *image_obj)
+{
+  PyArrayObject *image_array = (PyArrayObject *)PyArray_FROM_OTF(image_obj, NPY_INT32, NPY_ARRAY_IN_ARRAY);
+  if (image_array == NULL) {
+    return NULL;
   }
+  if (PyArray_NDIM(image_array) != 2) {
+    PyErr_SetString(PyExc_ValueError, "Image input array must be 2-dimensional\n");
+    Py_DECREF(image_array);
+    return NULL;
+  }
+  return image_array;
+}
 
-  // Normalise to one frame
-  for (j = 0; j < N_pix; j++) {
-    for (k = 0; k < hist_len; k++) {
-      window_hists[j*hist_len+k] /= N_images;
-    }
+PyDoc_STRVAR(calc_scores_bg__doc__, "calc_scores_bg(hists_bg, vmin, vmax, vmin_full=-50, vmax_full=255, dx=1, n_threads=0)\nBackground score for every pixel from the window histograms returned by calc_hists. Pass the result to denoise_scores.\n");
+static PyObject *calc_scores_bg(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+  PyObject *hists_bg_obj;
+  int vmin;
+  int vmax;
+  int vmin_full = -50;
+  int vmax_full = 255;
+  int dx = 1;
+  int n_threads = 0;
+
+  static char *kwlist[] = {(char *)"hists_bg", (char *)"vmin", (char *)"vmax", (char *)"vmin_full", (char *)"vmax_full", (char *)"dx", (char *)"n_threads", NULL};
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "Oii|iiii", kwlist, &hists_bg_obj, &vmin, &vmax, &vmin_full, &vmax_full, &dx, &n_threads)) {
+    return NULL;
+  }
+  if ((dx < 1) || (vmax < vmin) || (vmax_full < vmin_full)) {
+    PyErr_SetString(PyExc_ValueError, "Invalid parameters (dx >= 1, vmax >= vmin and vmax_full >= vmin_full required)\n");
+    return NULL;
+  }
+
+  PyArrayObject *hists_bg_array = (PyArrayObject *)PyArray_FROM_OTF(hists_bg_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
+  if (hists_bg_array == NULL) {
+    return NULL;
   }
-  
-  free(pixel_hists);
-  
-  return window_hists_array;
+  int hist_len = (vmax - vmin + dx) / dx;
+  if ((PyArray_NDIM(hists_bg_array) != 3) || (PyArray_DIM(hists_bg_array, 2) != hist_len)) {
+    PyErr_SetString(PyExc_ValueError, "Hists_Bg input array must be 3-dimensional with (vmax-vmin+dx)/dx bins\n");
+    Py_DECREF(hists_bg_array);
+    return NULL;
+  }
+  const double *hists_bg = (const double *)PyArray_DATA(hists_bg_array);
+  int N_x = (int) PyArray_DIM(hists_bg_array, 1);
+  int N_y = (int) PyArray_DIM(hists_bg_array, 0);
+  int full_hist_len = (vmax_full - vmin_full + dx) / dx;
+
+  npy_intp out_dim[] = {N_y, N_x};
+  PyArrayObject *scores_bg_array = (PyArrayObject *)PyArray_SimpleNew(2, out_dim, NPY_DOUBLE);
+  if (scores_bg_array == NULL) {
+    Py_DECREF(hists_bg_array);
+    return NULL;
+  }
+  double *scores_bg = (double *)PyArray_DATA(scores_bg_array);
+
+  Py_BEGIN_ALLOW_THREADS
+  run_rows(N_y, n_threads, [&](int y_begin, int y_end) {
+      scores_bg_rows(hists_bg, scores_bg, N_x, y_begin, y_end, vmin, vmax, vmin_full, full_hist_len, hist_len, dx);
+    });
+  Py_END_ALLOW_THREADS
+
+  Py_DECREF(hists_bg_array);
+  return (PyObject *)scores_bg_array;
 }
 
-PyDoc_STRVAR(denoise__doc__, "denoise(image, hists_bg, vmin, vmax, window_size, vmin_full=-50, vmax_full=255, dx=1)\n\n");
+PyDoc_STRVAR(denoise_scores__doc__, "denoise_scores(image, scores_bg, window_size, vmin_full=-50, vmax_full=255, dx=1, n_threads=0)\nScore image from the background scores returned by calc_scores_bg.\n");
+static PyObject *denoise_scores(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+  PyObject *image_obj;
+  PyObject *scores_bg_obj;
+  int window_size;
+  int vmin_full = -50;
+  int vmax_full = 255;
+  int dx = 1;
+  int n_threads = 0;
+
+  static char *kwlist[] = {(char *)"image", (char *)"scores_bg", (char *)"window_size", (char *)"vmin_full", (char *)"vmax_full", (char *)"dx", (char *)"n_threads", NULL};
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OOi|iiii", kwlist, &image_obj, &scores_bg_obj, &window_size, &vmin_full, &vmax_full, &dx, &n_threads)) {
+    return NULL;
+  }
+  if ((window_size < 1) || (dx < 1) || (vmax_full < vmin_full)) {
+    PyErr_SetString(PyExc_ValueError, "Invalid parameters (window_size >= 1, dx >= 1 and vmax_full >= vmin_full required)\n");
+    return NULL;
+  }
+
+  PyArrayObject *image_array = get_image(image_obj);
+  if (image_array == NULL) {
+    return NULL;
+  }
+  PyArrayObject *scores_bg_array = (PyArrayObject *)PyArray_FROM_OTF(scores_bg_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
+  if (scores_bg_array == NULL) {
+    Py_DECREF(image_array);
+    return NULL;
+  }
+  if (!PyArray_SAMESHAPE(image_array, scores_bg_array)) {
+    PyErr_SetString(PyExc_ValueError, "Image and background scores must have the same shape\n");
+    Py_DECREF(image_array);
+    Py_DECREF(scores_bg_array);
+    return NULL;
+  }
+  int N_x = (int) PyArray_DIM(image_array, 1);
+  int N_y = (int) PyArray_DIM(image_array, 0);
+
+  npy_intp out_dim[] = {N_y, N_x};
+  PyArrayObject *scores_array = (PyArrayObject *)PyArray_SimpleNew(2, out_dim, NPY_DOUBLE);
+  if (scores_array == NULL) {
+    Py_DECREF(image_array);
+    Py_DECREF(scores_bg_array);
+    return NULL;
+  }
+  const int32_t *image = (const int32_t *)PyArray_DATA(image_array);
+  const double *scores_bg = (const double *)PyArray_DATA(scores_bg_array);
+  double *scores = (double *)PyArray_DATA(scores_array);
+
+  Py_BEGIN_ALLOW_THREADS
+  std::vector<int32_t> binned((size_t) N_x * N_y);
+  scores_rows(image, scores_bg, scores, binned.data(), N_y, N_x, n_threads, window_size, vmin_full, vmax_full, dx);
+  Py_END_ALLOW_THREADS
+
+  Py_DECREF(image_array);
+  Py_DECREF(scores_bg_array);
+  return (PyObject *)scores_array;
+}
+
+PyDoc_STRVAR(denoise__doc__, "denoise(image, hists_bg, vmin, vmax, window_size, vmin_full=-50, vmax_full=255, dx=1, n_threads=0)\nScore image from the background histograms returned by calc_hists. When denoising many images compute the background scores once with calc_scores_bg and use denoise_scores.\n");
 static PyObject *denoise(PyObject *self, PyObject *args, PyObject *kwargs)
 {
   PyObject *image_obj;
@@ -96,113 +335,74 @@ static PyObject *denoise(PyObject *self, PyObject *args, PyObject *kwargs)
   int vmin;
   int vmax;
   int window_size;
-  int v;
-  int i,j,k,l;
-  int x_corner,y_corner;
-  int i_x, i_y;
-  int n_bg, n_img;
   // Set default values for not provided optional keyword arguments
   int vmin_full = -50;
   int vmax_full = 255;
   int dx = 1;
-  
-  static char *kwlist[] = {"image", "hists_bg", "vmin", "vmax", "window_size", "vmin_full", "vmax_full", "dx", NULL};
+  int n_threads = 0;
 
-  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OOiii|iii", kwlist, &image_obj, &hists_bg_obj, &vmin, &vmax, &window_size, &vmin_full, &vmax_full, &dx)) {
+  static char *kwlist[] = {(char *)"image", (char *)"hists_bg", (char *)"vmin", (char *)"vmax", (char *)"window_size", (char *)"vmin_full", (char *)"vmax_full", (char *)"dx", (char *)"n_threads", NULL};
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OOiii|iiii", kwlist, &image_obj, &hists_bg_obj, &vmin, &vmax, &window_size, &vmin_full, &vmax_full, &dx, &n_threads)) {
     return NULL;
   }
-  
-  PyObject * image_array = PyArray_FROM_OTF(image_obj, NPY_INT, NPY_IN_ARRAY);
-  if (image_array == NULL) {
-    Py_XDECREF(image_array);
+
+  if ((window_size < 1) || (dx < 1) || (vmax < vmin) || (vmax_full < vmin_full)) {
+    PyErr_SetString(PyExc_ValueError, "Invalid parameters (window_size >= 1, dx >= 1, vmax >= vmin and vmax_full >= vmin_full required)\n");
     return NULL;
   }
-  int * image = (int *)PyArray_DATA(image_array);
 
-  int ndim_image = PyArray_NDIM(image_array);
-  if (ndim_image != 2) {
-    PyErr_SetString(PyExc_ValueError, "Image input array must be 2-dimensional\n");
-    Py_XDECREF(image_array);
+  PyArrayObject *image_array = get_image(image_obj);
+  if (image_array == NULL) {
     return NULL;
   }
-
-  PyObject * hists_bg_array = PyArray_FROM_OTF(hists_bg_obj, NPY_DOUBLE, NPY_IN_ARRAY);
+  PyArrayObject *hists_bg_array = (PyArrayObject *)PyArray_FROM_OTF(hists_bg_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
   if (hists_bg_array == NULL) {
-    Py_XDECREF(hists_bg_array);
+    Py_DECREF(image_array);
     return NULL;
   }
-  double * hists_bg = (double *)PyArray_DATA(hists_bg_array);
-
-  int ndim_hists_bg = PyArray_NDIM(hists_bg_array);
-  if (ndim_hists_bg != 3) {
-    PyErr_SetString(PyExc_ValueError, "Hists_Bg input array must be 3-dimensional\n");
-    Py_XDECREF(hists_bg_array);
-    Py_XDECREF(image_array);
+  int hist_len = (vmax - vmin + dx) / dx;
+  if ((PyArray_NDIM(hists_bg_array) != 3) || (PyArray_DIM(hists_bg_array, 2) != hist_len) ||
+      (PyArray_DIM(hists_bg_array, 0) != PyArray_DIM(image_array, 0)) || (PyArray_DIM(hists_bg_array, 1) != PyArray_DIM(image_array, 1))) {
+    PyErr_SetString(PyExc_ValueError, "Hists_Bg input array must be 3-dimensional, match the image shape and have (vmax-vmin+dx)/dx bins\n");
+    Py_DECREF(image_array);
+    Py_DECREF(hists_bg_array);
     return NULL;
   }
-
-  int N_x      = (int) PyArray_DIM(hists_bg_array, 1);
-  int N_y      = (int) PyArray_DIM(hists_bg_array, 0);
-  int N_pix    = N_x * N_y;
+  int N_x = (int) PyArray_DIM(image_array, 1);
+  int N_y = (int) PyArray_DIM(image_array, 0);
   int full_hist_len = (vmax_full - vmin_full + dx) / dx;
-  int hist_len = (vmax - vmin + dx) / dx;
 
-  // Build window pixel histograms from image
-  int * hists_image = (int *) calloc(N_pix*full_hist_len, sizeof(int));
-  for (j = 0; j < N_pix; j++) {
-    x_corner = j % N_x - window_size/2;
-    y_corner = j / N_x - window_size/2;
-    if ((x_corner >= 0) && ((x_corner+window_size) <= N_x) && \
-	(y_corner >= 0) && ((y_corner+window_size) <= N_y)) {
-      for (i_x = 0; i_x < window_size; i_x++) {
-	for (i_y = 0; i_y < window_size; i_y++) {
-	  i = (y_corner + i_y) * N_x + (x_corner + i_x);
-	  v = image[i];
-	  k = (v - vmin_full) / dx;
-	  if ((v >= vmin_full) && (v <= vmax_full)) {
-	    hists_image[j*full_hist_len+k] += 1;
-	  } else if (v > vmax_full) {
-	    // If above range add to last bin
-	    k = full_hist_len - 1;
-	    hists_image[j*full_hist_len+k] += 1;
-	  }
-	}
-      }
-    }
+  npy_intp out_dim[] = {N_y, N_x};
+  PyArrayObject *scores_array = (PyArrayObject *)PyArray_SimpleNew(2, out_dim, NPY_DOUBLE);
+  if (scores_array == NULL) {
+    Py_DECREF(image_array);
+    Py_DECREF(hists_bg_array);
+    return NULL;
   }
+  const int32_t *image = (const int32_t *)PyArray_DATA(image_array);
+  const double *hists_bg = (const double *)PyArray_DATA(hists_bg_array);
+  double *scores = (double *)PyArray_DATA(scores_array);
 
-  //puts("Guard 1");
-  
-  // Compare and score
-  int out_dim[] = {N_y, N_x};
-  PyObject * scores_array = (PyObject *)PyArray_FromDims(2, out_dim, NPY_DOUBLE);
-  double * scores = (double *)PyArray_DATA(scores_array);
-  for (j = 0; j < N_pix; j++) {
-    scores[j] = 0.;
-    for (k = 0; k < full_hist_len; k++) {
-      v = vmin_full + k * dx;
-      if ((v >= vmin) && (v <= vmax)) {
-	l = (v-vmin)/dx;
-	n_bg = hists_bg[j*hist_len+l];
-      } else {
-	n_bg = 0;
-      }
-      n_img = hists_image[j*full_hist_len+k];
-      // Weighted subtraction of histograms
-      scores[j] += v * (n_img - n_bg);
-    }
-  }
-  
-  free(hists_image);
+  Py_BEGIN_ALLOW_THREADS
+  std::vector<double> scores_bg((size_t) N_x * N_y);
+  std::vector<int32_t> binned((size_t) N_x * N_y);
+  run_rows(N_y, n_threads, [&](int y_begin, int y_end) {
+      scores_bg_rows(hists_bg, scores_bg.data(), N_x, y_begin, y_end, vmin, vmax, vmin_full, full_hist_len, hist_len, dx);
+    });
+  scores_rows(image, scores_bg.data(), scores, binned.data(), N_y, N_x, n_threads, window_size, vmin_full, vmax_full, dx);
+  Py_END_ALLOW_THREADS
 
-  //puts("Guard 2");
-  
-  return scores_array;
+  Py_DECREF(image_array);
+  Py_DECREF(hists_bg_array);
+  return (PyObject *)scores_array;
 }
 
 static PyMethodDef DenoiseMethods[] = {
-  {"calc_hists", (PyCFunction)calc_hists, METH_VARARGS|METH_KEYWORDS, calc_hists__doc__},
-  {"denoise", (PyCFunction)denoise, METH_VARARGS|METH_KEYWORDS, denoise__doc__},
+  {"calc_hists", (PyCFunction)(void(*)(void))calc_hists, METH_VARARGS|METH_KEYWORDS, calc_hists__doc__},
+  {"calc_scores_bg", (PyCFunction)(void(*)(void))calc_scores_bg, METH_VARARGS|METH_KEYWORDS, calc_scores_bg__doc__},
+  {"denoise_scores", (PyCFunction)(void(*)(void))denoise_scores, METH_VARARGS|METH_KEYWORDS, denoise_scores__doc__},
+  {"denoise", (PyCFunction)(void(*)(void))denoise, METH_VARARGS|METH_KEYWORDS, denoise__doc__},
   {NULL, NULL, 0, NULL}
 };
 
@@ -218,7 +418,7 @@ static PyMethodDef DenoiseMethods[] = {
         NULL,                   /* m_free */
   };
 
-PyMODINIT_FUNC PyInit_initdenoise(void)
+PyMODINIT_FUNC PyInit_denoise(void)
 {
   import_array();
 
@@ -229,4 +429,3 @@ PyMODINIT_FUNC PyInit_initdenoise(void)
 
   return dmodule;
 }
-
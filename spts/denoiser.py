@@ -1,65 +1,117 @@
+import functools
 import numpy as np   
+import scipy.fft
 
 class DenoiserGauss:
 
-    def __init__(self, sigma):
+    def __init__(self, sigma, workers=1):
         self.sigma = sigma
-        self._G = None
-        self._G_sigma = None
+        self.workers = workers
 
     def denoise_image(self, image, full_output=False):
-        image_f64 = np.asarray(image, dtype=np.float64)
-        if self._G is None or self._G_sigma != self.sigma:
-            Nx = image.shape[1]
-            Ny = image.shape[0]
-            X,Y = np.meshgrid(np.arange(Nx), np.arange(Ny))
-            X = np.float64(X - Nx/2) / Nx
-            Y = np.float64(Y - Ny/2) / Ny
-            Rsq = X**2 + Y**2
-            self._G = np.exp(-Rsq/2./self.sigma**2)
-            self._G_sigma = self.sigma
-        fimage_G = np.fft.fftshift(np.fft.fft2(image)) * self._G
-        image_G = np.fft.ifft2(np.fft.ifftshift(fimage_G))
-        return image_G.real
+        image = _as_float(image)
+        fimage = _fft2(image, self.workers)
+        G = gauss_kernel(image.shape, self.sigma, image.dtype)
+        return np.real(_ifft2(fimage * G, image.shape, self.workers))
+
+    def denoise_stack(self, stack, out=None):
+        """
+        Denoise all frames of the stack (N, Y, X) in one call. The result is written to out if given.
+        """
+        stack = _as_float(stack)
+        out = _get_out(stack, out)
+        fstack = _fft2(stack, self.workers)
+        fstack *= gauss_kernel(stack.shape[-2:], self.sigma, stack.dtype)
+        out[...] = np.real(_ifft2(fstack, stack.shape[-2:], self.workers))
+        return out
 
 class DenoiserGauss2: 
 
-    def __init__(self, sigma): 
+    def __init__(self, sigma, workers=1): 
         self.sigma1 = sigma*2
         self.sigma2 = sigma
-        self._G1 = None
-        self._G2 = None
-        self._G1_sigma = None
-        self._G2_sigma = None
+        self.workers = workers
 
     def denoise_image(self, image, full_output=False):
-        image_f64 = np.asarray(image, dtype=np.float64)
-        Nx = image.shape[1]
-        Ny = image.shape[0]
-        if self._G1 is None or self._G1_sigma != self.sigma1 or self._G1.shape != image.shape:
-            X,Y = np.meshgrid(np.arange(Nx), np.arange(Ny))
-            X = np.float64(X - Nx/2) / Nx
-            Y = np.float64(Y - Ny/2) / Ny
-            Rsq = X**2 + Y**2
-            self._G1 = np.exp(-Rsq/2./(self.sigma1+np.finfo(np.float64).eps)**2)
-            self._G1_sigma = self.sigma1
-        if self._G2 is None or self._G2_sigma != self.sigma2 or self._G2.shape != image.shape:
-            X,Y = np.meshgrid(np.arange(Nx), np.arange(Ny))
-            X = np.float64(X - Nx/2) / Nx 
-            Y = np.float64(Y - Ny/2) / Ny
-            Rsq = X**2 + Y**2
-            self._G2 = np.exp(-Rsq/2./(self.sigma2+np.finfo(np.float64).eps)**2)
-            self._G2_sigma = self.sigma2
-        fimage_G1 = np.fft.fftshift(np.fft.fft2(image)) * self._G1
-        image_G1 = np.fft.ifft2(np.fft.ifftshift(fimage_G1))
-        fimage_G2 = np.fft.fftshift(np.fft.fft2(image)) * self._G2
-        image_G2 = np.fft.ifft2(np.fft.ifftshift(fimage_G2))
+        image = _as_float(image)
+        eps = np.finfo(np.float64).eps
+        # One forward transform for both filters
+        fimage = _fft2(image, self.workers)
+        G1 = gauss_kernel(image.shape, self.sigma1+eps, image.dtype)
+        G2 = gauss_kernel(image.shape, self.sigma2+eps, image.dtype)
+        image_G1 = _ifft2(fimage * G1, image.shape, self.workers)
+        image_G2 = _ifft2(fimage * G2, image.shape, self.workers)
         out = (abs(image_G1) - abs(image_G2))
         return out
 
+    def denoise_stack(self, stack, out=None):
+        """
+        Denoise all frames of the stack (N, Y, X) in one call. The result is written to out if given.
+        """
+        stack = _as_float(stack)
+        out = _get_out(stack, out)
+        shape = stack.shape[-2:]
+        eps = np.finfo(np.float64).eps
+        fstack = _fft2(stack, self.workers)
+        G1 = gauss_kernel(shape, self.sigma1+eps, stack.dtype)
+        G2 = gauss_kernel(shape, self.sigma2+eps, stack.dtype)
+        out[...] = abs(_ifft2(fstack * G1, shape, self.workers))
+        fstack *= G2
+        out -= abs(_ifft2(fstack, shape, self.workers))
+        return out
+
+def _is_symmetric(shape):
+    # The kernel is symmetric (and the filtered image real) only if both dimensions are even
+    return shape[-2] % 2 == 0 and shape[-1] % 2 == 0
+
+def _fft2(image, workers):
+    if _is_symmetric(image.shape):
+        return scipy.fft.rfft2(image, axes=(-2, -1), workers=workers)
+    else:
+        return scipy.fft.fft2(image, axes=(-2, -1), workers=workers)
+
+def _ifft2(fimage, shape, workers):
+    if _is_symmetric(shape):
+        return scipy.fft.irfft2(fimage, s=shape, axes=(-2, -1), workers=workers)
+    else:
+        return scipy.fft.ifft2(fimage, axes=(-2, -1), workers=workers)
+
+@functools.lru_cache(maxsize=8)
+def gauss_kernel(shape, sigma, dtype=np.float64):
+    """
+    Gaussian low-pass filter for the FFT of an image of the given shape, in unshifted layout and with frequencies in
+    units of the sampling frequency. The zero frequency is centred as in the shifted grid (X - Nx/2)/Nx, which for odd
+    dimensions is half a pixel off, such that the kernel is not symmetric. If both dimensions are even the kernel is
+    symmetric and only the half for the real-to-complex FFT (rfft2) is returned, otherwise the full kernel for fft2.
+    """
+    Ny, Nx = shape
+    Y = np.fft.ifftshift((np.arange(Ny) - Ny/2.) / Ny)
+    X = np.fft.ifftshift((np.arange(Nx) - Nx/2.) / Nx)
+    if _is_symmetric(shape):
+        X = X[:Nx//2+1]
+    Rsq = X[np.newaxis,:]**2 + Y[:,np.newaxis]**2
+    G = np.asarray(np.exp(-Rsq/2./sigma**2), dtype=dtype)
+    # Shared between calls
+    G.flags.writeable = False
+    return G
+
+def _as_float(image):
+    # Single precision input is processed in single precision
+    if np.asarray(image).dtype == np.float32:
+        return np.asarray(image)
+    else:
+        return np.asarray(image, dtype=np.float64)
+
+def _get_out(stack, out):
+    if out is None:
+        return np.empty(shape=stack.shape, dtype=stack.dtype)
+    if out.shape != stack.shape:
+        raise ValueError("Output buffer has shape %s but stack has shape %s." % (str(out.shape), str(stack.shape)))
+    return out
+
 class DenoiserHistogram:
 
-    def __init__(self, window_size, images_bg, vmin, vmax, dx=1, vmin_full=-50, vmax_full=255):
+    def __init__(self, window_size, images_bg, vmin, vmax, dx=1, vmin_full=-50, vmax_full=255, workers=1):
         import spts.denoise
         images_bg_i32 = np.asarray(images_bg, dtype=np.int32) 
         self.window_size = window_size
@@ -68,9 +120,24 @@ class DenoiserHistogram:
         self.dx = dx
         self.vmin_full = vmin_full
         self.vmax_full = vmax_full
-        self.hists_bg = spts.denoise.calc_hists(images_bg_i32, vmin=vmin, vmax=vmax, window_size=window_size, dx=self.dx)
+        # Number of threads (-1: all cores)
+        self.n_threads = max([0, workers])
+        self.hists_bg = spts.denoise.calc_hists(images_bg_i32, vmin=vmin, vmax=vmax, window_size=window_size, dx=self.dx, n_threads=self.n_threads)
+        # The background part of the score is the same for all images
+        self.scores_bg = spts.denoise.calc_scores_bg(self.hists_bg, vmin=vmin, vmax=vmax, vmin_full=vmin_full, vmax_full=vmax_full, dx=self.dx, n_threads=self.n_threads)
 
     def denoise_image(self, image, full_output=False):
+        import spts.denoise
         image_i32 = np.asarray(image, dtype=np.int32)
-        image_scores = denoise_hist.denoise(image_i32, self.hists_bg, vmin=self.vmin, vmax=self.vmax, window_size=self.window_size, vmin_full=self.vmin_full, vmax_full=self.vmax_full, dx=self.dx)
+        image_scores = spts.denoise.denoise_scores(image_i32, self.scores_bg, window_size=self.window_size, vmin_full=self.vmin_full, vmax_full=self.vmax_full, dx=self.dx, n_threads=self.n_threads)
         return image_scores
+
+    def denoise_stack(self, stack, out=None):
+        """
+        Denoise all frames of the stack (N, Y, X). The result is written to out if given.
+        """
+        if out is None:
+            out = np.empty(shape=np.shape(stack), dtype=np.float64)
+        for k, image in enumerate(stack):
+            out[k] = self.denoise_image(image)
+        return out
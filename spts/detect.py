@@ -1,6 +1,7 @@
 #!/usr/local/bin/python3
 import numpy as np
 import itertools
+import heapq
 import scipy.ndimage.measurements
 
 import logging
@@ -29,15 +30,14 @@ def find_particles(image_scored, image_thresholded, min_dist, n_particles_max, p
             log_info(logger, "%i labels - (frame overexposed? too many particles?), skipping analysis" % n_labels)
             return return_default
 
-        V = [image_scored[i_label == labels].max() for i_label in i_labels]
-
-        nx = image_thresholded.shape[1]
-        ny = image_thresholded.shape[0]
-        x,y = np.meshgrid(np.arange(nx), np.arange(ny))
-        x = x[image_thresholded]    
-        y = y[image_thresholded]
+        y, x = np.nonzero(image_thresholded)
         l = labels[image_thresholded]
         v = image_scored[image_thresholded]
+
+        # Value and position of the (first) maximum of every label
+        log_debug(logger, "Determine maxima")
+        i_max = find_label_maxima(v, l)
+        V = list(v[i_max])
         
         if peak_centering == "center_of_mass":
             log_debug(logger, "Determine centers of mass")
@@ -47,19 +47,12 @@ def find_particles(image_scored, image_thresholded, min_dist, n_particles_max, p
             
         elif peak_centering == "center_to_max":
             log_debug(logger, "Determine maximum positions")
-            X = []
-            Y = []
-            for i_label in i_labels:
-                i_max = (v*(l == i_label)).argmax()
-                X.append(x[i_max])
-                Y.append(y[i_max])
+            X = list(x[i_max])
+            Y = list(y[i_max])
         else:
             log_and_raise_error(logger, "%s is not a valid argument for peak_centering!" % peak_centering)    
             
-        dislocation = []
-        for i_label, xc, yc in zip(i_labels, X, Y):
-            i_max = (v*(l == i_label)).argmax()
-            dislocation.append(np.sqrt((x[i_max]-xc)**2 + (y[i_max]-yc)**2))
+        dislocation = [np.sqrt((x[i]-xc)**2 + (y[i]-yc)**2) for i, xc, yc in zip(i_max, X, Y)]
 
         merged = list(np.zeros(len(i_labels), dtype=bool))
         
@@ -85,68 +78,183 @@ def find_particles(image_scored, image_thresholded, min_dist, n_particles_max, p
         return success, i_labels, labels, areas, X, Y, V, merged, dists_closest_neighbor, dislocation
 
 
+def find_label_maxima(v, l):
+    """
+    Return for every label 1, 2, ..., l.max() the index of the first occurrence of its maximum value in v.
+    Every label must occur at least once in l.
+    """
+    # Stable sort by label and descending value, the first entry of every label is its first maximum
+    order = np.lexsort((-v, l))
+    l_sorted = l[order]
+    first = np.flatnonzero(np.concatenate([[True], l_sorted[1:] != l_sorted[:-1]]))
+    return order[first]
+
 def measure_areas(i_labels, labels):
-    areas = []
-    for label in i_labels:
-        a = (labels == label).sum()
-        assert a > 0
-        areas.append(a)
+    counts = np.bincount(labels.ravel(), minlength=max(i_labels)+1 if len(i_labels) > 0 else 0)
+    areas = list(counts[list(i_labels)])
+    assert all([a > 0 for a in areas])
     return areas
 
 def merge_close_points(i_labels, labels, X, Y, V, merged, min_dist):
+    """
+    Merge peaks that are closer than min_dist, always the closest pair first, and return the remaining peaks with
+    the distances to their closest neighbours. Neighbours are looked up in a grid index and the labels of merged
+    peaks are replaced in a single pass over the label image.
+    """
     i_labels = list(i_labels)
-    while True:
+    X = list(X)
+    Y = list(Y)
+    V = list(V)
+    merged = list(merged)
+    n_labels = len(i_labels)
+    active = [True] * n_labels
+    parent = list(range(n_labels))
+    index = _GridIndex(X, Y, min_dist)
 
-        n_labels = len(i_labels)
-        combs = np.asarray([c for c in itertools.combinations(range(n_labels),2)])
-        dists = np.asarray([np.sqrt((X[c[0]]-X[c[1]])**2+(Y[c[0]]-Y[c[1]])**2) for c in combs])
-
-        too_close = dists<min_dist
-        
-        if too_close.sum() > 0:
-            
-            dists = dists[too_close]
-            combs = combs[too_close]
-            combs = combs[dists.argsort()]
-            closest_comb = combs[0]
+    if min_dist > 0:
+        # Heap of candidate pairs (dist, k0, k1, version k0, version k1) with k0 < k1, a pair is outdated if one of
+        # its points was moved or removed after it had been pushed
+        version = [0] * n_labels
+        heap = []
+        for k0 in range(n_labels):
+            for k1 in index.query(X[k0], Y[k0], min_dist):
+                if k1 > k0:
+                    d = _dist(X, Y, k0, k1)
+                    if d < min_dist:
+                        heap.append((d, k0, k1, 0, 0))
+        heapq.heapify(heap)
 
+        while len(heap) > 0:
+            d, k0, k1, v0, v1 = heapq.heappop(heap)
+            if not (active[k0] and active[k1] and version[k0] == v0 and version[k1] == v1):
+                continue
             # Merge positions by averaging
-            X[closest_comb[0]] = (X[closest_comb[0]] + X[closest_comb[1]]) / 2
-            Y[closest_comb[0]] = (Y[closest_comb[0]] + Y[closest_comb[1]]) / 2.
-            V[closest_comb[0]] = max([V[closest_comb[0]], Y[closest_comb[1]]])
-            X.pop(closest_comb[1])
-            Y.pop(closest_comb[1])
-            V.pop(closest_comb[1])
-            # Replace label
-            labels[labels==i_labels[closest_comb[1]]] = i_labels[closest_comb[0]]
-            i_labels.pop(closest_comb[1])
-            # Update merged flag list
-            merged[closest_comb[0]] = True
-            merged.pop(closest_comb[1])
-
-            N = len(i_labels)
-            assert len(X) == N
-            assert len(Y) == N
-            assert len(merged) == N
-            assert len(V) == N
+            X[k0] = (X[k0] + X[k1]) / 2
+            Y[k0] = (Y[k0] + Y[k1]) / 2.
+            V[k0] = max([V[k0], Y[k1]])
+            merged[k0] = True
+            active[k1] = False
+            parent[k1] = k0
+            version[k0] += 1
+            index.remove(k1)
+            index.move(k0, X[k0], Y[k0])
+            for k in index.query(X[k0], Y[k0], min_dist):
+                if k != k0:
+                    d = _dist(X, Y, k0, k)
+                    if d < min_dist:
+                        heapq.heappush(heap, (d, min([k0, k]), max([k0, k]), version[min([k0, k])], version[max([k0, k])]))
 
-        else:
+    remaining = [k for k in range(n_labels) if active[k]]
+    if len(remaining) < n_labels:
+        # Replace labels of merged peaks by the label of the peak they were merged into
+        lut = np.arange(labels.max()+1, dtype=labels.dtype)
+        for k in range(n_labels):
+            k_root = k
+            while parent[k_root] != k_root:
+                k_root = parent[k_root]
+            lut[i_labels[k]] = i_labels[k_root]
+        labels = lut[labels]
+
+    dists_closest_neighbor = np.zeros(len(remaining))
+    if len(remaining) == 1:
+        dists_closest_neighbor[0] = -1
+    else:
+        for i0, k0 in enumerate(remaining):
+            dists_closest_neighbor[i0] = index.nearest(k0, lambda k1: _dist(X, Y, k0, k1))
+
+    i_labels = [i_labels[k] for k in remaining]
+    X = [X[k] for k in remaining]
+    Y = [Y[k] for k in remaining]
+    V = [V[k] for k in remaining]
+    merged = [merged[k] for k in remaining]
+    return i_labels, labels, X, Y, V, merged, dists_closest_neighbor
+
+def _dist(X, Y, k0, k1):
+    return np.sqrt((X[k0]-X[k1])**2+(Y[k0]-Y[k1])**2)
+
+
+class _GridIndex:
+    """
+    Points sorted into square grid cells for neighbour queries. Points can be moved and removed.
+    """
+    def __init__(self, X, Y, cell_size):
+        if cell_size <= 0:
+            # Aim for about one point per cell
+            extent = max([max(X) - min(X), max(Y) - min(Y), 1.]) if len(X) > 0 else 1.
+            cell_size = extent / max([np.sqrt(len(X)), 1.])
+        self._cell_size = float(cell_size)
+        self._cells = {}
+        self._cell_of = {}
+        for k, (x, y) in enumerate(zip(X, Y)):
+            self._insert(k, x, y)
+
+    def _get_cell(self, x, y):
+        return (int(np.floor(x / self._cell_size)), int(np.floor(y / self._cell_size)))
+
+    def _insert(self, k, x, y):
+        c = self._get_cell(x, y)
+        self._cells.setdefault(c, set()).add(k)
+        self._cell_of[k] = c
+
+    def remove(self, k):
+        c = self._cell_of.pop(k)
+        self._cells[c].discard(k)
+        if len(self._cells[c]) == 0:
+            del self._cells[c]
+
+    def move(self, k, x, y):
+        self.remove(k)
+        self._insert(k, x, y)
+
+    def query(self, x, y, r):
+        """
+        Return all points in cells that may contain points within distance r of (x, y).
+        """
+        cx, cy = self._get_cell(x, y)
+        n = int(np.ceil(r / self._cell_size))
+        ks = []
+        for ix in range(cx-n, cx+n+1):
+            for iy in range(cy-n, cy+n+1):
+                ks.extend(self._cells.get((ix, iy), ()))
+        return ks
+
+    def _ring(self, c, n):
+        cx, cy = c
+        if n == 0:
+            return self._cells.get(c, ())
+        ks = []
+        for ix in range(cx-n, cx+n+1):
+            ks.extend(self._cells.get((ix, cy-n), ()))
+            ks.extend(self._cells.get((ix, cy+n), ()))
+        for iy in range(cy-n+1, cy+n):
+            ks.extend(self._cells.get((cx-n, iy), ()))
+            ks.extend(self._cells.get((cx+n, iy), ()))
+        return ks
 
-            dists_closest_neighbor = np.zeros(n_labels)
-            if n_labels == 1:
-                dists_closest_neighbor[0] = -1
-            else:
-                for i0 in range(n_labels):
-                    dists_closest_neighbor[i0] = np.asarray([np.sqrt((X[i0]-X[i1])**2+(Y[i0]-Y[i1])**2) for i1 in range(n_labels) if i1 != i0]).min()
-                    
-            return i_labels, labels, X, Y, V, merged, dists_closest_neighbor
+    def nearest(self, k0, dist):
+        """
+        Return the smallest distance dist(k) of point k0 to any other point in the index.
+        """
+        c = self._cell_of[k0]
+        n_cells_max = max([max([abs(ci - cj) for ci, cj in zip(c, other)]) for other in self._cells.keys()])
+        d_min = None
+        for n in range(n_cells_max+1):
+            for k in self._ring(c, n):
+                if k != k0:
+                    d = dist(k)
+                    if d_min is None or d < d_min:
+                        d_min = d
+            # Points in rings further out are at least n cell sizes away
+            if d_min is not None and d_min <= n * self._cell_size:
+                break
+        return d_min
 
             
 def clean_up_labels(i_labels, labels):
-    labels_new = np.zeros_like(labels)
     i_labels_new = range(1, len(i_labels)+1)
-    for i_label_new,i_label_old in zip(i_labels_new, i_labels):
-        labels_new[labels == i_label_old] = i_label_new
+    lut = np.zeros(labels.max()+1, dtype=labels.dtype)
+    lut[list(i_labels)] = i_labels_new
+    labels_new = lut[labels]
     return i_labels_new, labels_new
     
         
@@ -0,0 +1,125 @@
+import concurrent.futures
+import numpy as np
+import h5py
+
+import logging
+logger = logging.getLogger(__name__)
+
+import spts.log
+from spts.log import log_and_raise_error,log_warning,log_info,log_debug
+
+from spts.calibration import RunningStats
+
+# Approximate size of the blocks of frames read at once (rounded to whole chunks of the dataset)
+BLOCK_NBYTES = 64<<20
+
+def get_blocks(ds, start=0, stop=None, block_nbytes=BLOCK_NBYTES):
+    """
+    Split the frame range [start, stop) of the dataset ds (frames along the first axis) into blocks (i0, i1) whose
+    boundaries are aligned with the chunks of the dataset, such that every chunk is read only once.
+    """
+    N = ds.shape[0]
+    stop = N if stop is None else min([stop, N])
+    start = max([start, 0])
+    chunk_frames = ds.chunks[0] if ds.chunks is not None else 1
+    frame_nbytes = max([1, int(np.prod(ds.shape[1:])) * ds.dtype.itemsize])
+    block_frames = max([1, block_nbytes // (frame_nbytes * chunk_frames)]) * chunk_frames
+    blocks = []
+    i0 = start
+    while i0 < stop:
+        i1 = min([(i0 // block_frames + 1) * block_frames, stop])
+        blocks.append((i0, i1))
+        i0 = i1
+    return blocks
+
+def _integrate_block(filename, dataset, i0, i1, samples):
+    """
+    Statistics of the frames [i0, i1) of a dataset: RunningStats, sum, min and max, and a copy of the frames with the
+    (absolute) indices in samples.
+    """
+    with h5py.File(filename, "r") as f:
+        frames = f[dataset][i0:i1]
+    S = RunningStats()
+    S.add(frames)
+    if frames.dtype.kind in "ui":
+        s = frames.sum(axis=0, dtype=np.int64)
+    else:
+        s = frames.sum(axis=0, dtype=np.float64)
+    return {"stats": S, "sum": s, "min": frames.min(axis=0), "max": frames.max(axis=0),
+            "samples": frames[np.asarray(samples, dtype=int) - i0]}
+
+def integrate_stack(filename, dataset, start=0, stop=None, mask=None, percentiles=None, percentile_frames=256,
+                    n_workers=1, threads=False, block_nbytes=BLOCK_NBYTES):
+    """
+    Per-pixel sum, mean, std, min and max of the frames [start, stop) of a dataset (frames along the first axis) in a
+    single pass. The dataset is read in chunk-aligned blocks, with n_workers > 1 the blocks are processed in a pool of
+    processes (or threads if threads=True). Only a few blocks are held in memory at a time.
+
+    mask:               Boolean array of the frame shape, pixels that are False are set to 0 in all outputs
+    percentiles:        List of percentiles (0-100) to compute per pixel. They are computed from an evenly spaced
+                        selection of at most percentile_frames frames (exact if the range has fewer frames).
+    """
+    with h5py.File(filename, "r") as f:
+        ds = f[dataset]
+        if ds.ndim < 2:
+            log_and_raise_error(logger, "Dataset %s in %s has %i dimension(s), expected a stack of frames." % (dataset, filename, ds.ndim))
+        blocks = get_blocks(ds, start, stop, block_nbytes)
+        shape = ds.shape[1:]
+        dtype = ds.dtype
+    if len(blocks) == 0:
+        log_and_raise_error(logger, "No frames in the range %s:%s of %s (%s)." % (start, stop, dataset, filename))
+    if mask is not None and mask.shape != shape:
+        log_and_raise_error(logger, "Mask has shape %s, frames have shape %s." % (str(mask.shape), str(shape)))
+    start, stop = blocks[0][0], blocks[-1][1]
+    N = stop - start
+    # Frames kept for the percentiles
+    if percentiles:
+        step = int(np.ceil(N / float(max([1, percentile_frames]))))
+        sample_indices = np.arange(start, stop, step)
+        samples = np.zeros((len(sample_indices),) + shape, dtype=dtype)
+    else:
+        sample_indices = np.zeros(0, dtype=int)
+        samples = None
+    S = RunningStats()
+    out = {}
+    i_sample = 0
+    def merge(r):
+        nonlocal i_sample
+        S.merge(r["stats"])
+        if "sum" in out:
+            out["sum"] += r["sum"]
+            np.minimum(out["min"], r["min"], out=out["min"])
+            np.maximum(out["max"], r["max"], out=out["max"])
+        else:
+            out["sum"], out["min"], out["max"] = r["sum"], r["min"], r["max"]
+        if samples is not None:
+            samples[i_sample:i_sample+len(r["samples"])] = r["samples"]
+            i_sample += len(r["samples"])
+        log_info(logger, "Integrated %i/%i frames" % (S.n, N))
+    tasks = [(filename, dataset, i0, i1, sample_indices[(sample_indices >= i0) & (sample_indices < i1)]) for i0, i1 in blocks]
+    if n_workers <= 1:
+        for t in tasks:
+            merge(_integrate_block(*t))
+    else:
+        Executor = concurrent.futures.ThreadPoolExecutor if threads else concurrent.futures.ProcessPoolExecutor
+        with Executor(max_workers=n_workers) as executor:
+            # Submit only a few blocks ahead to bound the memory use, results are merged in order
+            pending = []
+            for t in tasks:
+                pending.append(executor.submit(_integrate_block, *t))
+                if len(pending) > 2*n_workers:
+                    merge(pending.pop(0).result())
+            for p in pending:
+                merge(p.result())
+    out["mean"] = S.mean
+    out["std"] = S.get_std()
+    if percentiles:
+        for p in percentiles:
+            out["percentile_%g" % p] = np.percentile(samples, p, axis=0)
+    if mask is not None:
+        for v in out.values():
+            v[~mask] = 0
+    out["n_frames"] = N
+    out["start"] = start
+    out["stop"] = stop
+    return out
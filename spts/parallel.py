@@ -0,0 +1,336 @@
+import time, traceback, queue
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+import spts.log
+from spts.log import log_and_raise_error,log_warning,log_info,log_debug
+
+import spts.worker
+import spts.profiling
+
+# Size of the shared memory ring buffer of every worker process
+RING_NBYTES = 128<<20
+
+# Arrays smaller than this are sent along with the descriptors instead of through the ring buffer
+INLINE_NBYTES = 4096
+
+# Offsets in the ring buffer are multiples of this
+ALIGN_NBYTES = 64
+
+# Largest block of frames handed out by MPIBlockScheduler, in units of the read block length
+MAX_SCHEDULED_BLOCKS = 16
+
+class _SharedArray:
+    """
+    Descriptor of an array in the ring buffer of a worker process.
+    """
+    __slots__ = ["offset", "shape", "dtype"]
+
+    def __init__(self, offset, shape, dtype):
+        self.offset = offset
+        self.shape = shape
+        self.dtype = dtype
+
+    def __getstate__(self):
+        return (self.offset, self.shape, self.dtype)
+
+    def __setstate__(self, state):
+        self.offset, self.shape, self.dtype = state
+
+
+def _is_shareable(a):
+    return isinstance(a, np.ndarray) and not a.dtype.hasobject and a.nbytes >= INLINE_NBYTES
+
+def _iter_shareable(D):
+    for v in D.values():
+        if isinstance(v, dict):
+            yield from _iter_shareable(v)
+        elif _is_shareable(v):
+            yield v
+
+def _align(nbytes):
+    return -(-nbytes // ALIGN_NBYTES) * ALIGN_NBYTES
+
+
+class _RingWriter:
+    """
+    Worker side of a ring buffer. Space is allocated at the head and waits for the reader to release (move the tail)
+    if the ring is full. head and tail count bytes since the start and never decrease.
+    """
+    def __init__(self, shm, tail, cond):
+        self.shm = shm
+        self.capacity = shm.size
+        self.tail = tail
+        self.cond = cond
+        self.head = 0
+        self.time_blocked = 0.
+
+    def _alloc(self, nbytes):
+        n = _align(nbytes)
+        pos = self.head % self.capacity
+        if pos + n > self.capacity:
+            # Skip the end of the ring, arrays are never split
+            self.head += self.capacity - pos
+            pos = 0
+        end = self.head + n
+        if end - self.tail.value > self.capacity:
+            t0 = time.perf_counter()
+            with self.cond:
+                self.cond.wait_for(lambda: end - self.tail.value <= self.capacity)
+            self.time_blocked += time.perf_counter() - t0
+        self.head = end
+        return pos
+
+    def encode(self, D):
+        """
+        Copy the large arrays of the (nested) dictionary D into the ring and return a copy of D in which they are
+        replaced by descriptors.
+        """
+        E = {}
+        for k, v in D.items():
+            if isinstance(v, dict):
+                E[k] = self.encode(v)
+            elif _is_shareable(v):
+                offset = self._alloc(v.nbytes)
+                np.ndarray(v.shape, dtype=v.dtype, buffer=self.shm.buf, offset=offset)[...] = v
+                E[k] = _SharedArray(offset, v.shape, v.dtype.str)
+            else:
+                E[k] = v
+        return E
+
+    def fits(self, packages):
+        # Upper bound of the space that the packages take in the ring (including skipped ends)
+        n = sum([_align(a.nbytes) for p in packages for a in _iter_shareable(p)])
+        return 2*n <= self.capacity
+
+
+def _decode(D, buf):
+    E = {}
+    for k, v in D.items():
+        if isinstance(v, dict):
+            E[k] = _decode(v, buf)
+        elif isinstance(v, _SharedArray):
+            E[k] = np.ndarray(v.shape, dtype=np.dtype(v.dtype), buffer=buf, offset=v.offset)
+        else:
+            E[k] = v
+    return E
+
+
+def _work_loop(rank, n_processes, conf, batch_size, profile, trace_memory, worker_kwargs, shm_name, tail, cond, q):
+    """
+    Main function of a worker process. The process has its own Worker (and hence its own open input files) and
+    processes every n_processes-th work package, starting with package rank.
+    """
+    shm = None
+    try:
+        shm = shared_memory.SharedMemory(name=shm_name)
+        ring = _RingWriter(shm, tail, cond)
+        P = spts.profiling.StageProfiler(trace_memory=trace_memory) if profile else None
+        W = spts.worker.Worker(conf, i0_offset=rank, step_size=n_processes, batch_size=batch_size, profiler=P, **worker_kwargs)
+        pickled = 0
+        while True:
+            w = W.get_work()
+            if w is None:
+                break
+            if batch_size > 1:
+                ls = W.work_batch(w)
+            else:
+                ls = [W.work(w)]
+            ls = [l for l in ls if l is not None]
+            if ring.fits(ls):
+                q.put(("slices", [ring.encode(l) for l in ls], ring.head))
+            else:
+                # Larger than the ring, send everything with the message
+                pickled += len(ls)
+                q.put(("slices", ls, ring.head))
+        io_stats = W.get_io_stats()
+        io_stats["time_blocked_ring"] = ring.time_blocked
+        io_stats["frames_pickled"] = pickled
+        W.close()
+        q.put(("done", {"io_stats": io_stats, "profile": P.get_summary() if P is not None else None}, ring.head))
+    except Exception:
+        q.put(("error", traceback.format_exc(), None))
+    finally:
+        if shm is not None:
+            shm.close()
+
+
+class _Process:
+    """
+    Parent side of a worker process and its ring buffer.
+    """
+    def __init__(self, ctx, rank, n_processes, conf, batch_size, profile, trace_memory, worker_kwargs, ring_nbytes):
+        self.rank = rank
+        self.shm = shared_memory.SharedMemory(create=True, size=ring_nbytes)
+        self.tail = ctx.Value("q", 0, lock=False)
+        self.cond = ctx.Condition()
+        self.queue = ctx.Queue()
+        self.process = ctx.Process(target=_work_loop, name="spts-worker-%i" % rank,
+                                   args=(rank, n_processes, conf, batch_size, profile, trace_memory, worker_kwargs,
+                                         self.shm.name, self.tail, self.cond, self.queue))
+        self.process.start()
+
+    def get(self):
+        while True:
+            try:
+                return self.queue.get(timeout=1.)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    log_and_raise_error(logger, "Worker process %i terminated unexpectedly (exit code %s)" % (self.rank, str(self.process.exitcode)))
+
+    def release(self, head):
+        with self.cond:
+            self.tail.value = head
+            self.cond.notify()
+
+    def close(self):
+        self.process.join(timeout=1.)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+        self.queue.close()
+        try:
+            self.shm.close()
+        except BufferError:
+            # Arrays in the buffer are still referenced (e.g. by a traceback), the memory is freed with them
+            pass
+        self.shm.unlink()
+
+
+def run_parallel(conf, n_processes, write_slice, batch_size=1, profile=False, trace_memory=False, worker_kwargs=None, ring_nbytes=RING_NBYTES):
+    """
+    Analyse the frames selected by the configuration conf in n_processes worker processes and pass the output of every
+    frame to write_slice (e.g. H5Writer.write_slice) in this process, in the order of the frames.
+
+    Large arrays of the output are copied by the workers into a shared memory ring buffer of ring_nbytes bytes per
+    worker, only small descriptors are sent through the queues. write_slice has to copy the data, the memory is
+    reused after write_slice returns.
+
+    Returns a list with one dictionary per worker process with the I/O statistics ("io_stats") and, if profile is True,
+    the summary of its StageProfiler ("profile").
+    """
+    worker_kwargs = {} if worker_kwargs is None else worker_kwargs
+    ctx = multiprocessing.get_context()
+    processes = []
+    results = [None] * n_processes
+    try:
+        for rank in range(n_processes):
+            processes.append(_Process(ctx, rank, n_processes, conf, batch_size, profile, trace_memory, worker_kwargs, ring_nbytes))
+        # Workers take turns in processing work packages, reading round robin restores the order of the frames
+        active = list(processes)
+        while len(active) > 0:
+            for p in list(active):
+                kind, msg, head = p.get()
+                if kind == "error":
+                    log_and_raise_error(logger, "Error in worker process %i:\n%s" % (p.rank, msg))
+                elif kind == "done":
+                    results[p.rank] = msg
+                    active.remove(p)
+                else:
+                    for l in msg:
+                        D = _decode(l, p.shm.buf)
+                        write_slice(D)
+                        del D
+                    del msg
+                    p.release(head)
+    finally:
+        for p in processes:
+            p.close()
+    for r in results:
+        if r["io_stats"]["frames_pickled"] > 0:
+            log_warning(logger, "%i frames did not fit into the shared memory ring buffer (%.1f MB) and were pickled" % (r["io_stats"]["frames_pickled"], ring_nbytes/1.E6))
+    return results
+
+def sum_io_stats(results):
+    """
+    Return the I/O statistics of run_parallel summed over all worker processes.
+    """
+    stats = {}
+    for r in results:
+        for k, v in r["io_stats"].items():
+            stats[k] = stats.get(k, 0) + v
+    return stats
+
+
+def get_guided_block(i, stop, block_length, n_workers, max_blocks=MAX_SCHEDULED_BLOCKS):
+    """
+    Return the end of the block of frames starting at frame i that is handed out next. The block has a size of the
+    remaining frames divided by twice the number of workers (guided schedule), in units of block_length, and ends at a
+    multiple of block_length (or at stop). Blocks get smaller towards the end such that slow workers do not hold up
+    the others.
+    """
+    remaining = -(-(stop - i) // block_length)
+    n_blocks = min([max([1, -(-remaining // (2*n_workers))]), max_blocks])
+    return min([(i // block_length + n_blocks) * block_length, stop])
+
+
+class MPIBlockScheduler:
+    """
+    Hands out contiguous blocks of frames to the worker processes (rank > 0) on demand. The index of the next frame is
+    a counter in an MPI window on rank 0 that the workers update with atomic operations (compare and swap), rank 0 does
+    not take part apart from exposing the window. Must be created (and freed) by all processes of the communicator.
+    """
+    def __init__(self, comm, max_blocks=MAX_SCHEDULED_BLOCKS):
+        from mpi4py import MPI
+        self._MPI = MPI
+        self.comm = comm
+        self.max_blocks = max_blocks
+        self.n_workers = max([1, comm.size - 1])
+        # Number of frames handed out (counted from the first frame of the range)
+        self._counter = np.zeros(1, dtype=np.int64)
+        self.win = MPI.Win.Create(self._counter if comm.rank == 0 else None, disp_unit=self._counter.itemsize, comm=comm)
+        self.blocks = []
+        self.time_claim = 0.
+        self._t_start = time.time()
+
+    def _compare_and_swap(self, value, compare):
+        MPI = self._MPI
+        result = np.zeros(1, dtype=np.int64)
+        self.win.Lock(0, MPI.LOCK_SHARED)
+        self.win.Compare_and_swap(np.array([value], dtype=np.int64), np.array([compare], dtype=np.int64), result, 0, 0)
+        self.win.Unlock(0)
+        return int(result[0])
+
+    def next_block(self, start, stop, block_length):
+        """
+        Claim the next block of frames of the range [start, stop) and return (i0, i1), or None if all frames have been
+        handed out. Blocks are aligned with multiples of block_length (e.g. the length of the blocks read by
+        spts.reader.H5FrameReader) such that every block of the file is read by a single worker.
+        """
+        t0 = time.perf_counter()
+        offset = self._compare_and_swap(0, 0)
+        while True:
+            i0 = start + offset
+            if i0 >= stop:
+                block = None
+                break
+            i1 = get_guided_block(i0, stop, block_length, self.n_workers, self.max_blocks)
+            found = self._compare_and_swap(i1 - start, offset)
+            if found == offset:
+                block = (i0, i1)
+                break
+            # Another worker was faster
+            offset = found
+        self.time_claim += time.perf_counter() - t0
+        if block is not None:
+            self.blocks.append(block)
+            log_debug(logger, "Claimed frames %i-%i" % (block[0], block[1]-1))
+        return block
+
+    def get_stats(self):
+        """
+        Return the blocks handed out to this process and the throughput since the scheduler was created.
+        """
+        n_frames = sum([i1 - i0 for i0, i1 in self.blocks])
+        time_elapsed = time.time() - self._t_start
+        return {"n_blocks": len(self.blocks), "n_frames": n_frames,
+                "blocks": np.array(self.blocks, dtype=np.int64).reshape(-1, 2),
+                "time_elapsed": time_elapsed, "time_claim": self.time_claim,
+                "frames_per_second": n_frames / time_elapsed if time_elapsed > 0 else 0.}
+
+    def free(self):
+        self.win.Free()
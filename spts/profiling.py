@@ -0,0 +1,109 @@
+import time, json
+import contextlib
+import tracemalloc
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+import spts.log
+from spts.log import log_and_raise_error,log_warning,log_info,log_debug
+
+# Bin edges (in seconds) of the histograms of the processing time per frame, 10 bins per decade from 10 us to 100 s
+HIST_BIN_EDGES = 10.**np.arange(-5., 2.01, 0.1)
+
+class StageProfiler:
+    """
+    Collects wall time, CPU time and (optionally) the peak of memory allocated by Python and numpy for every processing
+    stage. CPU time is measured for the whole process and hence includes the time spent on other threads. Memory tracing
+    uses tracemalloc and slows down processing noticeably.
+    """
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self._stages = {}
+        self._t_start = time.time()
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def measure(self, name, n_frames=1):
+        """
+        Context manager measuring the code within for stage name, which processes n_frames frames.
+        """
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            m0 = tracemalloc.get_traced_memory()[0]
+        t0 = time.perf_counter()
+        c0 = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - t0
+            cpu = time.process_time() - c0
+            peak = tracemalloc.get_traced_memory()[1] - m0 if self.trace_memory else 0
+            self.add(name, wall, cpu, peak, n_frames)
+
+    def add(self, name, wall, cpu, peak=0, n_frames=1):
+        S = self._stages.get(name)
+        if S is None:
+            S = {"n_calls": 0, "n_frames": 0, "wall_time": 0., "cpu_time": 0., "peak_bytes": 0,
+                 "wall_time_min": np.inf, "wall_time_max": 0.,
+                 "hist_wall_time": np.zeros(len(HIST_BIN_EDGES)-1, dtype=np.int64)}
+            self._stages[name] = S
+        S["n_calls"] += 1
+        S["n_frames"] += n_frames
+        S["wall_time"] += wall
+        S["cpu_time"] += cpu
+        S["peak_bytes"] = max([S["peak_bytes"], peak])
+        # Calls that process several frames count as n_frames frames of equal duration
+        t_frame = wall / max([n_frames, 1])
+        S["wall_time_min"] = min([S["wall_time_min"], t_frame])
+        S["wall_time_max"] = max([S["wall_time_max"], t_frame])
+        j = np.clip(np.searchsorted(HIST_BIN_EDGES, t_frame, side="right") - 1, 0, len(HIST_BIN_EDGES)-2)
+        S["hist_wall_time"][j] += n_frames
+
+    def get_summary(self):
+        """
+        Return a dictionary with one entry per stage (in the order of first appearance) and the histogram bin edges.
+        """
+        D = {}
+        for name, S in self._stages.items():
+            D[name] = dict(S)
+            D[name]["hist_wall_time"] = S["hist_wall_time"].copy()
+            D[name]["frames_per_second"] = S["n_frames"] / S["wall_time"] if S["wall_time"] > 0 else 0.
+            D[name]["wall_time_mean"] = S["wall_time"] / S["n_frames"] if S["n_frames"] > 0 else 0.
+        D["hist_bin_edges"] = HIST_BIN_EDGES.copy()
+        D["time_elapsed"] = time.time() - self._t_start
+        return D
+
+    def log_summary(self):
+        log_summary(self.get_summary())
+
+    def write_json(self, filename):
+        write_json(self.get_summary(), filename)
+
+def log_summary(summary):
+    """
+    Log one line per stage of a summary returned by StageProfiler.get_summary.
+    """
+    for name, S in summary.items():
+        if isinstance(S, dict):
+            log_info(logger, "%s: %i frames / wall %.2f sec (%.2f ms per frame, %.1f Hz) / cpu %.2f sec / peak %.1f MB" % (name, S["n_frames"], S["wall_time"], S["wall_time_mean"]*1000., S["frames_per_second"], S["cpu_time"], S["peak_bytes"]/1.E6))
+
+def write_json(summary, filename):
+    """
+    Write a summary returned by StageProfiler.get_summary to a JSON file.
+    """
+    with open(filename, "w") as f:
+        json.dump(_to_json(summary), f, indent=2)
+
+def _to_json(D):
+    if isinstance(D, dict):
+        return {k: _to_json(v) for k, v in D.items()}
+    if isinstance(D, np.ndarray):
+        return D.tolist()
+    if isinstance(D, (float, np.floating)):
+        return float(D) if np.isfinite(D) else None
+    if isinstance(D, np.integer):
+        return int(D)
+    return D
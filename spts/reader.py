@@ -0,0 +1,177 @@
+import os, time
+import concurrent.futures
+import numpy as np
+import h5py
+
+import logging
+logger = logging.getLogger(__name__)
+
+import spts.log
+from spts.log import log_and_raise_error,log_warning,log_info,log_debug
+
+# Upper limit for the size of a block of frames that is read (and prefetched) at once
+BLOCK_NBYTES_MAX = 64*(1<<20)
+
+# Minimum time between two reopenings of the file by refresh
+REFRESH_SECONDS = 1.
+
+class H5FrameReader:
+    """
+    Reader for a stack of frames in an HDF5 dataset. The file is kept open for the lifetime of the reader and frames
+    are read in blocks that are aligned to the chunks of the dataset. With read_ahead the next block is prefetched on a
+    background thread while the current one is processed. Without read_ahead (random access, e.g. in the GUI) only the
+    requested frames are read.
+    """
+    def __init__(self, filename, dataset_name, roi=None, read_ahead=True):
+        self.filename = filename
+        self.dataset_name = dataset_name
+        self.roi = roi if roi is not None else (slice(None), slice(None))
+        self.read_ahead = read_ahead
+        self.bytes_read = 0
+        self.time_read = 0.
+        self.time_blocked = 0.
+        self._f = None
+        self._ds = None
+        self._pid = None
+        self._executor = None
+        self._block = None
+        self._prefetch = None
+        self._read_ahead_limit = None
+        self._t_open = None
+        self._open()
+
+    def _open(self):
+        # Handles and threads do not survive a fork, child processes open their own
+        if self._f is not None and self._pid == os.getpid():
+            return
+        self._f = h5py.File(self.filename, "r")
+        if self.dataset_name not in self._f:
+            raise IOError("Cannot find dataset %s in %s." % (self.dataset_name, self.filename))
+        self._ds = self._f[self.dataset_name]
+        self._pid = os.getpid()
+        self._t_open = time.time()
+        self._executor = None
+        self._block = None
+        self._prefetch = None
+        frame_shape = [len(range(*s.indices(n))) for s, n in zip(self.roi, self._ds.shape[1:])]
+        frame_nbytes = max([1, int(np.prod(frame_shape)) * self._ds.dtype.itemsize])
+        chunk_length = self._ds.chunks[0] if self._ds.chunks is not None else 1
+        n_max = max([1, BLOCK_NBYTES_MAX // frame_nbytes])
+        # Multiple of the chunk length unless a single chunk exceeds the size limit
+        self._block_length = max([chunk_length * (n_max // chunk_length), min([chunk_length, n_max])])
+        log_debug(logger, "Opened %s:%s (block length %i frames)" % (self.filename, self.dataset_name, self._block_length))
+
+    @property
+    def shape(self):
+        self._open()
+        return self._ds.shape
+
+    @property
+    def block_length(self):
+        """
+        Number of frames per block, blocks start at multiples of the block length.
+        """
+        self._open()
+        return self._block_length
+
+    def refresh(self, min_age=REFRESH_SECONDS):
+        """
+        Reopen the file (if it was opened at least min_age seconds ago) such that frames that were added to the dataset
+        since it was opened become visible.
+        """
+        if self._f is not None and self._pid == os.getpid() and time.time() - self._t_open < min_age:
+            return
+        self.close()
+        self._open()
+
+    def set_read_ahead_limit(self, stop, i_next=None):
+        """
+        Do not prefetch frames at or beyond stop and prefetch the block of frame i_next instead (None: no prefetch).
+        """
+        self._read_ahead_limit = (stop, i_next)
+
+    def read(self, i, N=1, dtype=None):
+        """
+        Return frame i (N=1) or the stack of frames i, ..., i+N-1 as a new array.
+        """
+        self._open()
+        i_stop = min([i + N, self._ds.shape[0]])
+        if not self.read_ahead:
+            # Random access, the rest of a block would mostly be read for nothing
+            if i_stop <= i:
+                return None
+            t0 = time.time()
+            out = self._read_frames(i, i_stop)
+            self.time_blocked += time.time() - t0
+            if N == 1:
+                out = out[0]
+            return out if dtype is None else np.asarray(out, dtype=dtype)
+        out = None
+        j = i
+        while j < i_stop:
+            j0, block = self._get_block(j)
+            j1 = min([j0 + block.shape[0], i_stop])
+            if N == 1:
+                out = np.array(block[j-j0], dtype=dtype)
+            else:
+                if out is None:
+                    out = np.empty(shape=(i_stop-i,)+block.shape[1:], dtype=dtype if dtype is not None else block.dtype)
+                out[j-i:j1-i] = block[j-j0:j1-j0]
+            j = j1
+        # Start reading the block that follows the current one
+        i_next = self._get_block_start(j-1) + self._block_length
+        if self._read_ahead_limit is not None and i_next >= self._read_ahead_limit[0]:
+            i_next = self._read_ahead_limit[1]
+            i_next = None if i_next is None else self._get_block_start(i_next)
+        if self.read_ahead and i_next is not None and i_next < self._ds.shape[0]:
+            self._start_prefetch(i_next)
+        return out
+
+    def _get_block_start(self, i):
+        return (i // self._block_length) * self._block_length
+
+    def _get_block(self, i):
+        i0 = self._get_block_start(i)
+        if self._block is not None and self._block[0] == i0:
+            return self._block
+        if self._prefetch is not None and self._prefetch[0] == i0:
+            t0 = time.time()
+            self._block = self._prefetch[1].result()
+            self.time_blocked += time.time() - t0
+            self._prefetch = None
+        else:
+            t0 = time.time()
+            self._block = self._read_block(i0)
+            self.time_blocked += time.time() - t0
+        return self._block
+
+    def _start_prefetch(self, i0):
+        if (self._block is not None and self._block[0] == i0) or (self._prefetch is not None and self._prefetch[0] == i0):
+            return
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._prefetch = (i0, self._executor.submit(self._read_block, i0))
+
+    def _read_block(self, i0):
+        return i0, self._read_frames(i0, min([i0 + self._block_length, self._ds.shape[0]]))
+
+    def _read_frames(self, i0, i1):
+        t0 = time.time()
+        data = self._ds[i0:i1, self.roi[0], self.roi[1]]
+        self.bytes_read += data.nbytes
+        self.time_read += time.time() - t0
+        return data
+
+    def get_stats(self):
+        return {"bytes_read": self.bytes_read, "time_read": self.time_read, "time_blocked": self.time_blocked}
+
+    def close(self):
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown(wait=True)
+        self._executor = None
+        self._prefetch = None
+        self._block = None
+        if self._f is not None and self._pid == os.getpid():
+            self._f.close()
+        self._f = None
+        self._ds = None
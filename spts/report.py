@@ -0,0 +1,204 @@
+import os, sys, copy
+import subprocess
+import concurrent.futures
+import numpy as np
+import scipy.ndimage
+import h5py
+
+import logging
+logger = logging.getLogger(__name__)
+
+import spts.log
+from spts.log import log_and_raise_error,log_warning,log_info,log_debug
+
+# Reports are rendered from the summary datasets in the CXI and calibration files, matplotlib is only imported here
+_plt = None
+
+def _get_pyplot():
+    global _plt
+    if _plt is None:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot
+        _plt = matplotlib.pyplot
+    return _plt
+
+def _get_log_cmap(plt):
+    # Use special colormap to avoid seeing value below 1
+    cmap = copy.copy(plt.get_cmap())
+    cmap.set_bad(cmap.colors[0])
+    return cmap
+
+def _save(fig, report_fname):
+    plt = _get_pyplot()
+    try:
+        fig.savefig(report_fname)
+        log_info(logger, "Report saved to %s" % report_fname)
+    finally:
+        plt.close(fig)
+    return report_fname
+
+
+def render_background_report(D, report_fname):
+    """
+    Render the report of a background (dictionary with bg, bg_std, good_pixels and frame_mean).
+    """
+    plt = _get_pyplot()
+    bg, bg_std, good_pixels = D["bg"], D["bg_std"], D["good_pixels"]
+    fig, ax = plt.subplots(2, 2, figsize=(20, 14))
+    pos = ax[0][0].imshow(bg*good_pixels)
+    ax[0][0].set_title('Median frame')
+    fig.colorbar(pos, ax=ax[0][0])
+    ax[0][1].imshow(bg_std*good_pixels)
+    ax[0][1].set_title('Per pixel std deviation')
+    fig.colorbar(pos, ax=ax[0][1])
+    ax[1][0].imshow(good_pixels == 0)
+    ax[1][0].set_title('Bad pixels')
+    ax[1][1].plot(D["frame_mean"])
+    ax[1][1].set_title('Mean intensity by frame')
+    return _save(fig, report_fname)
+
+def render_flatfield_report(D, report_fname, title=None):
+    """
+    Render the report of a flatfield (dictionary with ff, ff_std and frame_mean).
+    """
+    plt = _get_pyplot()
+    from matplotlib.colors import LogNorm
+    ff, ff_std = D["ff"], D["ff_std"]
+    fig, ax = plt.subplots(2, 2, figsize=(20, 14))
+    if title is not None:
+        fig.suptitle(title, fontsize=16)
+    pos = ax[0][0].imshow(ff)
+    ax[0][0].set_title('Median frame')
+    fig.colorbar(pos, ax=ax[0][0])
+    pos = ax[0][1].imshow(ff_std)
+    ax[0][1].set_title('Per pixel std deviation')
+    fig.colorbar(pos, ax=ax[0][1])
+    ax[1][0].plot(D["frame_mean"])
+    ax[1][0].set_title('Mean intensity by frame')
+    pos = ax[1][1].imshow(ff, norm=LogNorm(vmin=1), cmap=_get_log_cmap(plt))
+    ax[1][1].set_title('Median frame (log scale)')
+    fig.colorbar(pos, ax=ax[1][1])
+    return _save(fig, report_fname)
+
+def render_roi_report(ff, roi, ff_low_limit, report_fname, title=None):
+    """
+    Render the report of the ROI (ymin, ymax, xmin, xmax) that was chosen on the flatfield ff.
+    """
+    plt = _get_pyplot()
+    import matplotlib.patches
+    from matplotlib.colors import LogNorm
+    ymin, ymax, xmin, xmax = [int(v) for v in roi]
+    ff_thres = ff.copy()
+    ff_thres[ff < ff_low_limit] = 0
+    com_y = round(scipy.ndimage.center_of_mass(np.sum(ff_thres, axis=1))[0])
+    com_x = round(scipy.ndimage.center_of_mass(np.sum(ff_thres, axis=0))[0])
+    fig, ax = plt.subplots(2, 2, figsize=(20, 14))
+    if title is not None:
+        fig.suptitle(title, fontsize=16)
+    for a, norm, cmap, label in [(ax[0][0], None, None, 'Median frame'), (ax[0][1], LogNorm(vmin=1), _get_log_cmap(plt), 'Median frame (log scale)')]:
+        pos = a.imshow(ff, norm=norm, cmap=cmap)
+        a.set_title(label)
+        # Create a Rectangle with the ROI
+        a.add_patch(matplotlib.patches.Rectangle((xmin, ymin), xmax-xmin+1, ymax-ymin+1, linewidth=1, edgecolor='w', facecolor='none', ls=':'))
+        fig.colorbar(pos, ax=a)
+    ff_roi = ff[ymin:ymax, xmin:xmax]
+    pos = ax[1][0].imshow(ff_roi, extent=[xmin, xmax, ymax, ymin])
+    ax[1][0].axvline(x=com_x, color='black', linestyle=':')
+    ax[1][0].axhline(y=com_y, color='black', linestyle=':')
+    ax[1][0].set_title('Median frame ROI')
+    fig.colorbar(pos, ax=ax[1][0])
+    if ymin <= com_y < ymax and xmin <= com_x < xmax:
+        ax[1][1].plot(np.arange(xmin, xmax), ff_roi[com_y-ymin, :], label='horizontal')
+        ax[1][1].plot(np.arange(ymin, ymax), ff_roi[:, com_x-xmin], label='vertical')
+        ax[1][1].legend(loc="upper right")
+    ax[1][1].grid(True)
+    ax[1][1].set_title('Lineout through the center of ROI')
+    bottom_notes = 'COM y = %d x = %d ROI y = %d:%d x = %d:%d. ' % (com_y, com_x, ymin, ymax, xmin, xmax)
+    bottom_notes += 'Area above threshold (%d) = %d px. ' % (ff_low_limit, (ff_roi > ff_low_limit).sum())
+    fig.text(0.05, 0.05, bottom_notes, fontsize=10, ha='left')
+    return _save(fig, report_fname)
+
+def render_conversion_report(D, report_fname):
+    """
+    Render the report of a conversion (dictionary with bg, ff, data_mean and image_mean, all optional).
+    """
+    plt = _get_pyplot()
+    fig, ax = plt.subplots(2, 2, figsize=(20, 14))
+    for (i, j), name, label in [((0, 0), "bg", 'Background'), ((1, 0), "ff", 'Flatfield'),
+                                ((0, 1), "data_mean", 'Integrated Raw'), ((1, 1), "image_mean", 'Integrated Image')]:
+        if D.get(name) is not None:
+            pos = ax[i][j].imshow(D[name])
+            ax[i][j].set_title(label)
+            fig.colorbar(pos, ax=ax[i][j])
+    return _save(fig, report_fname)
+
+
+def render_calibration_reports(filename):
+    """
+    Render the report of a calibration file written by spts.calibration.CalibrationStore next to its source file.
+    """
+    with h5py.File(filename, "r") as f:
+        kind = f.attrs["kind"]
+        source = f.attrs["source"]
+        D = {name: f[name][()] for name in f.keys()}
+    if isinstance(kind, bytes):
+        kind = kind.decode()
+    if isinstance(source, bytes):
+        source = source.decode()
+    if kind == "bg":
+        return [render_background_report(D, source[:-4]+"_bg_report.pdf")]
+    elif kind == "ff":
+        return [render_flatfield_report(D, source[:-4]+"_ff_report.pdf", title='Flatfield report for %s' % source)]
+    else:
+        log_warning(logger, "No report for calibration of kind %s (%s)" % (kind, filename))
+        return []
+
+def render_cxi_reports(filename):
+    """
+    Render the conversion and ROI reports of a CXI file written by cxd_to_h5.
+    """
+    D = {}
+    with h5py.File(filename, "r") as f:
+        for name, path in [("bg", "/entry_1/image_1/bg"), ("ff", "/entry_1/image_1/ff"), ("ff_fullframe", "/entry_1/image_1/ff_fullframe"),
+                           ("roi", "/entry_1/image_1/roi"), ("roi_low_limit", "/entry_1/process_1/roi_low_limit"),
+                           ("data_mean", "/entry_1/data_1/data_mean"), ("image_mean", "/entry_1/image_1/data_mean")]:
+            if path in f:
+                D[name] = f[path][()]
+    reports = [render_conversion_report(D, filename[:-4]+"_report.pdf")]
+    if "ff_fullframe" in D and "roi" in D:
+        reports.append(render_roi_report(D["ff_fullframe"], D["roi"], D.get("roi_low_limit", 10), filename[:-4]+"_roi_report.pdf",
+                                         title='Flatfield ROI report for %s' % filename))
+    return reports
+
+def render_reports(filename):
+    """
+    Render all reports of a CXI file or a calibration file and return the filenames of the reports.
+    """
+    with h5py.File(filename, "r") as f:
+        is_calibration = "kind" in f.attrs
+    if is_calibration:
+        return render_calibration_reports(filename)
+    else:
+        return render_cxi_reports(filename)
+
+def render_all_reports(filenames, n_processes=None):
+    """
+    Render the reports of many files in parallel processes (default: one per core). Files that fail are logged and skipped.
+    """
+    reports = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_processes) as executor:
+        futures = {executor.submit(render_reports, fn): fn for fn in filenames}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                reports += future.result()
+            except Exception as e:
+                log_warning(logger, "Could not render report of %s (%s)" % (futures[future], str(e)))
+    return reports
+
+def render_reports_in_background(filenames, n_processes=1):
+    """
+    Start a detached process rendering the reports of the files and return without waiting for it.
+    """
+    code = "import sys, spts.report; spts.report.render_all_reports(sys.argv[2:], int(sys.argv[1]))"
+    return subprocess.Popen([sys.executable, "-c", code, str(n_processes)] + list(filenames), start_new_session=True)
@@ -4,12 +4,18 @@ import os
 import numpy
 import sys
 import time
+import json
+import shlex
+import signal
+import subprocess
 import h5py
-import h5writer
 import logging
 import logging.handlers
 import pandas as pd
 import cxd_to_h5 as cxd
+import spts.calibration
+import spts.writer
+import spts.report
 import concurrent.futures
 import multiprocessing
 from io import StringIO
@@ -28,10 +34,12 @@ logging.basicConfig(level=logging.INFO)  # Set initial logging level
 
 def tong_code(args):
 
+    # Shared between all processes, every calibration is computed once
+    store = spts.calibration.CalibrationStore(args.calibration_dir)
     bg, bg_std, good_pixels = cxd.estimate_background(
-        args.background_filename, args.bg_frames_max, args.filename)
+        args.background_filename, args.bg_frames_max, args.filename, store, args.bad_pixel_threshold)
     ff, ff_std = cxd.estimate_flatfield(
-        args.flatfield_filepath, args.ff_frames_max, bg, good_pixels)
+        args.flatfield_filepath, args.ff_frames_max, bg, good_pixels, store)
     roi = cxd.guess_ROI(ff, args.flatfield_filepath,
                     args.roi_low_limit, args.roi_fraction)
 
@@ -50,20 +58,24 @@ def tong_code(args):
 
     # Initialise output CXI file
     print("Writing to %s" % f_out)
-    W = h5writer.H5Writer(f_out)
+    W = spts.writer.H5Writer(f_out, **spts.writer.get_layout_kwargs(args))
 
     cxd.cxd_to_h5(args.filename, bg, ff, roi, good_pixels, W, args.percentile_filter, args.percentile_number,
-              args.percentile_frames, args.crop_raw, args.min_x, args.max_x, args.min_y, args.max_y, args.skip_raw)
+              args.percentile_frames, args.crop_raw, args.min_x, args.max_x, args.min_y, args.max_y, args.skip_raw, args.threads)
 
     # Write out information on the command used
     out = {"entry_1": {"process_1": {}}}
-    out["entry_1"]["process_1"] = {"command": str(sys.argv)}
-    out["entry_1"]["process_1"] = {"cwd": str(os.getcwd())}
+    out["entry_1"]["process_1"] = {"command": str(sys.argv), "cwd": str(os.getcwd()), "roi_low_limit": args.roi_low_limit}
     W.write_solo(out)
     # Close CXI file
     W.close()
     if args.skip_raw:
         h5py.File(f_out,'r+')['entry_1']['data_1']['data'] = h5py.SoftLink('/entry_1/image_1/data')
+    if args.layout_report:
+        for line in spts.writer.format_layout_report(spts.writer.get_layout_report(f_out, W.get_stats())):
+            print(line)
+    # Files with the summary datasets of the reports
+    return [f_out] + store.paths
 
 def get_args():
     parser = argparse.ArgumentParser(
@@ -88,7 +100,7 @@ def get_args():
 
     parser.add_argument('-rl', '--roi-low-limit', type=int,
                         help='Miminum intensity threshold for ROI calculations from flatfield.', default=10)
-    parser.add_argument('-rf', '--roi-fraction', type=int,
+    parser.add_argument('-rf', '--roi-fraction', type=float,
                         help='Fraction of intensity above threshold to include in ROI.', default=0.999)
 
     parser.add_argument('-m', '--percentile-filter', action='store_true',
@@ -114,8 +126,29 @@ def get_args():
                         help='overwrite already cxi files in folder', default=False)
     parser.add_argument('-sk', '--skip-raw', action='store_true',
                         help='Skip saving the raw data, instead linking to processed data')
+    spts.writer.add_layout_arguments(parser)
+    parser.add_argument('-t', '--threads', type=int,
+                        help='Number of threads correcting frames of a file (default: all cores in watch mode, 1 otherwise as files are converted in parallel).', default=None)
     parser.add_argument('-q', '--quiet', action='store_true',
-                        help="Don't show plots interactively")
+                        help="Don't show plots interactively (no effect, reports are never shown)")
+    parser.add_argument('--report', action='store_true',
+                        help='Render the PDF reports of all files in parallel after the conversions.')
+    parser.add_argument('--bad-pixel-threshold', type=float,
+                        help='Pixels with a background above the median level plus this many standard deviations are marked as bad.', default=6.)
+    parser.add_argument('--calibration-dir', type=str,
+                        help='Directory of the cached background and flatfield estimates (default: next to the CXD files).', default=None)
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running and convert new CXD files as soon as their acquisition is finished (stop with Ctrl-C).')
+    parser.add_argument('--poll-interval', type=float,
+                        help='Seconds between scans of the data path in watch mode.', default=10.)
+    parser.add_argument('--settle-time', type=float,
+                        help='A CXD file counts as finished when its size and modification time did not change for this many seconds.', default=30.)
+    parser.add_argument('--state-file', type=str,
+                        help='JSON file recording the files converted in watch mode (default: auto_cxd2cxi_state.json in the data path).', default=None)
+    parser.add_argument('--analyse', type=str,
+                        help='In watch mode, analyse every converted file with run_spts_auto.py and this config file.', default=None)
+    parser.add_argument('--analysis-args', type=str,
+                        help='Additional arguments of run_spts_auto.py, e.g. "-c 8 -wd 9".', default="")
 
     args = parser.parse_args()
 
@@ -178,6 +211,12 @@ def get_args():
         else:
             print(f"Flatfield file found. Path: {args.flatfield_filepath}")
 
+    if args.threads is None:
+        args.threads = os.cpu_count() if args.watch else 1
+
+    if args.state_file is None:
+        args.state_file = os.path.join(args.data_path, "auto_cxd2cxi_state.json")
+
     return args
 
 def process_file(args, file, files_to_do, log):
@@ -226,12 +265,173 @@ def process_file(args, file, files_to_do, log):
 
     original_level = logging.getLogger().level
     logging.getLogger().setLevel(logging.CRITICAL)
-    tong_code(args)
+    report_files = tong_code(args)
     logging.info("This will not appear in the console.")
     logging.getLogger().setLevel(original_level)
+    return report_files
         
+def load_state(filename):
+    """
+    Read the state file of the watch mode, a dictionary with an entry for every CXD file that was (or is being) converted.
+    """
+    if not os.path.exists(filename):
+        return {}
+    with open(filename, "r") as f:
+        return json.load(f)
+
+def save_state(state, filename):
+    # Replace the file at once such that it is never left half written
+    with open(filename + ".tmp", "w") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(filename + ".tmp", filename)
+
+def get_finished_files(args, log, state, seen, now):
+    """
+    Return the CXD files in the data path that still need to be converted and whose acquisition is finished. A file is
+    finished when its size and modification time did not change for args.settle_time seconds (seen records the last
+    size and modification time of every file and when they were first observed) and it has an entry in the log book.
+    """
+    finished = []
+    for file in sorted(os.listdir(args.data_path)):
+        if not file.endswith(".cxd") or file in ["_flatfield01624.cxd", "data01624.cxd"]:
+            continue
+        if state.get(file, {}).get("status") in ["done", "failed", "skipped"]:
+            continue
+        if args.start_number is not None and int(file[4:9]) < args.start_number:
+            continue
+        if args.end_number is not None and int(file[4:9]) > args.end_number:
+            continue
+        try:
+            st = os.stat(os.path.join(args.data_path, file))
+        except FileNotFoundError:
+            continue
+        key = [st.st_size, st.st_mtime]
+        if file not in seen or seen[file][0] != key:
+            seen[file] = (key, now)
+            continue
+        # Files that were written long ago are finished right away (the clock of a mounted file system may differ)
+        if now - seen[file][1] < args.settle_time and now - st.st_mtime < args.settle_time:
+            continue
+        # The log book entry is usually written after the acquisition
+        if not log_book.check_name_in_log(file, log):
+            continue
+        finished.append(file)
+    return finished
+
+def start_analysis(args, file):
+    """
+    Start run_spts_auto.py for a converted file in a separate process and return the process.
+    """
+    n = int(file[4:9])
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "run_spts_auto.py"),
+           "-dp", args.data_path, "-lf", args.log_file, "-cf", args.analyse, "-sn", str(n), "-en", str(n)]
+    cmd += shlex.split(args.analysis_args)
+    print(f"Analysing {file}: {' '.join(cmd)}")
+    return subprocess.Popen(cmd)
+
+def _finish_conversion(args, file, future, state):
+    # Record the result of a conversion in the state file, returns the output files or None if it failed
+    t_found = state[file]["time"]
+    try:
+        report_files = future.result()
+    except (Exception, SystemExit) as exc:
+        print(f'Conversion of {file} generated an exception: {exc}')
+        state[file] = {"status": "failed", "error": str(exc), "time": time.time()}
+        save_state(state, args.state_file)
+        return None
+    state[file] = {"status": "done", "output": report_files[0], "time": time.time()}
+    save_state(state, args.state_file)
+    print(f"Converted {file} in {state[file]['time'] - t_found:.0f} seconds.")
+    return report_files
+
+def _terminate(signum, frame):
+    raise KeyboardInterrupt
+
+def watch(args):
+    """
+    Convert CXD files as they are written to the data path until interrupted. Files that are converted are recorded in
+    the state file, a file that was being converted when the watch was interrupted is converted again on the next start.
+    Already existing complete CXI files are not converted again (unless --overwrite is given). With --analyse every converted
+    file is analysed right away, one file at a time.
+    """
+    state = load_state(args.state_file)
+    print(f"Watching {args.data_path} for new CXD files (state file: {args.state_file}).")
+    signal.signal(signal.SIGTERM, _terminate)
+    seen = {}
+    log = None
+    running = {}
+    # Files waiting for the analysis (also those of an earlier watch that was interrupted)
+    analyses = sorted([file for file, v in state.items() if v.get("analysis") == "pending"]) if args.analyse is not None else []
+    analysis = None
+    rendered = set()
+    executor = concurrent.futures.ProcessPoolExecutor()
+    try:
+        while True:
+            now = time.time()
+            # The log book grows during the beamtime
+            try:
+                log = log_book.read_log_book(args.log_file)
+            except Exception as e:
+                if log is None:
+                    raise
+                print(f"WARNING: Could not read log book {args.log_file} ({e}), using the previous version.")
+            for file in get_finished_files(args, log, state, seen, now):
+                if file in running:
+                    continue
+                out_file = os.path.join(args.data_path, file[:-4] + ".cxi")
+                if state.get(file, {}).get("status") != "converting" and os.path.exists(out_file) and spts.writer.is_output_complete(out_file) and not args.overwrite:
+                    state[file] = {"status": "done", "output": out_file, "time": now}
+                    save_state(state, args.state_file)
+                    continue
+                # Backgrounds, flatfields and excluded files are not converted
+                if file not in log_book.check_bg_ff_and_exclude(args, [file], log):
+                    state[file] = {"status": "skipped", "time": now}
+                    save_state(state, args.state_file)
+                    continue
+                print(f"New file: {file}")
+                state[file] = {"status": "converting", "size": seen[file][0][0], "time": now}
+                save_state(state, args.state_file)
+                running[file] = executor.submit(process_file, args, file, [file], log)
+            for file, future in list(running.items()):
+                if future.done():
+                    del running[file]
+                    report_files = _finish_conversion(args, file, future, state)
+                    if report_files is None:
+                        continue
+                    if args.report:
+                        new = [fn for fn in report_files if fn not in rendered]
+                        rendered.update(new)
+                        spts.report.render_reports_in_background(new)
+                    if args.analyse is not None:
+                        state[file]["analysis"] = "pending"
+                        save_state(state, args.state_file)
+                        analyses.append(file)
+            if analysis is not None and analysis.poll() is not None:
+                file = analyses.pop(0)
+                if analysis.returncode != 0:
+                    print(f"WARNING: Analysis of {file} exited with code {analysis.returncode}.")
+                state[file]["analysis"] = "done" if analysis.returncode == 0 else "failed"
+                save_state(state, args.state_file)
+                analysis = None
+            if analysis is None and len(analyses) > 0:
+                analysis = start_analysis(args, analyses[0])
+            time.sleep(args.poll_interval)
+    except KeyboardInterrupt:
+        print(f"Stopping watch, waiting for {len(running)} conversion(s) to finish.")
+        executor.shutdown(wait=True, cancel_futures=True)
+        for file, future in running.items():
+            if not future.cancelled():
+                _finish_conversion(args, file, future, state)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        if analysis is not None:
+            analysis.wait()
+
 def main():
     args = get_args()
+    if args.watch:
+        watch(args)
+        return
     log = log_book.read_log_book(args.log_file)
     files_to_do = log_book.get_cxd2do(args, log)
 
@@ -240,12 +440,13 @@ def main():
 
     
     
+    report_files = []
     #iterate through files_to_do and process them
     with concurrent.futures.ProcessPoolExecutor() as executor:
             futures = [executor.submit(process_file, args, file, files_to_do, log) for file in files_to_do]
             for i, future in enumerate(concurrent.futures.as_completed(futures)):
                 try:
-                    future.result()
+                    report_files += future.result()
                     elapsed_time = time.time() - start_time
                     iter_time = elapsed_time / (i + 1)
                     remaining_files = len(files_to_do) - (i + 1)
@@ -255,6 +456,12 @@ def main():
                     print(f'Generated an exception: {exc}')
                     traceback.print_exc()
 
+    if args.report:
+        # Calibrations shared by several files are rendered once
+        report_files = sorted(set(report_files))
+        print(f"Rendering reports of {len(report_files)} files...")
+        spts.report.render_all_reports(report_files)
+
 if __name__ == "__main__":
     main()
     #main()
\ No newline at end of file
@@ -1,142 +1,117 @@
 #!/usr/bin/env python
 import numpy as np
-import os,sys,h5py
-from pylab import imread
+import os,sys,json
+import subprocess
 import argparse
 
-def avi_to_frames(filename):
-    d = filename[:-len(".avi")] + "_frames"
-    if os.path.exists(d):
-        print("Frames already converted to PNG ...")
-        return d
-    print("Prepare output directory ...")
-    cmd = "mkdir %s" % d
-    print(cmd)
-    os.system(cmd)
-    cmd = "rm %s/*" % d
-    print(cmd)
-    os.system(cmd)
-    print("Convert AVI to PNGs ...")
-    cmd = ("ffmpeg -i %s %s/" % (filename,d) + "frame%09d.png")
-    print(cmd)
-    os.system(cmd)
-    return d
+import spts.writer
 
-def _new_dataset(f, name, dtype, frame_shape, N=None):
-    if N is not None:
-        shape = tuple([N] + list(frame_shape))
-    else:
-        shape = frame_shape
-    ds = f.create_dataset(name, shape, dtype=dtype)
-    ndim = len(list(frame_shape))
-    if N is not None:
-        axid = "experiment_identifier"
-        if ndim == 1:
-            axid += ":x"
-        elif ndim == 2:
-            axid += ":y:x"
-        elif ndim == 3:
-            axid += ":z:y:x"
-    else:
-        if ndim == 1:
-            axid = "x"
-        elif ndim == 2:
-            axid = "y:x"
-        elif ndim == 3:
-            axid = "z:y:x"           
-    ds.attrs.modify("axes",[axid])
-    return ds
-    
-def frames_to_h5(directory, factor, N_max=250):
-    filenames = [(directory + "/" + filename) for filename in os.listdir(directory) \
-         if filename.startswith("frame") and filename.endswith(".png")]
-    #filenames = filenames[:10]
-    filename_h5 = directory + "/frames.cxi"
-    init = False
-    N = len(filenames)
-    print("Convert PNGs to H5 ...")
-    with h5py.File(filename_h5,"w") as f:
-        f.create_group("/entry_1")
-        # Raw data
-        grp_name = "/entry_1/data_1"
-        ds_raw_sum = _new_dataset(f, grp_name + "/sum", np.int32, tuple(), N)
-        ds_raw_min = _new_dataset(f, grp_name + "/min", np.int16, tuple(), N)
-        ds_raw_max = _new_dataset(f, grp_name + "/max", np.int16, tuple(), N)
-        ds_raw_median = _new_dataset(f, grp_name + "/median", np.float64, tuple(), N)
-        for i,filename in enumerate(filenames):
-            print("(%i/%i) Raw frame to H5" % (i+1,N))
-            img = imread(filename)
-            # RGB to Grayscale
-            img = np.array(np.round(255*img.sum(axis=2)/3),dtype=np.int16)
-            if not init:
-                ds_raw = _new_dataset(f, grp_name + "/data", np.int16, img.shape, N)
-                init = True
-            ds_raw[i,:,:] = img[:,:]
-            ds_raw_sum[i] = img.sum()
-            ds_raw_min[i] = img.min()
-            ds_raw_max[i] = img.max()
-            ds_raw_median[i] = np.median(img)  
-        # Background and fluctuation
-        ds_std = _new_dataset(f, grp_name + "/std", np.float64, img.shape, None)
-        ds_bg = _new_dataset(f, grp_name + "/bg", np.float64, img.shape, None)
-        if N < N_max:
-            bg = np.median(ds_raw,axis=0)
-            std = np.std(ds_raw,axis=0)
-        else:
-            bg = np.median(ds_raw[:N_max,:,:],axis=0)
-            std = np.std(ds_raw[:N_max,:,:],axis=0)
-        ds_std[:,:] = std[:,:]
-        ds_bg[:,:] = bg[:,:]
-        # Corrected data 1
-        grp_name = "/entry_1/image_1"
-        f.create_group(grp_name)
-        ds_corr1_sum = _new_dataset(f, grp_name + "/sum", np.int32, tuple(), N)
-        ds_corr1_min = _new_dataset(f, grp_name + "/min", np.int16, tuple(), N)
-        ds_corr1_max = _new_dataset(f, grp_name + "/max", np.int16, tuple(), N)
-        ds_corr1_median = _new_dataset(f, grp_name + "/median", np.float64, tuple(), N)
-        ds_corr1 = _new_dataset(f, grp_name + "/data", np.float64, img.shape, N)
-        for i in range(N):
-            print("(%i/%i) Corrected (1) frame to H5" % (i+1,N))
-            temp = ds_raw[i,:,:] - bg[:,:]
-            img1 = temp - np.median(temp)
-            ds_corr1[i,:,:] = img1[:,:]
-            ds_corr1_sum[i] = img1.sum()
-            ds_corr1_min[i] = img1.min()
-            ds_corr1_max[i] = img1.max()
-            ds_corr1_median[i] = np.median(img1)
-        # Corrected data 1
-        grp_name = "/entry_1/image_2"
-        f.create_group(grp_name)
-        ds_corr2_sum = _new_dataset(f, grp_name + "/sum", np.int32, tuple(), N)
-        ds_corr2_min = _new_dataset(f, grp_name + "/min", np.int16, tuple(), N)
-        ds_corr2_max = _new_dataset(f, grp_name + "/max", np.int16, tuple(), N)
-        ds_corr2_median = _new_dataset(f, grp_name + "/median", np.float64, tuple(), N)
-        ds_corr2 = _new_dataset(f, grp_name + "/data", np.float64, img.shape, N)
-        for i in range(N):
-            print("(%i/%i) Corrected (2) frame to H5" % (i+1,N))
-            temp = ds_raw[i,:,:] - bg[:,:]
-            row_medians = np.median(temp, axis=1)
-            img2 = temp# - np.array([row_medians]).repeat(img.shape[1],axis=0).reshape((img.shape[0],img.shape[1]))
-            ds_corr2[i,:,:] = img2[:,:]
-            ds_corr2_sum[i] = img2.sum()
-            ds_corr2_min[i] = img2.min()
-            ds_corr2_max[i] = img2.max()
-            ds_corr2_median[i] = np.median(img2)
+def get_frame_shape(filename):
+    """
+    Return (height, width) of the video stream of the AVI file (asks ffprobe).
+    """
+    cmd = ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "stream=width,height", "-of", "json", filename]
+    out = subprocess.run(cmd, stdout=subprocess.PIPE, check=True).stdout
+    stream = json.loads(out)["streams"][0]
+    return int(stream["height"]), int(stream["width"])
+
+def iter_frames(filename, rgb_mean=False):
+    """
+    Decode the AVI file with ffmpeg and yield the frames as 2D uint8 arrays. The frames are piped as raw video, by
+    default converted to grey by ffmpeg. With rgb_mean=True ffmpeg delivers RGB and the grey value is the rounded mean
+    of the three channels.
+    """
+    height, width = get_frame_shape(filename)
+    channels = 3 if rgb_mean else 1
+    nbytes = height * width * channels
+    cmd = ["ffmpeg", "-v", "error", "-i", filename, "-f", "rawvideo", "-pix_fmt", "rgb24" if rgb_mean else "gray", "-"]
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=nbytes)
+    try:
+        while True:
+            buf = bytearray(nbytes)
+            view = memoryview(buf)
+            n = 0
+            while n < nbytes:
+                r = p.stdout.readinto(view[n:])
+                if not r:
+                    break
+                n += r
+            if n < nbytes:
+                break
+            frame = np.frombuffer(buf, dtype=np.uint8)
+            if rgb_mean:
+                # Mean of three integers is never halfway between two integers, rounding is exact
+                s = frame.reshape(height, width, 3).sum(axis=2, dtype=np.uint16)
+                frame = ((s + 1) // 3).astype(np.uint8)
+            yield frame.reshape(height, width)
+    finally:
+        p.stdout.close()
+        if p.wait() != 0:
+            print("WARNING: ffmpeg exited with code %i" % p.returncode)
+
+def _get_stats(img):
+    return {"sum": img.sum(), "min": img.min(), "max": img.max(), "median": np.median(img)}
+
+def _get_slice(raw, bg, image_2=False):
+    out = {"entry_1": {"data_1": {"data": raw}}}
+    out["entry_1"]["data_1"].update(_get_stats(raw))
+    # Corrected data 1 (background and median subtracted)
+    temp = raw.astype(np.float32) - bg
+    img1 = temp - np.median(temp)
+    out["entry_1"]["image_1"] = {"data": img1}
+    out["entry_1"]["image_1"].update(_get_stats(img1))
+    if image_2:
+        # Corrected data 2 (background subtracted)
+        out["entry_1"]["image_2"] = {"data": temp}
+        out["entry_1"]["image_2"].update(_get_stats(temp))
+    return out
+
+def avi_to_h5(filename_avi, factor=None, N_max=250, rgb_mean=False, image_2=False, layout_kwargs={}):
+    """
+    Convert an AVI file to CXI in a single pass over the decoded frames. The background (median) and its fluctuation
+    (std) are estimated from the first N_max frames, which are held in memory until the background is known.
+    """
+    filename_h5 = os.path.abspath(os.path.dirname(filename_avi)) + "/" + (filename_avi.split("/")[-1])[:-len(".avi")] + ".cxi"
+    print("Convert %s to %s ..." % (filename_avi, filename_h5))
+    W = spts.writer.H5Writer(filename_h5, **layout_kwargs)
+    frames = iter_frames(filename_avi, rgb_mean=rgb_mean)
+    buf = []
+    for raw in frames:
+        buf.append(raw)
+        if len(buf) == N_max:
+            break
+    if len(buf) == 0:
+        W.close()
+        print("ERROR: No frames in %s" % filename_avi)
+        return None
+    stack = np.asarray(buf)
+    bg = np.median(stack, axis=0).astype(np.float32)
+    std = np.std(stack, axis=0).astype(np.float32)
+    del stack
+    N = 0
+    for raw in buf:
+        W.write_slice(_get_slice(raw, bg, image_2))
+        N += 1
+    buf = None
+    for raw in frames:
+        W.write_slice(_get_slice(raw, bg, image_2))
+        N += 1
+        if N % 100 == 0:
+            print("(%i) Frames converted" % N, end='\r')
+    print("(%i) Frames converted" % N)
+    W.write_solo({"entry_1": {"data_1": {"bg": bg, "std": std}}})
+    W.close()
     return filename_h5
-            
-def avi_to_h5(filename_avi, factor, keep_pngs=False):
-    directory_frames = avi_to_frames(filename_avi)
-    filename_h5 = frames_to_h5(directory_frames, factor=factor)
-    filename_h5_new = os.path.abspath(os.path.dirname(filename_avi)) + "/" + (filename_avi.split("/")[-1])[:-len(".avi")] + ".cxi"
-    os.system("mv %s %s" % (filename_h5,filename_h5_new))
-    if not keep_pngs: os.system("rm -rf %s" % directory_frames)
-    return filename_h5_new
 
 def main():
     parser = argparse.ArgumentParser(description='Conversion of AVI to HDF5')
-    parser.add_argument('filename', type=str, help='HDF5 filename', default=None)
-    parser.add_argument('-k', '--keep_pngs', action="store_true", help='keep temporary PNG files')
-    parser.add_argument('-f','--factor', type=float, help='multiply by factor', default=3700.)
+    parser.add_argument('filename', type=str, nargs='?', help='AVI filename (default: all AVI files in the current directory)', default=None)
+    parser.add_argument('-k', '--keep_pngs', action="store_true", help='no effect, frames are piped from ffmpeg without temporary files')
+    parser.add_argument('-f','--factor', type=float, help='multiply by factor (not used)', default=3700.)
+    parser.add_argument('-n', '--n-background', type=int, help='number of frames for the estimation of the background', default=250)
+    parser.add_argument('--rgb-mean', action="store_true", help='grey value as mean of the RGB channels instead of the luma computed by ffmpeg')
+    parser.add_argument('--image-2', action="store_true", help='also write the background subtracted frames without median subtraction (/entry_1/image_2)')
+    spts.writer.add_layout_arguments(parser)
     args = parser.parse_args()
     if args.filename is None:
         filenames = [f for f in os.listdir("./") if f.endswith(".avi")]
@@ -144,7 +119,11 @@ def main():
         filenames = [args.filename]
     for i,filename in enumerate(filenames):
         print(("(%i/%i)" % (i+1,len(filenames))), filename)
-        avi_to_h5(filename, factor=args.factor, keep_pngs=args.keep_pngs)
+        filename_h5 = avi_to_h5(filename, factor=args.factor, N_max=args.n_background, rgb_mean=args.rgb_mean, image_2=args.image_2,
+                                layout_kwargs=spts.writer.get_layout_kwargs(args))
+        if filename_h5 is not None and args.layout_report:
+            for line in spts.writer.format_layout_report(spts.writer.get_layout_report(filename_h5)):
+                print(line)
 
 if __name__ == "__main__":
     main()
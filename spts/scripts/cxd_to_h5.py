@@ -2,10 +2,11 @@
 import argparse
 import os
 import sys
+import threading, queue, collections
+import concurrent.futures
 import olefile
 import numpy as np
 
-from scipy.ndimage import percentile_filter
 import scipy.ndimage
 
 import sys
@@ -14,14 +15,22 @@ import h5writer
 import h5py
 import spts
 import spts.camera
+import spts.writer
+import spts.calibration
+import spts.report
 from spts.camera import CXDReader
-import matplotlib.pyplot as plt
-import matplotlib.cm
-import matplotlib.patches
-from matplotlib.colors import LogNorm
 
+# Maximum number of frames read from the CXD file at once
+BLOCK_LENGTH = 64
 
-def estimate_background(filename_bg_cxd, bg_frames_max, filename):
+# Approximate size of a block of (cropped) frames, fewer frames are read at once if the frames are large
+BLOCK_NBYTES = 32<<20
+
+# Memory for the blocks that are read, corrected or waiting to be written at the same time (at least one block)
+PIPELINE_NBYTES = 512<<20
+
+
+def estimate_background(filename_bg_cxd, bg_frames_max, filename, store=None, bad_pixel_threshold=6.):
     print("*************************************")
     print("*   Background correction section   *")
     print("*************************************")
@@ -31,198 +40,56 @@ def estimate_background(filename_bg_cxd, bg_frames_max, filename):
             print("Background file missing!")
             return None, None, None
 
-    f_cache = filename_bg_cxd[:-4] + '_bg_' + str(bg_frames_max) + ".h5"
-    bg = None
-    try:
-        f = h5py.File(f_cache, 'r')
-        print("Reading cached background from %s" % (f_cache))
-        bg = f['bg'][:]
-        bg_std = f['bg_std'][:]
-        good_pixels = f['good_pixels'][:]
-        print("Mean over mean background = %.0f" % (np.mean(bg)))
-        print("Std dev over mean background = %.0f" % (np.std(bg)))
-        return bg, bg_std, good_pixels
-    except OSError:
-        pass
-
-    Rbg = CXDReader(filename_bg_cxd)
-    N = min([bg_frames_max, Rbg.get_number_of_frames()])
-    print("Collecting %d background frames..." % (N), end='')
-    for i in range(N):
-        frame = Rbg.get_frame(i)  # dtype: uint16
-
-        if i == 0:
-            shape = (frame.shape[0], frame.shape[1], N)
-            bg_stack = np.zeros(shape, dtype=frame.dtype)  # background stack
-
-        bg_stack[:, :, i] = frame[:, :]
-    print("done")
-
-    print("Calculating background estimate by mean of buffer...", end='')
-    bg = np.mean(bg_stack, axis=2)
-    bg_std = np.std(bg_stack, axis=2)
-
-    # Use the standard deviation of the 50% middle values to find
-    # bad pixels
-    sort_bg = np.sort(bg.flatten())
-    middle_bg = sort_bg[round(len(sort_bg)/4):-round(len(sort_bg)/4)]
-    middle_std = np.std(middle_bg)
-    good_pixels = bg < np.mean(middle_bg)+middle_std*6
-    bg *= good_pixels
-    print("done")
-    print("Found %d bad pixels" % (good_pixels == 0).sum())
+    if store is None:
+        store = spts.calibration.CalibrationStore()
+
+    def compute(filename_bg_cxd, n_frames, bad_pixel_threshold):
+        print("Calculating background estimate by mean of %d frames..." % (n_frames), end='')
+        D = spts.calibration.compute_background(filename_bg_cxd, n_frames, bad_pixel_threshold)
+        print("done")
+        print("Found %d bad pixels" % (D["good_pixels"] == 0).sum())
+        return D
 
+    D = spts.calibration.get_background(filename_bg_cxd, bg_frames_max, bad_pixel_threshold, store=store, compute=compute)
+    bg, bg_std, good_pixels = D["bg"], D["bg_std"], D["good_pixels"]
     print("Mean over mean background = %.0f" % (np.mean(bg)))
     print("Std dev over mean background = %.0f" % (np.std(bg)))
-
-    f = h5py.File(f_cache, 'w')
-    f.create_dataset('bg', data=bg)
-    f.create_dataset('bg_std', data=bg_std)
-    f.create_dataset('good_pixels', data=good_pixels)
-    f.close()
-
-    # Make a small report
-    report_fname = filename_bg_cxd[:-4]+"_bg_report.pdf"
-    print("Writing report to %s..." % (report_fname), end='')
-    fig, ax = plt.subplots(2, 2, figsize=(20, 14))
-    pos = ax[0][0].imshow(bg*good_pixels)
-    ax[0][0].set_title('Median frame')
-    fig.colorbar(pos, ax=ax[0][0])
-    ax[0][1].imshow(bg_std*good_pixels)
-    ax[0][1].set_title('Per pixel std deviation')
-    fig.colorbar(pos, ax=ax[0][1])
-    ax[1][0].imshow(good_pixels == 0)
-    ax[1][0].set_title('Bad pixels')
-    ax[1][1].plot(np.mean(bg_stack, axis=(0, 1)))
-    ax[1][1].set_title('Mean intensity by frame')
-
-    try:
-        plt.savefig(report_fname)
-        print("\nReport saved succesfully!!!")
-    except IOError:
-        pass
-
-    try:
-        if(not args.quiet):
-            plt.show()
-    except:
-        pass
-
-    print("done")
-
     return bg, bg_std, good_pixels
 
 
-def estimate_flatfield(flatfield_filename, ff_frames_max, bg, good_pixels):
+def estimate_flatfield(flatfield_filename, ff_frames_max, bg, good_pixels, store=None):
     print("*************************************")
     print("*   Flat field correction section   *")
     print("*************************************")
-    if(flatfield_filename is None):
-        flatfield_filename = flatfield_filename[:-4] + "_ff.cxd"
-        if not os.path.isfile(flatfield_filename):
-            print("Flat field file missing!")
-            return None, None
-
-    f_cache = flatfield_filename[:-4] + '_ff_' + str(ff_frames_max) + ".h5"
-    ff = None
-    try:
-        f = h5py.File(f_cache, 'r')
-        print("Reading cached background from %s" % (f_cache))
-        ff = f['ff'][:]
-        ff_std = f['ff_std'][:]
-        print("Mean over median flatfield = %.0f" % (np.mean(ff)))
-        print("Std dev over median flatfield = %.0f" % (np.std(ff)))
-        return ff, ff_std
-    except OSError:
-        pass
-
-    print("Collecting flat-field frames...", end='')
-
-    R = CXDReader(flatfield_filename)
-    N = min([ff_frames_max, R.get_number_of_frames()])
-    frame = R.get_frame(0)  # dtype: uint16
-    if(good_pixels is None):
-        print("Warning: Good pixels information is missing. Using all the pixels.")
-        good_pixels = np.ones_like(frame)
-
-    if bg is None:
-        print("Warning: Background information is missing. Using median of the 1st frame as background.")
-        bg = np.median(frame.flatten())
-
-    shape = (N, frame.shape[0], frame.shape[1])
-    ff_stack = np.zeros(shape, dtype=np.float32)  # background stack
-
-    com_stack = np.zeros((N, 2))
-    for i in range(N):
-        frame = R.get_frame(i)  # dtype: uint16
-        ff_stack[i, :, :] = (np.ndarray.astype(
-            frame, dtype='float32') - bg)*good_pixels
-        com_stack[i] = scipy.ndimage.center_of_mass(ff_stack[i])
-
-    print("done")
-    print("Calculating flatfield correction estimate by median of buffer... ", end='')
-    ff = np.median(ff_stack, axis=0)
-    ff_std = np.std(ff_stack, axis=0)
-    ff_mean = np.mean(ff)
-    print("done")
-    print("Mean of all pixels in median flatfield = %.0f" % (ff_mean))
+    if(flatfield_filename is None or not os.path.isfile(flatfield_filename)):
+        print("Flat field file missing!")
+        return None, None
+
+    if store is None:
+        store = spts.calibration.CalibrationStore()
+
+    def compute(flatfield_filename, n_frames, bg, good_pixels):
+        print("Calculating flatfield correction estimate by median of %d frames... " % (n_frames), end='')
+        D = spts.calibration.compute_flatfield(flatfield_filename, n_frames, bg, good_pixels)
+        print("done")
+        ff_mean = np.mean(D["ff"])
+        ff_mean_std = np.std(D["frame_mean"])
+        print("Std dev across frames of flatfield mean intensity = %.0f (%.1f%%)" %
+              (ff_mean_std, 100.0 * ff_mean_std/ff_mean))
+        if(100.0 * ff_mean_std/ff_mean > 10):
+            print("Warning: Flatfield intensity is fluctuating more than 10% across frames!")
+        com_mean = scipy.ndimage.center_of_mass(D["ff"])
+        print("Center of mass of median flatfield = %.0f,%.0f" %
+              (com_mean[0], com_mean[1]))
+        com_std = np.std(D["center_of_mass"], axis=0)
+        print("Center of mass std dev of flatfield = %.0f,%.0f" %
+              (com_std[0], com_std[1]))
+        return D
+
+    D = spts.calibration.get_flatfield(flatfield_filename, ff_frames_max, bg, good_pixels, store=store, compute=compute)
+    ff, ff_std = D["ff"], D["ff_std"]
+    print("Mean of all pixels in median flatfield = %.0f" % (np.mean(ff)))
     print("Std dev of all pixels in median flatfield = %.0f" % (np.std(ff)))
-    ff_mean_std = np.std(np.mean(ff_stack, axis=(1, 2)))
-    print("Std dev across frames of flatfield mean intensity = %.0f (%.1f%%)" %
-          (ff_mean_std, 100.0 * ff_mean_std/ff_mean))
-    if(100.0 * ff_mean_std/ff_mean > 10):
-        print("Warning: Flatfield intensity is fluctuating more than 10% across frames!")
-    com_mean = scipy.ndimage.center_of_mass(ff)
-    print("Center of mass of median flatfield = %.0f,%.0f" %
-          (com_mean[0], com_mean[1]))
-    com_std = np.std(com_stack, axis=0)
-    print("Center of mass std dev of flatfield = %.0f,%.0f" %
-          (com_std[0], com_std[1]))
-
-    f = h5py.File(f_cache, 'w')
-    f.create_dataset('ff', data=ff)
-    f.create_dataset('ff_std', data=ff_std)
-    f.close()
-
-    # Make a small report
-    report_fname = flatfield_filename[:-4]+"_ff_report.pdf"
-    print("Writing report to %s..." % (report_fname), end='')
-    fig, ax = plt.subplots(2, 2, figsize=(20, 14))
-    fig.suptitle('Flatfield report for %s' % (flatfield_filename), fontsize=16)
-    pos = ax[0][0].imshow(ff)
-    ax[0][0].set_title('Median frame')
-    fig.colorbar(pos, ax=ax[0][0])
-    pos = ax[0][1].imshow(ff_std)
-    ax[0][1].set_title('Per pixel std deviation')
-    fig.colorbar(pos, ax=ax[0][1])
-
-    ax[1][0].plot(np.mean(ff_stack, axis=(1, 2)))
-    ax[1][0].set_title('Mean intensity by frame')
-    ff_stack_mean = np.mean(ff_stack, axis=0)
-    #pos = ax[1][1].imshow(ff_stack_mean, vmin=0, vmax=np.percentile(ff_stack_mean.flatten(), 99.99))
-
-    import copy
-    # Use special colormap to avoid seeing value below 1
-    my_cmap = copy.copy(plt.get_cmap())
-    my_cmap.set_bad(my_cmap.colors[0])
-    pos = ax[1][1].imshow(ff, norm=LogNorm(vmin=1), cmap=my_cmap)
-    ax[1][1].set_title('Median frame (log scale)')
-    fig.colorbar(pos, ax=ax[1][1])
-
-    try:
-        plt.savefig(report_fname)
-        print("\nReport saved succesfully!!!")
-    except IOError:
-        pass
-
-    try:
-        if(not args.quiet):
-            plt.show()
-    except:
-        pass
-
-    print("done")
-
     return ff, ff_std
 
 
@@ -231,109 +98,187 @@ def guess_ROI(ff, flatfield_filename, ff_low_limit, roi_fraction):
         print("Cannot guess ROI: flat field information missing!")
         return (slice(None), slice(None))
 
-    ff_thres = ff.copy()
-    ff_thres[ff < ff_low_limit] = 0
-
-    ff_y = np.sum(ff_thres, axis=1)
-    ff_x = np.sum(ff_thres, axis=0)
-
-    # We'll try to include roi_fraction of the intensity in our ROI
-    com = scipy.ndimage.center_of_mass(ff_y)
-    com_y = round(com[0])
-    y_width = 1
-    while(ff_y.sum()*roi_fraction > ff_y[com_y-y_width:com_y+y_width].sum()):
-        y_width += 1
-    # And now we'll add some padding around
-    pad = 20  # 20 px padding
-    ymin = com_y - y_width - pad
-    if(ymin < 0):
-        ymin = 0
-    ymax = com_y + y_width + pad
-    if(ymax > ff.shape[0]):
-        ymax = ff.shape[0]
-
-    com = scipy.ndimage.center_of_mass(ff_x)
-    com_x = round(com[0])
-    x_width = 1
-    while(ff_x.sum()*roi_fraction > ff_x[com_x-x_width:com_x+x_width].sum()):
-        x_width += 1
-
-    # And now we'll add some padding around
-    pad = 20  # 20 px padding
-    xmin = com_x - x_width - pad
-    if(xmin < 0):
-        xmin = 0
-    xmax = com_x + x_width + pad
-    if(xmax > ff.shape[1]):
-        xmax = ff.shape[1]
-
+    ymin, ymax, xmin, xmax = spts.calibration.find_roi(ff, ff_low_limit, roi_fraction)
     print("Auto cropping to y = %d:%d x = %d:%d" % (ymin, ymax, xmin, xmax))
     roi = (slice(ymin, ymax, None), slice(xmin, xmax, None))
-
-    # Make a small report
-    report_fname = flatfield_filename[:-4]+"_roi_report.pdf"
-    print("Writing report to %s..." % (report_fname), end='')
-    fig, ax = plt.subplots(2, 2, figsize=(20, 14))
-    fig.suptitle('Flatfield ROI report for %s' %
-                 (flatfield_filename), fontsize=16)
-    pos = ax[0][0].imshow(ff)
-    ax[0][0].set_title('Median frame')
-    # Create a Rectangle with the ROI
-    rect = matplotlib.patches.Rectangle(
-        (xmin, ymin), xmax-xmin+1, ymax-ymin+1, linewidth=1, edgecolor='w', facecolor='none', ls=':')
-    ax[0][0].add_patch(rect)
-    fig.colorbar(pos, ax=ax[0][0])
-
-    import copy
-    # Use special colormap to avoid seeing value below 1
-    my_cmap = copy.copy(plt.get_cmap())
-    my_cmap.set_bad(my_cmap.colors[0])
-    pos = ax[0][1].imshow(ff, norm=LogNorm(vmin=1), cmap=my_cmap)
-    ax[0][1].set_title('Median frame (log scale)')
-    # Create a Rectangle with the ROI
-    rect = matplotlib.patches.Rectangle(
-        (xmin, ymin), xmax-xmin+1, ymax-ymin+1, linewidth=1, edgecolor='w', facecolor='none', ls=':')
-    ax[0][1].add_patch(rect)
-    fig.colorbar(pos, ax=ax[0][1])
-    ff_roi = ff[roi]
-    pos = ax[1][0].imshow(ff_roi, extent=[xmin, xmax, ymax, ymin])
-
-    ax[1][0].axvline(x=com_x, color='black', linestyle=':')
-    ax[1][0].axhline(y=com_y, color='black', linestyle=':')
-    ax[1][0].set_title('Median frame ROI')
-    fig.colorbar(pos, ax=ax[1][0])
-    ax[1][1].plot(np.arange(xmin, xmax),
-                  ff_roi[round(com_y-ymin), :], label='horizontal')
-    ax[1][1].plot(np.arange(ymin, ymax),
-                  ff_roi[:, round(com_x-xmin)], label='vertical')
-    ax[1][1].grid(True)
-    ax[1][1].legend(loc="upper right")
-    ax[1][1].set_title('Lineout through the center of ROI')
-
-    bottom_notes = 'COM y = %d x = %d ROI y = %d:%d x = %d:%d. ' % (
-        com_y, com_x, ymin, ymax, xmin, xmax)
-    bottom_notes += 'Area above threshold (%d) = %d px. ' % (
-        ff_low_limit, (ff_roi > ff_low_limit).sum())
-    plt.figtext(0.05, 0.05, bottom_notes, fontsize=10, ha='left')
-
-    try:
-        plt.savefig(report_fname)
-        print("\nReport saved succesfully!!!")
-    except IOError:
-        pass
-
-    plt.savefig(report_fname)
-    try:
-        if(not args.quiet):
-            plt.show()
-    except:
-        pass
-
-    print("done")
     return roi
 
 
-def cxd_to_h5(filename_cxd,  bg, ff, roi, good_pixels, W, do_percent_filter, filt_percent, filt_frames, cropping, minx, maxx, miny, maxy, skip_raw = False):
+def guess_ROIs(ff, ff_low_limit, roi_fraction, n_spots):
+    """
+    ROIs of the n_spots brightest beam spots on the flatfield and the ROI that contains all of them.
+    """
+    if(ff is None):
+        print("Cannot guess ROIs: flat field information missing!")
+        return [], (slice(None), slice(None))
+
+    rois = spts.calibration.find_rois(ff, ff_low_limit, roi_fraction, n_spots)
+    for i, (ymin, ymax, xmin, xmax) in enumerate(rois):
+        print("Spot %d: y = %d:%d x = %d:%d" % (i, ymin, ymax, xmin, xmax))
+    if len(rois) == 0:
+        return rois, (slice(None), slice(None))
+    R = np.asarray(rois)
+    ymin, xmin = R[:, 0].min(), R[:, 2].min()
+    ymax, xmax = R[:, 1].max(), R[:, 3].max()
+    print("Auto cropping to y = %d:%d x = %d:%d" % (ymin, ymax, xmin, xmax))
+    return rois, (slice(int(ymin), int(ymax), None), slice(int(xmin), int(xmax), None))
+
+
+def _correct_frame(frame, roi, good_pixels_roi, bg_corr):
+    # bg_corr: float32 background of the ROI (or None)
+    image_raw = frame[roi]*good_pixels_roi
+    image_bgcor = None
+    if(bg_corr is not None):
+        image_bgcor = ((image_raw.astype(np.float32) -
+                        bg_corr).astype(np.float32))*good_pixels_roi
+    return image_raw, image_bgcor
+
+
+class TemporalPercentileFilter:
+    """
+    Percentile filter along the frame axis of a movie with N frames that gives the same result as
+    scipy.ndimage.percentile_filter(movie, percentile, size=(size, 1, 1)) (mode "reflect") but only needs the frames
+    of one block plus size-1 neighbouring frames at a time.
+    """
+    def __init__(self, percentile, size, N):
+        self.size = size
+        self.N = N
+        # Rank of the percentile as defined by scipy.ndimage.percentile_filter
+        if percentile < 0:
+            percentile += 100
+        if percentile < 0 or percentile > 100:
+            raise ValueError("Invalid percentile %s" % str(percentile))
+        if percentile == 100:
+            self.rank = size - 1
+        else:
+            self.rank = int(float(size) * percentile / 100.0)
+        # Window of frame i: i-size//2, ..., i-size//2+size-1
+        self._offset = size // 2
+
+    def _get_indices(self, i0, i1):
+        # Frame indices of all windows of frames i0, ..., i1-1, reflected at the ends of the movie
+        j = np.arange(i0 - self._offset, i1 - self._offset + self.size - 1) % (2 * self.N)
+        return np.where(j < self.N, j, 2 * self.N - 1 - j)
+
+    def get_range(self, i0, i1):
+        """
+        Return the range of frames (start, stop) that is needed for filtering the frames i0, ..., i1-1.
+        """
+        j = self._get_indices(i0, i1)
+        return j.min(), j.max() + 1
+
+    def filter(self, frames, start, i0, i1):
+        """
+        Return the filtered frames i0, ..., i1-1. frames holds the frames of the range returned by get_range.
+        """
+        j = self._get_indices(i0, i1) - start
+        out = np.empty(shape=(i1-i0,)+frames.shape[1:], dtype=frames.dtype)
+        for k in range(i1-i0):
+            out[k] = np.partition(frames[j[k:k+self.size]], self.rank, axis=0)[self.rank]
+        return out
+
+
+def _read_block(R, N, i0, block_length, rows, pfilter):
+    # Frames i0, ..., i0+block_length-1 and the frames needed for filtering them, only the given rows are read
+    i1 = min([i0+block_length, N])
+    if pfilter is None:
+        return i0, R.get_frames(i0, i1, rows=rows), None
+    start, stop = pfilter.get_range(i0, i1)
+    start, stop = min([start, i0]), max([stop, i1])
+    frames = R.get_frames(start, stop, rows=rows)
+    return i0, frames[i0-start:i1-start], (start, frames)
+
+
+def _correct_block(i0, frames, context, roi, good_pixels_roi, bg_corr, pfilter):
+    if pfilter is not None:
+        start, frames_context = context
+        filtered = pfilter.filter(frames_context[(slice(None),)+roi]*good_pixels_roi, start, i0, i0+len(frames))
+    results = []
+    for k, frame in enumerate(frames):
+        if pfilter is not None:
+            bg_corr = filtered[k].astype(np.float32)
+        image_raw, image_bgcor = _correct_frame(frame, roi, good_pixels_roi, bg_corr)
+        image_bgcor_f16 = image_bgcor.astype(np.float16) if image_bgcor is not None else None
+        results.append((image_raw, image_bgcor, np.asarray(image_raw, dtype='float32'), image_bgcor_f16))
+    return results
+
+
+def _get_block_layout(R, roi, good_pixels_roi, pfilter):
+    """
+    Return the number of frames per block and the number of blocks that may be in the pipeline at the same time, such
+    that the frames read (with the context of the percentile filter) and their corrected images fit into
+    PIPELINE_NBYTES.
+    """
+    ny = len(range(*roi[0].indices(R.get_frame_shape(0)[0])))
+    roi_pixels = int(good_pixels_roi.size)
+    read_nbytes = ny * R.get_frame_shape(0)[1] * R.get_frame_dtype(0).itemsize
+    # Raw image (with the dtype of the product with good_pixels), float32 raw and corrected image, float16 image
+    raw_itemsize = np.result_type(R.get_frame_dtype(0), good_pixels_roi.dtype).itemsize
+    out_nbytes = roi_pixels * (raw_itemsize + 4 + 4 + 2)
+    block_length = max([1, min([BLOCK_LENGTH, BLOCK_NBYTES // max([1, read_nbytes + out_nbytes])])])
+    context = pfilter.size - 1 if pfilter is not None else 0
+    block_nbytes = (block_length + context) * read_nbytes + block_length * out_nbytes
+    return block_length, max([1, PIPELINE_NBYTES // block_nbytes])
+
+
+def _iter_corrected_blocks(R, N, roi, good_pixels_roi, bg_corr, pfilter, n_threads):
+    """
+    Yield the corrected frames block by block in order. With n_threads > 1 one thread reads blocks of frames ahead and
+    a pool of n_threads threads corrects them. Only the rows of the ROI are read, and the number of blocks that are
+    read but not yet handed over is bounded such that the pipeline needs at most about PIPELINE_NBYTES of memory.
+    """
+    block_length, max_blocks = _get_block_layout(R, roi, good_pixels_roi, pfilter)
+    # Frames are cropped to the rows of the ROI when they are read
+    rows = roi[0]
+    roi = (slice(None), roi[1])
+    if n_threads <= 1 or max_blocks == 1:
+        for i0 in range(0, N, block_length):
+            yield _correct_block(*_read_block(R, N, i0, block_length, rows, pfilter), roi, good_pixels_roi, bg_corr, pfilter)
+        return
+
+    blocks = queue.Queue()
+    # A slot is taken before a block is read and given back after it was handed over
+    slots = threading.Semaphore(max_blocks)
+    stop = threading.Event()
+
+    def read():
+        try:
+            for i0 in range(0, N, block_length):
+                while not slots.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+                if stop.is_set():
+                    return
+                blocks.put(_read_block(R, N, i0, block_length, rows, pfilter))
+            blocks.put(None)
+        except Exception as e:
+            blocks.put(e)
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    pending = collections.deque()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min([n_threads, max_blocks])) as pool:
+            while True:
+                item = blocks.get()
+                if isinstance(item, Exception):
+                    raise item
+                if item is not None:
+                    pending.append(pool.submit(_correct_block, *item, roi, good_pixels_roi, bg_corr, pfilter))
+                # Hand over the oldest block once enough are in flight (or all remaining at the end)
+                while len(pending) > 0 and (item is None or len(pending) >= min([n_threads, max_blocks]) or pending[0].done()):
+                    results = pending.popleft().result()
+                    yield results
+                    del results
+                    slots.release()
+                if item is None:
+                    break
+    finally:
+        stop.set()
+        reader.join()
+
+
+def cxd_to_h5(filename_cxd,  bg, ff, roi, good_pixels, W, do_percent_filter, filt_percent, filt_frames, cropping, minx, maxx, miny, maxy, skip_raw = False, n_threads = 1):
     print("*************************************")
     print("*   Particle conversion section     *")
     print("*************************************")
@@ -351,23 +296,11 @@ def cxd_to_h5(filename_cxd,  bg, ff, roi, good_pixels, W, do_percent_filter, fil
         good_pixels = np.ones_like(frame)
 
     N = R.get_number_of_frames()
-    shape = (N, frame[roi].shape[0], frame[roi].shape[1])
 
+    pfilter = None
     if(do_percent_filter):
-        four_gigabytes = 4*(1 << 30)
-        if np.prod(shape)*frame.dtype.itemsize > four_gigabytes:
-            gigs = np.prod(shape)*np.dtype(np.float16).itemsize/(1 << 30)
-            print(
-                "Warning: reading data for percentile filter will require more than %.1fG of RAM!" % gigs)
-
-        print("Calculating percentile filter...", end='')
-        data_stack = np.zeros(shape, dtype=frame.dtype)  # percent_filter stack
-        for i in range(N):
-            frame = R.get_frame(i)
-            data_stack[i] = frame[roi]*good_pixels[roi]
-        filtered_stack = percentile_filter(
-            data_stack, filt_percent, size=(filt_frames, 1, 1))
-        print('done.')
+        # The filter runs block by block on the frames that are being converted
+        pfilter = TemporalPercentileFilter(filt_percent, filt_frames, N)
 
     # Initialise integration variables
     integrated_raw = None
@@ -375,57 +308,51 @@ def cxd_to_h5(filename_cxd,  bg, ff, roi, good_pixels, W, do_percent_filter, fil
     integratedsq_raw = None
     integratedsq_image = None
 
-    # Write frames
-    for i in range(N):
-
-        frame = R.get_frame(i)
-
-        bg_corr = None
-        if(do_percent_filter):
-            # Replace background with percentile filter
-            # Applying both a constant background correction after a percentile filter is redundant
-            bg_corr = filtered_stack[i]
-        elif(bg is not None):
-            bg_corr = bg[roi]
-
-        print('(%d/%d) Writing frames...' % (i+1, N), end='\r')
-
-        frame = R.get_frame(i)
-        image_raw = frame[roi]*good_pixels[roi]
-
-        out = {}
-        out["entry_1"] = {}
-
-        # Raw data
-        if(not skip_raw):
-            out["entry_1"]["data_1"] = {"data": image_raw}
-
-        # Background-subtracted image
-        if(bg_corr is not None):
-            image_bgcor = ((image_raw.astype(np.float32) -
-                           bg_corr.astype(np.float32)).astype(np.float32))*good_pixels[roi]
-            # Save corrected data as float16 to save on space
-            out["entry_1"]["image_1"] = {"data": image_bgcor.astype(np.float16)}
-
-        # Write to disc
-        W.write_slice(out)
-
-        if integrated_raw is None:
-            integrated_raw = np.zeros(shape=image_raw.shape, dtype='float32')
-        if integratedsq_raw is None:
-            integratedsq_raw = np.zeros(shape=image_raw.shape, dtype='float32')
-        integrated_raw += np.asarray(image_raw, dtype='float32')
-        integratedsq_raw += np.asarray(image_raw, dtype='float32')**2
-
-        if(bg_corr is not None):
-            if integrated_image is None:
-                integrated_image = np.zeros(
-                    shape=image_bgcor.shape, dtype='float32')
-            if integratedsq_image is None:
-                integratedsq_image = np.zeros(
-                    shape=image_bgcor.shape, dtype='float32')
-            integrated_image += image_bgcor
-            integratedsq_image += np.asarray(image_bgcor, dtype='f')**2
+    # With the percentile filter the background is replaced frame by frame by the filtered frames
+    # Applying both a constant background correction after a percentile filter is redundant
+    bg_corr = None
+    if(not do_percent_filter and bg is not None):
+        bg_corr = bg[roi].astype(np.float32)
+
+    # Write frames (in order) while the following blocks are read and corrected
+    i = 0
+    for results in _iter_corrected_blocks(R, N, roi, good_pixels[roi], bg_corr, pfilter, n_threads):
+        for image_raw, image_bgcor, image_raw_f32, image_bgcor_f16 in results:
+
+            print('(%d/%d) Writing frames...' % (i+1, N), end='\r')
+
+            out = {}
+            out["entry_1"] = {}
+
+            # Raw data
+            if(not skip_raw):
+                out["entry_1"]["data_1"] = {"data": image_raw}
+
+            # Background-subtracted image
+            if(image_bgcor is not None):
+                # Save corrected data as float16 to save on space
+                out["entry_1"]["image_1"] = {"data": image_bgcor_f16}
+
+            # Write to disc
+            W.write_slice(out)
+
+            if integrated_raw is None:
+                integrated_raw = np.zeros(shape=image_raw.shape, dtype='float32')
+            if integratedsq_raw is None:
+                integratedsq_raw = np.zeros(shape=image_raw.shape, dtype='float32')
+            integrated_raw += image_raw_f32
+            integratedsq_raw += image_raw_f32**2
+
+            if(image_bgcor is not None):
+                if integrated_image is None:
+                    integrated_image = np.zeros(
+                        shape=image_bgcor.shape, dtype='float32')
+                if integratedsq_image is None:
+                    integratedsq_image = np.zeros(
+                        shape=image_bgcor.shape, dtype='float32')
+                integrated_image += image_bgcor
+                integratedsq_image += image_bgcor**2
+            i += 1
     # Print newline
     print('(%d/%d) Writing frames...done.' % (N, N))
     # Write integrated images
@@ -457,40 +384,6 @@ def cxd_to_h5(filename_cxd,  bg, ff, roi, good_pixels, W, do_percent_filter, fil
     # Close readers
     R.close()
 
-    # Make a small report
-    report_fname = filename_cxd[:-4]+"_report.pdf"
-    print("Writing report to %s..." % (report_fname), end='')
-
-    fig, ax = plt.subplots(2, 2, figsize=(20, 14))
-    if bg is not None:
-        pos = ax[0][0].imshow(bg[roi])
-        ax[0][0].set_title('Background')
-        fig.colorbar(pos, ax=ax[0][0])
-    if ff is not None:
-        pos = ax[1][0].imshow(ff[roi])
-        ax[1][0].set_title('Flatfield')
-        fig.colorbar(pos, ax=ax[1][0])
-    if integrated_raw is not None:
-        pos = ax[0][1].imshow(integrated_raw)
-        ax[0][1].set_title('Integrated Raw')
-        fig.colorbar(pos, ax=ax[0][1])
-    if integrated_image is not None:
-        pos = ax[1][1].imshow(integrated_image)
-        ax[1][1].set_title('Integrated Image')
-        fig.colorbar(pos, ax=ax[1][1])
-
-    try:
-        plt.savefig(report_fname)
-        print("\nReport saved succesfully!!!")
-    except IOError:
-        pass
-
-    try:
-        if(not args.quiet):
-            plt.show()
-    except:
-        pass
-
     print("done.")
 
 
@@ -512,8 +405,10 @@ if __name__ == "__main__":
 
     parser.add_argument('-rl', '--roi-low-limit', type=int,
                         help='Miminum intensity threshold for ROI calculations from flatfield.', default=10)
-    parser.add_argument('-rf', '--roi-fraction', type=int,
+    parser.add_argument('-rf', '--roi-fraction', type=float,
                         help='Fraction of intensity above threshold to include in ROI.', default=0.999)
+    parser.add_argument('--roi-spots', type=int,
+                        help='Number of beam spots on the flatfield. With more than one spot the ROI of every spot is stored and the data are cropped to the region containing all of them.', default=1)
 
     parser.add_argument('-m', '--percentile-filter', action='store_true',
                         help='Apply a percentile filter to output images.')
@@ -537,16 +432,30 @@ if __name__ == "__main__":
     parser.add_argument('-s', '--skip-raw', action='store_true',
                         help='Skip saving the raw data, instead linking to processed data')
     parser.add_argument('-q', '--quiet', action='store_true',
-                        help="Don't show plots interactively")
+                        help="Don't show plots interactively (no effect, reports are never shown)")
+    parser.add_argument('--report', action='store_true',
+                        help='Render the PDF reports in a background process after the conversion (see also render_reports.py).')
+    parser.add_argument('--bad-pixel-threshold', type=float,
+                        help='Pixels with a background above the median level plus this many standard deviations are marked as bad.', default=6.)
+    parser.add_argument('--calibration-dir', type=str,
+                        help='Directory of the cached background and flatfield estimates (default: next to the CXD files).', default=None)
+    spts.writer.add_layout_arguments(parser)
+    parser.add_argument('-t', '--threads', type=int,
+                        help='Number of threads correcting frames (reading and writing run on their own threads).', default=os.cpu_count())
 
     args = parser.parse_args()
 
+    store = spts.calibration.CalibrationStore(args.calibration_dir)
     bg, bg_std, good_pixels = estimate_background(
-        args.background_filename, args.bg_frames_max, args.filename)
+        args.background_filename, args.bg_frames_max, args.filename, store, args.bad_pixel_threshold)
     ff, ff_std = estimate_flatfield(
-        args.flatfield_filename, args.ff_frames_max, bg, good_pixels)
-    roi = guess_ROI(ff, args.flatfield_filename,
-                    args.roi_low_limit, args.roi_fraction)
+        args.flatfield_filename, args.ff_frames_max, bg, good_pixels, store)
+    rois = None
+    if args.roi_spots > 1:
+        rois, roi = guess_ROIs(ff, args.roi_low_limit, args.roi_fraction, args.roi_spots)
+    else:
+        roi = guess_ROI(ff, args.flatfield_filename,
+                        args.roi_low_limit, args.roi_fraction)
 
     if(args.filename is None):
         sys.exit(0)
@@ -562,18 +471,26 @@ if __name__ == "__main__":
         f_out = args.filename[:-4] + ".cxi"
 
     # Initialise output CXI file
-    W = h5writer.H5Writer(f_out)
+    W = spts.writer.H5Writer(f_out, **spts.writer.get_layout_kwargs(args))
 
     cxd_to_h5(args.filename, bg, ff, roi, good_pixels, W, args.percentile_filter, args.percentile_number,
-              args.percentile_frames, args.crop_raw, args.min_x, args.max_x, args.min_y, args.max_y, args.skip_raw)
+              args.percentile_frames, args.crop_raw, args.min_x, args.max_x, args.min_y, args.max_y, args.skip_raw, args.threads)
 
     # Write out information on the command used
     out = {"entry_1": {"process_1": {}}}
-    out["entry_1"]["process_1"] = {"command": str(sys.argv)}
-    out["entry_1"]["process_1"] = {"cwd": str(os.getcwd())}
+    out["entry_1"]["process_1"] = {"command": str(sys.argv), "cwd": str(os.getcwd()), "roi_low_limit": args.roi_low_limit}
+    if rois is not None and len(rois) > 0:
+        # ROIs of the spots (ymin, ymax, xmin, xmax) in full frame coordinates
+        out["entry_1"]["image_1"] = {"rois": np.asarray(rois)}
     W.write_solo(out)
     # Close CXI file
     W.close()
     if args.skip_raw:
         h5py.File(f_out,'r+')['entry_1']['data_1']['data'] = h5py.SoftLink('/entry_1/image_1/data')
+    if args.layout_report:
+        for line in spts.writer.format_layout_report(spts.writer.get_layout_report(f_out, W.get_stats())):
+            print(line)
         
+    if args.report:
+        print("Rendering reports in the background")
+        spts.report.render_reports_in_background([f_out] + store.paths)
@@ -1,24 +1,49 @@
 #!/usr/bin/env python
 import h5py, numpy
 import argparse
+import os
+import logging
+
+import spts
+import spts.integrate
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Integrate stack of 2D arrays saved in h5 dataset')
     parser.add_argument('filename', type=str, help='filename')
     parser.add_argument('dataset', type=str, help='dataset')
+    parser.add_argument('-o', '--output', type=str, help='output filename', default="sum.h5")
+    parser.add_argument('--start', type=int, help='first frame', default=0)
+    parser.add_argument('--stop', type=int, help='stop before this frame (default: last frame)', default=None)
+    parser.add_argument('-m', '--mask', type=str, help='mask file (e.g. written by make_simple_mask.py), pixels that are False are set to 0', default=None)
+    parser.add_argument('--mask-dataset', type=str, help='dataset of the mask', default="/data")
+    parser.add_argument('-p', '--percentile', type=float, action='append', help='percentile (0-100) image to compute, can be given several times', default=None)
+    parser.add_argument('--percentile-frames', type=int, help='maximum number of (evenly spaced) frames for the percentiles', default=256)
+    parser.add_argument('-j', '--processes', type=int, help='number of processes reading and integrating blocks of frames in parallel', default=1)
+    parser.add_argument('--threads', action='store_true', help='use threads instead of processes', default=False)
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', help='verbose mode', default=False)
     args = parser.parse_args()
 
-    with h5py.File(args.filename, "r") as f:
-        print(f.keys())
-        ds = f[args.dataset]
-        N = ds.shape[0]
-        sum = numpy.zeros(shape=(ds.shape[1],ds.shape[2]))
-        for i in range(N):
-            print("(%i/%i)" % (i+1,N))
-            sum += ds[i,:,:]
+    lvl = logging.INFO if args.verbose else logging.WARNING
+    spts.logger.setLevel(lvl)
+    logging.basicConfig(level=lvl)
+
+    mask = None
+    if args.mask is not None:
+        with h5py.File(args.mask, "r") as f:
+            mask = numpy.asarray(f[args.mask_dataset][()], dtype=bool)
+
+    out = spts.integrate.integrate_stack(args.filename, args.dataset, start=args.start, stop=args.stop, mask=mask,
+                                         percentiles=args.percentile, percentile_frames=args.percentile_frames,
+                                         n_workers=args.processes, threads=args.threads)
 
-    with h5py.File("sum.h5", "w") as f:
-        f["data"] = sum
-    
-        
-        
+    with h5py.File(args.output, "w") as f:
+        # /data is the sum (as in earlier versions)
+        f["data"] = out.pop("sum")
+        f["sum"] = h5py.SoftLink("/data")
+        for k, v in out.items():
+            f[k] = v
+        if mask is not None:
+            f["mask"] = mask
+        f.attrs["filename"] = os.path.abspath(args.filename)
+        f.attrs["dataset"] = args.dataset
+    print("Integrated %i frames (%i:%i) of %s, saved to %s" % (out["n_frames"], out["start"], out["stop"], args.dataset, args.output))
@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+import argparse
+import os
+import logging
+
+import spts
+import spts.report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Render the PDF reports of CXI files (written by cxd_to_h5) and of background/flatfield calibration files')
+    parser.add_argument('filenames', type=str, nargs='+',
+                        help='CXI and/or calibration files')
+    parser.add_argument('-j', '--processes', type=int,
+                        help='Number of processes rendering reports in parallel.', default=os.cpu_count())
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', help='verbose mode', default=False)
+    args = parser.parse_args()
+
+    lvl = logging.INFO if args.verbose else logging.WARNING
+    spts.logger.setLevel(lvl)
+    logging.basicConfig(level=lvl)
+
+    reports = spts.report.render_all_reports(args.filenames, args.processes)
+    for fn in sorted(reports):
+        print("Report saved to %s" % fn)
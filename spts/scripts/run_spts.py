@@ -2,6 +2,7 @@
 import argparse
 import os, sys, shutil
 import time
+import signal
 
 import socket
 
@@ -13,19 +14,30 @@ logger = spts.logger
 
 import spts.config
 import spts.worker
+import spts.profiling
+import spts.writer
+import spts.parallel
 
 # Add SPTS stream handler to other loggers
 import h5writer 
 
-from mulpro import mulpro
+def _terminate(signum, frame):
+    # SLURM sends SIGTERM when the time limit is reached, the output is closed as incomplete and can be resumed
+    raise SystemExit("Terminated by signal %i" % signum)
 
 if __name__ == "__main__":
     __spec__ = None
     parser = argparse.ArgumentParser(description='Mie scattering imaging data analysis')
     parser.add_argument('-v', '--verbose', dest='verbose',  action='store_true', help='verbose mode', default=False)
     parser.add_argument('-d', '--debug', dest='debug',  action='store_true', help='debugging mode (even more output than in verbose mode)', default=False)
-    parser.add_argument('-c','--cores', type=int, help='number of cores', default=1)
+    parser.add_argument('-c','--cores', type=int, help='number of worker processes (outputs are written by the main process)', default=1)
     parser.add_argument('-m','--mpi', dest='mpi', action='store_true', help='mpi processes = reader(s) + writer', default=False)
+    parser.add_argument('-b','--batch-size', dest='batch_size', type=int, help='number of consecutive frames processed per work package', default=1)
+    parser.add_argument('-p','--profile', dest='profile', action='store_true', help='measure time (and memory) spent in every stage, write summary to output file and spts_profile.json', default=False)
+    parser.add_argument('--profile-memory', dest='profile_memory', action='store_true', help='also trace peak memory allocation in every stage (slow)', default=False)
+    parser.add_argument('--resume', dest='resume', action='store_true', help='continue an interrupted run after the frames committed to spts.cxi', default=False)
+    parser.add_argument('--checkpoint-interval', dest='checkpoint_interval', type=float, help='seconds between updates of the number of frames committed to the output file', default=spts.writer.CHECKPOINT_SECONDS)
+    spts.writer.add_layout_arguments(parser)
     args = parser.parse_args()
 
     if not os.path.exists("./spts.conf"):
@@ -45,42 +57,105 @@ if __name__ == "__main__":
 
     if args.mpi and args.cores > 1:
         parser.error("Specifying cores > 1 is only permitted when not running with MPI. ")
+    if args.mpi and args.resume:
+        parser.error("Resuming is only permitted when not running with MPI. ")
+    if args.profile_memory:
+        args.profile = True
+    # With several cores every worker process has its own profiler
+    P = spts.profiling.StageProfiler(trace_memory=args.profile_memory) if args.profile and args.cores == 1 else None
     
     if args.mpi:
         import mpi4py
         comm = mpi4py.MPI.COMM_WORLD
         is_worker = comm.rank > 0
-        H = h5writer.H5WriterMPISW("./spts.cxi", comm=comm, chunksize=100, compression=None)
+        # Workers claim blocks of frames on demand, created before the writer because rank 0 does not return from its constructor before the end
+        S = spts.parallel.MPIBlockScheduler(comm)
+        H = spts.writer.H5WriterMPISW("./spts.cxi", comm=comm, chunksize=100, **spts.writer.get_layout_kwargs(args))
         if is_worker:
-            W = spts.worker.Worker(conf, i0_offset=comm.rank-1, step_size=comm.size-1)
+            W = spts.worker.Worker(conf, batch_size=args.batch_size, profiler=P, scheduler=S)
     else:
         is_worker = True
-        H = h5writer.H5Writer("./spts.cxi")
-        W = spts.worker.Worker(conf)
+        i_start = None
+        if args.resume:
+            status, n = spts.writer.get_output_status("./spts.cxi")
+            if status in ["complete", None]:
+                log_info(logger, "Output file spts.cxi is complete, nothing to resume.")
+                sys.exit(0)
+            if status == "incomplete" and n > 0:
+                i_start = conf["general"]["i0"] + spts.writer.get_resume_position("./spts.cxi", conf["general"]["i0"])
+                log_info(logger, "Resume at frame %i" % i_start)
+        H = spts.writer.H5Writer("./spts.cxi", resume=i_start is not None, checkpoint_seconds=args.checkpoint_interval, **spts.writer.get_layout_kwargs(args))
+        signal.signal(signal.SIGTERM, _terminate)
+        if args.cores == 1:
+            W = spts.worker.Worker(conf, batch_size=args.batch_size, profiler=P, i_start=i_start)
 
     if is_worker:
-        if args.cores > 1:
-            mulpro.mulpro(Nprocesses=args.cores-1, worker=W.work, getwork=W.get_work, logres=H.write_slice)
-        else:
-            while True:
-                t0 = time.time()
-                log_debug(logger, "Read work package (analysis)")
-                w = W.get_work()
-                if w is None:
-                    log_debug(logger, "No more images to process")
-                    break
-                log_debug(logger, "Start work")
-                l = W.work(w)
-                t1 = time.time()
-                t_work = t1-t0
-                t0 = time.time()
-                H.write_slice(l)
-                t1 = time.time()
-                t_write = t1-t0
-                log_info(logger, "work %.2f sec / write %.2f sec" % (t_work, t_write))            
+        try:
+            if args.cores > 1:
+                results = spts.parallel.run_parallel(conf, args.cores, H.write_slice, batch_size=args.batch_size,
+                                                     profile=args.profile, trace_memory=args.profile_memory,
+                                                     worker_kwargs={"i_start": i_start})
+                io_stats = spts.parallel.sum_io_stats(results)
+                log_info(logger, "blocked on shared memory %.2f sec" % io_stats["time_blocked_ring"])
+            else:
+                while True:
+                    t0 = time.time()
+                    log_debug(logger, "Read work package (analysis)")
+                    w = W.get_work()
+                    if w is None:
+                        log_debug(logger, "No more images to process")
+                        break
+                    log_debug(logger, "Start work")
+                    if args.batch_size > 1:
+                        ls = W.work_batch(w)
+                    else:
+                        ls = [W.work(w)]
+                    t1 = time.time()
+                    t_work = t1-t0
+                    t0 = time.time()
+                    for l in ls:
+                        H.write_slice(l)
+                    t1 = time.time()
+                    t_write = t1-t0
+                    log_info(logger, "work %.2f sec / write %.2f sec" % (t_work, t_write))            
+                io_stats = W.get_io_stats()
+                W.close()
+        except (KeyboardInterrupt, SystemExit):
+            if not args.mpi:
+                H.close(complete=False)
+                log_warning(logger, "Interrupted, %i frames committed to spts.cxi (continue with --resume)" % H.n_frames_committed)
+            raise
+        log_info(logger, "read %.1f MB in %.2f sec / blocked on reading %.2f sec" % (io_stats["bytes_read"]/1.E6, io_stats["time_read"], io_stats["time_blocked"]))
+        if args.mpi:
+            # Throughput of every rank
+            schedule = S.get_stats()
+            schedule.update(io_stats)
+            log_info(logger, "rank %i: %i frames in %i blocks (%.1f Hz)" % (comm.rank, schedule["n_frames"], schedule["n_blocks"], schedule["frames_per_second"]))
+            H.write_solo({"schedule": {"rank_%i" % comm.rank: schedule}})
+        if args.profile and args.cores > 1:
+            # One summary per worker process
+            for rank, r in enumerate(results):
+                spts.profiling.log_summary(r["profile"])
+                spts.profiling.write_json(r["profile"], "./spts_profile_worker_%i.json" % rank)
+                H.write_solo({"profile": {"worker_%i" % rank: r["profile"]}})
+        if P is not None:
+            P.log_summary()
+            # One summary per worker process
+            if args.mpi:
+                P.write_json("./spts_profile_rank_%i.json" % comm.rank)
+                H.write_solo({"profile": {"rank_%i" % comm.rank: P.get_summary()}})
+            else:
+                P.write_json("./spts_profile.json")
+                H.write_solo({"profile": P.get_summary()})
 
     H.write_solo({'__version__': spts.__version__})
     H.close()
+    if args.mpi:
+        S.free()
+
+    if args.layout_report and (not args.mpi or comm.rank == 0):
+        for line in spts.writer.format_layout_report(spts.writer.get_layout_report("./spts.cxi", H.get_stats())):
+            log_info(logger, line)
 
     log_info(logger, "SPTS - Clean exit.")
                 
@@ -1,17 +1,18 @@
 #!/usr/bin/env python 
 import numpy as np
 import argparse
-import os, sys, shutil
+import os, sys, shutil, copy
 import time
 import socket
 import pandas as pd
 import spts.config
 import spts.worker
+import spts.writer
+import spts.batch
 import h5py
 
 # Add SPTS stream handler to other loggers
 import h5writer
-import concurrent.futures
 import logging
 
 # Add the parent directory to the sys.path
@@ -24,42 +25,6 @@ import utils.log_book as log_book
 original_level = logging.getLogger().level
 logging.basicConfig(level=original_level)  # Set initial logging level
 
-def tong_spts_ana(args, conf, out_file, silent = False):
-    if silent:  # Suppress all logging output
-        original_level = logging.getLogger().level
-        logging.getLogger().setLevel(logging.CRITICAL)
-
-    is_worker = True
-    H = h5writer.H5Writer(out_file)
-    W = spts.worker.Worker(conf)
-
-    if is_worker:
-        while True:
-            t0 = time.time()
-            #print("Read work package (analysis)")
-            w = W.get_work()
-            if w is None:
-                #print("No more images to process")
-                break
-            #print("Start work")
-            l = W.work(w)
-            t1 = time.time()
-            t_work = t1-t0
-            t0 = time.time()
-            H.write_slice(l)
-            t1 = time.time()
-            t_write = t1-t0
-            #print("work %.2f sec / write %.2f sec" % (t_work, t_write))            
-
-    H.write_solo({'__version__': spts.__version__})
-    H.close()
-
-    #print("SPTS - Clean exit.")
-
-    if silent:
-        logging.info("This will not appear in the console.")
-        logging.getLogger().setLevel(original_level)
-
 def get_args():
     parser = argparse.ArgumentParser(description='Mie scattering imaging data analysis')
     parser.add_argument('-dp', '--directory', type=str, help='directory for input', default=None)
@@ -72,9 +37,11 @@ def get_args():
     parser.add_argument('-wd', '--window_size', type=int, help='window width, pixel limits', default=None)
     parser.add_argument('-v', '--verbose', dest='verbose',  action='store_true', help='verbose mode', default=False)
     parser.add_argument('-d', '--debug', dest='debug',  action='store_true', help='debugging mode (even more output than in verbose mode)', default=False)
-    parser.add_argument('-c','--cores', type=int, help='number of cores', default=1)
+    parser.add_argument('-c','--cores', type=int, help='number of worker processes shared by all files (default: all cores)', default=None)
+    parser.add_argument('-b','--batch-size', dest='batch_size', type=int, help='number of consecutive frames processed per work package', default=1)
     parser.add_argument('-m','--mpi', dest='mpi', action='store_true', help='mpi processes = reader(s) + writer', default=False)
     parser.add_argument('-ow','--overwrite', type=bool, help='Standard False, if True overwrites file if found in folder', default=False)
+    parser.add_argument('--resume', dest='resume', action='store_true', help='continue incomplete output files of interrupted runs instead of starting them again', default=False)
     
     args = parser.parse_args()
 
@@ -176,40 +143,56 @@ def prepare_save_directory(args, file, conf, log):
 
     return out_file
 
-def run_process(args, file, conf, log, silent=False):
-
-    print("Processing file: ", file)
-
-    conf = prepare_config(conf, args, file, log)
+def prepare_job(args, file, conf, log):
+    """
+    Return the job (see spts.batch.run_batch) for a file, or None if the file does not have to be processed.
+    """
+    # Every file has its own copy of the settings (as if processed on its own)
+    args = copy.copy(args)
+    conf = prepare_config(copy.deepcopy(conf), args, file, log)
     out_file = prepare_save_directory(args, file, conf, log)
 
     # Check if the output file already exists
+    resume = False
     if os.path.exists(out_file):
         if args.overwrite:
             print(f"Overwriting file {out_file}.")
             os.remove(out_file)
-        else:
+        elif spts.writer.is_output_complete(out_file):
+            # Output files are marked as incomplete until the analysis is finished
             print(f"File {out_file} already exists. Skipping processing.")
-            return
+            return None
+        elif args.resume:
+            resume = True
+        else:
+            print(f"File {out_file} is incomplete. Processing again.")
+            os.remove(out_file)
         
     # Check if the input HDF5 file is valid
     input_file_path = conf['general']['filename']
     if not is_hdf5_file_valid(input_file_path):
         print(f"Input file {input_file_path} is corrupted or invalid. Skipping processing.")
-        return
-    
-    if silent:  # Suppress all logging output
-        original_level = logging.getLogger().level
-        logging.getLogger().setLevel(logging.CRITICAL)
+        return None
+
+    return {"file": file, "conf": conf, "out_file": out_file, "resume": resume,
+            "conf_file": args.save_directory + "conf/spts_" + file[:-4] + ".conf"}
 
-    tong_spts_ana(args, conf, out_file, silent)
+def save_job(job):
+    spts.config.write_configfile(job["conf"], job["conf_file"])
+    print("Saved file: ", job["file"])
 
-    if silent:
-        logging.info("This will not appear in the console.")
-        logging.getLogger().setLevel(original_level)
+def run_jobs(args, jobs):
+    # Frames of all files are split into work units that are shared by a pool of worker processes
+    spts.batch.run_batch(jobs, n_processes=args.cores, batch_size=args.batch_size, on_done=save_job,
+                         on_error=lambda job, exc: print(f"Processing of {job['file']} generated an exception: {exc}"))
 
-    spts.config.write_configfile(conf, args.save_directory + "conf/spts_" + file[:-4] + ".conf")
-    print("Saved file: ", file)
+def run_process(args, file, conf, log):
+
+    print("Processing file: ", file)
+
+    job = prepare_job(args, file, conf, log)
+    if job is not None:
+        run_jobs(args, [job])
 
 def prepare_config(conf, args, file, log):
     
@@ -241,28 +224,18 @@ def run_spts_auto():
     files_to_do = log_book.get_cxi2do(args, log)
     conf = spts.config.read_configfile(args.config_file)
 
-    #run_process(args, files_to_do[0], conf, log)
-
-    start_time = time.time()
-    iter_time = 0
-
-    #wait for 10secs
-    time.sleep(6)
     print(files_to_do)
 
-    #iterate through files_to_do and process them
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        futures = [executor.submit(run_process, args, file, conf, log, silent=False) for file in files_to_do]
-        for i, future in enumerate(concurrent.futures.as_completed(futures)):
-            try:
-                future.result()
-                elapsed_time = time.time() - start_time
-                iter_time = elapsed_time / (i + 1)
-                remaining_files = len(files_to_do) - (i + 1)
-                eta = iter_time * remaining_files
-                print(f"Processed {i + 1}/{len(files_to_do)} files. ETA: {eta:.2f} seconds")
-            except Exception as exc:
-                print(f'Generated an exception: {exc}')
+    jobs = []
+    for file in files_to_do:
+        print("Preparing file: ", file)
+        job = prepare_job(args, file, conf, log)
+        if job is not None:
+            jobs.append(job)
+
+    start_time = time.time()
+    run_jobs(args, jobs)
+    print(f"Processed {len(jobs)} files in {time.time() - start_time:.2f} seconds.")
     if args.save_directory is not None:
         spts.config.write_configfile(conf, args.save_directory + "spts.conf")
             
@@ -1,3 +1,4 @@
+import contextlib
 import numpy as np
 import h5py
 
@@ -11,14 +12,29 @@ import spts.denoiser
 import spts.detect
 import spts.analysis
 import spts.threshold
+import spts.reader
+import spts.calibration
 
 class Worker:
-    def __init__(self, conf, i0_offset=0, pipeline_mode=False, data_mount_prefix="", step_size=1):
+    def __init__(self, conf, i0_offset=0, pipeline_mode=False, data_mount_prefix="", step_size=1, batch_size=1, profiler=None, scheduler=None, i_start=None):
         self.conf = conf
         self.data_mount_prefix = data_mount_prefix
         self.pipeline_mode = pipeline_mode
         self._i0_offset = i0_offset
         self._step_size = step_size
+        self._batch_size = batch_size
+        self._readers = {}
+        self._denoise_buffer = None
+        self._background = None
+        self._background_key = None
+        # Optional spts.profiling.StageProfiler that measures every stage
+        self.profiler = profiler
+        # Optional scheduler (e.g. spts.parallel.MPIBlockScheduler) handing out blocks of frames, replaces offset and step size
+        self.scheduler = scheduler
+        self._blocks = []
+        self._read_ahead_limit = None
+        # First frame (e.g. when a run is resumed), the range of frames still ends as if starting from i0
+        self._i_start = i_start if i_start is not None else conf["general"]["i0"]
         self.i = None
         self.update()
 
@@ -26,18 +42,21 @@ class Worker:
         if not hasattr(self, 'denoiser') or not is_same_dicts(self.conf["denoise"], self.denoiser.denoise_dict):
             method = self.conf["denoise"]["method"]
             if method == "gauss":
-                self.denoiser = spts.denoiser.DenoiserGauss(sigma=self.conf["denoise"]["sigma"])
+                self.denoiser = spts.denoiser.DenoiserGauss(sigma=self.conf["denoise"]["sigma"], workers=self.conf["denoise"].get("workers", 1))
             elif method == "gauss2":
-                self.denoiser = spts.denoiser.DenoiserGauss2(sigma=self.conf["denoise"]["sigma"])
+                self.denoiser = spts.denoiser.DenoiserGauss2(sigma=self.conf["denoise"]["sigma"], workers=self.conf["denoise"].get("workers", 1))
             elif method == "histogram":
-                images_bg = self._read_image(self.dataset_name, np.float64, self.conf["denoise"].get("n_histogram", 100))
+                # Background statistics from the first frames, processed in the same way as the images that are denoised
+                n_bg = min([self.conf["denoise"].get("n_histogram", 100), self.N_arr])
+                images_bg = [self._load_data(i, self.conf["process"]["dataset_name"], self.conf["process"]["subtract_constant"], self.conf["process"]["cmcx"], self.conf["process"]["cmcy"], background=self._get_background())[0] for i in range(n_bg)]
                 self.denoiser = spts.denoiser.DenoiserHistogram(window_size=self.conf["denoise"]["window_size"],
                                                                images_bg=images_bg,
                                                                vmin=self.conf["denoise"].get("vmin", -20),
                                                                vmax=self.conf["denoise"].get("vmax", 20),
                                                                dx=self.conf["denoise"].get("dx", 1),
                                                                vmin_full=self.conf["denoise"].get("vmin_full", -50),
-                                                               vmax_full=self.conf["denoise"].get("vmax_full", 255))
+                                                               vmax_full=self.conf["denoise"].get("vmax_full", 255),
+                                                               workers=self.conf["denoise"].get("workers", 1))
             else:
                 print("ERROR: Method %s is not implemented" % method)
                 return
@@ -54,17 +73,91 @@ class Worker:
             print("ERROR: Do not use function get_work in pipeline mode!")
             return
 
+        if self.scheduler is not None:
+            return self._get_scheduled_work()
+
+        # In batch mode offset and step size count blocks of frames instead of single frames
         if self.i is None:
-            i = self._i0_offset + self.conf["general"]["i0"]
+            i = self._i0_offset * self._batch_size + self._i_start
         else:
-            i = self.i + self._step_size
+            i = self.i + self._step_size * self._batch_size
             
         if self._is_valid_i(i):
             self.i = i
             work_package = {"i": i}
+            if self._batch_size > 1:
+                work_package["n"] = self._get_batch_length(i)
             return work_package
         else:
             return None
+
+    def _get_scheduled_work(self):
+        if self.i is None:
+            self._blocks = [self._claim_block()]
+        elif self._blocks[0] is None:
+            return None
+        elif self.i + self._get_package_length(self.i) < self._blocks[0][1]:
+            self.i = self.i + self._get_package_length(self.i)
+            return self._get_package(self.i)
+        else:
+            self._blocks.pop(0)
+        if self._blocks[0] is None:
+            return None
+        # The next block is claimed when the current one is started, such that the readers can prefetch it
+        self._blocks.append(self._claim_block())
+        self._read_ahead_limit = (self._blocks[0][1], None if self._blocks[1] is None else self._blocks[1][0])
+        for R in self._readers.values():
+            R.set_read_ahead_limit(*self._read_ahead_limit)
+        self.i = self._blocks[0][0]
+        return self._get_package(self.i)
+
+    def _get_package(self, i):
+        work_package = {"i": i}
+        if self._batch_size > 1:
+            work_package["n"] = self._get_package_length(i)
+        return work_package
+
+    def _claim_block(self):
+        start, stop = self.get_frame_range()
+        return self.scheduler.next_block(start, stop, self.get_block_length())
+
+    def get_frame_range(self):
+        """
+        Return the first frame and the end (exclusive) of the range of frames to process.
+        """
+        return self._i_start, max([self._i_start, min([self.N_arr, self.conf["general"]["i0"] + self.N])])
+
+    def get_block_length(self):
+        """
+        Return the number of raw frames that are read at once, blocks start at multiples of the block length.
+        """
+        return self._get_reader(self.conf["raw"]["dataset_name"]).block_length
+
+    def get_output_nbytes(self):
+        """
+        Return an upper estimate of the number of bytes of the output of one frame, computed from the frame shape, the
+        maximum number of particles and the output level without processing any frame.
+        """
+        output_level = self.conf["general"]["output_level"]
+        R = self._get_reader(self.conf["raw"]["dataset_name"])
+        n_pixels = int(np.prod([len(range(*s.indices(n))) for s, n in zip(R.roi, R.shape[1:])]))
+        n_max = self.conf["detect"]["n_particles_max"]
+        nbytes = OUTPUT_SCALARS_NBYTES + sum([itemsize * n_pixels for itemsize, l in OUTPUT_IMAGES if l <= output_level])
+        nbytes += DETECT_PARTICLES.get_nbytes(n_max, output_level) + ANALYSE_PARTICLES.get_nbytes(n_max, output_level)
+        if output_level >= 3:
+            if self.conf["analyse"]["integration_mode"] == "windows":
+                s = self.conf["analyse"]["window_size"]
+            else:
+                s = spts.analysis.THUMBNAILS_WINDOW_SIZE_DEFAULT
+            nbytes += n_max * s * s * 8
+        return nbytes
+
+    def _get_package_length(self, i):
+        return min([self._batch_size, self._blocks[0][1] - i])
+
+    def _get_batch_length(self, i):
+        n = min([self._batch_size, self.N_arr - i, self.N - (i - self.conf["general"]["i0"])])
+        return max([n, 1])
             
     def work(self, work_package, tmp_package=None, out_package=None, target="analyse"):
 
@@ -87,27 +180,73 @@ class Worker:
         if out_package is None or W["i"] != out_package["i"]:
             out_package = {"i": i}
             
-        tmp = [("1_raw", self._work_raw),
-               ("2_process", self._work_process),
-               ("3_denoise", self._work_denoise),
-               ("4_threshold", self._work_threshold),
-               ("5_detect", self._work_detect),
-               ("6_analyse", self._work_analyse)]
-           
-        for work_name, work_func in tmp:
+        for work_name, work_func in self._get_stages():
             if not work_name in tmp_package:
                 log_info(logger, "(%i) Starting %s" % (i, work_name))
-                out_package, tmp_package = work_func(work_package, tmp_package, out_package)
+                with self._measure(work_name):
+                    out_package, tmp_package = work_func(work_package, tmp_package, out_package)
                 log_info(logger, "(%i) Done with %s" % (i, work_name))
             if work_name.endswith(target):
                 log_info(logger, "(%i) Reached target %s" % (i, work_name))
                 return out_package
         log_warning(logger, "(%i) Incorrect target defined (%s)" % (i, target))
         return out_package
+
+    def work_batch(self, work_package, target="analyse"):
+        """
+        Process the block of frames i, ..., i+n-1 described by the work package ({"i": i, "n": n}). Raw and processed
+        data are read in chunk-aligned blocks and every stage is run for all frames of the block before moving on to
+        the next stage. Returns a list with one output package per frame, each of which can be passed to
+        H5Writer.write_slice.
+        """
+        i0 = work_package["i"]
+        n = work_package.get("n", 1)
+        log_debug(logger, "(%i-%i) Start batch work" % (i0, i0+n-1))
+        if self.pipeline_mode:
+            self.update()
+
+        indices = [i for i in range(i0, i0+n) if self._is_valid_i(i)]
+        if len(indices) < n:
+            logger.warning("Invalid indices in block. Probably we reached the end of the processing range (i=%i, n=%i, N=%i, N_arr=%i)" % (i0, n, self.N, self.N_arr))
+        if len(indices) == 0:
+            return []
+
+        tmp_packages = [{"i": i} for i in indices]
+        out_packages = [{"i": i} for i in indices]
+        for work_name, work_func in self._get_stages():
+            log_info(logger, "(%i-%i) Starting %s" % (indices[0], indices[-1], work_name))
+            with self._measure(work_name, len(indices)):
+                if work_name == "3_denoise":
+                    # Denoise all frames of the block in one call
+                    images_denoised = self._denoise_stack([tmp_package["2_process"]["image"] for tmp_package in tmp_packages])
+                    for k, i in enumerate(indices):
+                        out_packages[k], tmp_packages[k] = work_func({"i": i}, tmp_packages[k], out_packages[k], image_denoised=images_denoised[k])
+                else:
+                    for k, i in enumerate(indices):
+                        out_packages[k], tmp_packages[k] = work_func({"i": i}, tmp_packages[k], out_packages[k])
+            log_info(logger, "(%i-%i) Done with %s" % (indices[0], indices[-1], work_name))
+            if work_name.endswith(target):
+                log_info(logger, "(%i-%i) Reached target %s" % (indices[0], indices[-1], work_name))
+                return out_packages
+        log_warning(logger, "(%i-%i) Incorrect target defined (%s)" % (indices[0], indices[-1], target))
+        return out_packages
+
+    def _measure(self, work_name, n_frames=1):
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.measure(work_name, n_frames)
+
+    def _get_stages(self):
+        return [("1_raw", self._work_raw),
+                ("2_process", self._work_process),
+                ("3_denoise", self._work_denoise),
+                ("4_threshold", self._work_threshold),
+                ("5_detect", self._work_detect),
+                ("6_analyse", self._work_analyse)]
         
     def _work_raw(self, work_package, tmp_package, out_package):
         i = work_package["i"]
-        O = OutputCollector()
+        O = OutputCollector(self.conf["general"]["output_level"], self.pipeline_mode)
         # Read raw data
         image_raw, saturation_mask = self._load_data(i, self.conf["raw"]["dataset_name"], self.conf["raw"]["subtract_constant"], self.conf["raw"].get("cmcx", False), self.conf["raw"].get("cmcy", False), saturation_level=self.conf["raw"]["saturation_level"])
 
@@ -118,15 +257,15 @@ class Worker:
         O.add("saturated_n_pixels", saturated_n_pixels, 0)
         success = (saturated_n_pixels == 0) or not self.conf["raw"]["skip_saturated_frames"]
         O.add("success", success, 0, pipeline=True)          
-        out_package["1_raw"] = O.get_dict(self.conf["general"]["output_level"], self.pipeline_mode)
-        tmp_package["1_raw"] = O.get_dict(5, True)
+        out_package["1_raw"] = O.get_dict()
+        tmp_package["1_raw"] = O.get_all()
         return out_package, tmp_package
             
     def _work_process(self, work_package, tmp_package, out_package):
         i = work_package["i"]
-        O = OutputCollector()
+        O = OutputCollector(self.conf["general"]["output_level"], self.pipeline_mode)
         # Read processed data
-        image, foo = self._load_data(i, self.conf["process"]["dataset_name"], self.conf["process"]["subtract_constant"], self.conf["process"]["cmcx"], self.conf["process"]["cmcy"])
+        image, foo = self._load_data(i, self.conf["process"]["dataset_name"], self.conf["process"]["subtract_constant"], self.conf["process"]["cmcx"], self.conf["process"]["cmcy"], background=self._get_background())
         if self.conf["process"]["floor_cut_level"] is not None:
             sel = image<self.conf["process"]["floor_cut_level"]
             if sel.sum() > 0:
@@ -135,29 +274,39 @@ class Worker:
         O.add("image", image, 2, pipeline=True)
         success = True
         O.add("success", success, 0, pipeline=True)        
-        out_package["2_process"] = O.get_dict(self.conf["general"]["output_level"], self.pipeline_mode)
-        tmp_package["2_process"] = O.get_dict(5, True)
+        out_package["2_process"] = O.get_dict()
+        tmp_package["2_process"] = O.get_all()
         return out_package, tmp_package
 
-    def _work_denoise(self, work_package, tmp_package, out_package):
+    def _work_denoise(self, work_package, tmp_package, out_package, image_denoised=None):
         i = work_package["i"]
-        O = OutputCollector()
+        O = OutputCollector(self.conf["general"]["output_level"], self.pipeline_mode)
         image = tmp_package["2_process"]["image"]
 
-        # Denoise
-        log_info(logger, "(%i/%i) Denoise image" % (i+1, self.N_arr))
-        self._update_denoiser()
-        image_denoised = self.denoiser.denoise_image(image, full_output=True)
+        # Denoise (unless already done for the whole block)
+        if image_denoised is None:
+            log_info(logger, "(%i/%i) Denoise image" % (i+1, self.N_arr))
+            self._update_denoiser()
+            image_denoised = self.denoiser.denoise_image(image, full_output=True)
         O.add("image_denoised", np.asarray(image_denoised, dtype=np.float16), 4, pipeline=True)
         success = True
         O.add("success", success, 0, pipeline=True)        
-        out_package["3_denoise"] = O.get_dict(self.conf["general"]["output_level"], self.pipeline_mode)
-        tmp_package["3_denoise"] = O.get_dict(5, True)
+        out_package["3_denoise"] = O.get_dict()
+        tmp_package["3_denoise"] = O.get_all()
         return out_package, tmp_package
         
+    def _denoise_stack(self, images):
+        self._update_denoiser()
+        stack = np.asarray(images)
+        # The output buffer is reused from block to block
+        if self._denoise_buffer is None or self._denoise_buffer.shape != stack.shape:
+            self._denoise_buffer = None
+        self._denoise_buffer = self.denoiser.denoise_stack(stack, out=self._denoise_buffer)
+        return self._denoise_buffer
+
     def _work_threshold(self, work_package, tmp_package, out_package):
         i = work_package["i"]
-        O = OutputCollector()
+        O = OutputCollector(self.conf["general"]["output_level"], self.pipeline_mode)
 
         image_denoised = tmp_package["3_denoise"]["image_denoised"]
 
@@ -167,13 +316,13 @@ class Worker:
         O.add("thresholded_n_pixels", thresholded_n_pixels, 0)
         success = thresholded_n_pixels > 0
         O.add("success", success, 0, pipeline=True)        
-        out_package["4_threshold"] = O.get_dict(self.conf["general"]["output_level"], self.pipeline_mode)
-        tmp_package["4_threshold"] = O.get_dict(5, True)
+        out_package["4_threshold"] = O.get_dict()
+        tmp_package["4_threshold"] = O.get_all()
         return out_package, tmp_package
 
     def _work_detect(self, work_package, tmp_package, out_package):
         i = work_package["i"]
-        O = OutputCollector()
+        O = OutputCollector(self.conf["general"]["output_level"], self.pipeline_mode)
         image_denoised = tmp_package["3_denoise"]["image_denoised"]
         image_thresholded = tmp_package["4_threshold"]["image_thresholded"]
 
@@ -187,36 +336,23 @@ class Worker:
         n_labels = len(i_labels)
         success = success and (n_labels > 0) and (n_labels <= n_max)
         log_info(logger, "(%i/%i) Found %i particles" % (i+1, self.N_arr, n_labels))
+        particles = DETECT_PARTICLES.new_record(n_max)
         if success:
             O.add("n", n_labels, 0, pipeline=True)
-            O.add("x", uniform_particle_array(x, n_max), 0, pipeline=True)
-            O.add("y", uniform_particle_array(y, n_max), 0, pipeline=True)
-            O.add("peak_score", uniform_particle_array(score, n_max), 0, pipeline=False)
-            O.add("area", uniform_particle_array(area, n_max, np.int32), 0)
-            O.add("merged", uniform_particle_array(merged, n_max, np.int16), 0, pipeline=True)
-            O.add("dist_neighbor", uniform_particle_array(dist_neighbor, n_max), 0)
-            O.add("i_labels", uniform_particle_array(i_labels, n_max), 5, pipeline=True)
+            set_particle_values(particles, x=x, y=y, peak_score=score, area=area, merged=merged, dist_neighbor=dist_neighbor, i_labels=i_labels, dislocation=dislocation)
             O.add("image_labels", image_labels, 5, pipeline=True)
-            O.add("dislocation", uniform_particle_array(dislocation, n_max), 0, pipeline=False)
         else:
             O.add("n", 0, 0, pipeline=True)
-            O.add("x", uniform_particle_array([], n_max), 0, pipeline=True)
-            O.add("y", uniform_particle_array([], n_max), 0, pipeline=True)
-            O.add("peak_score", uniform_particle_array([], n_max), 0, pipeline=False)            
-            O.add("area", uniform_particle_array([], n_max, np.int32), 0)
-            O.add("merged", uniform_particle_array([], n_max, np.int16), 0, pipeline=True)
-            O.add("dist_neighbor", uniform_particle_array([], n_max), 0)
-            O.add("i_labels", uniform_particle_array([], n_max), 5, pipeline=True)
-            O.add("image_labels", np.zeros_like(image_thresholded), 5, pipeline=True)
-            O.add("dislocation", uniform_particle_array([], n_max), 0, pipeline=False)
+            O.add("image_labels", np.zeros(image_thresholded.shape, dtype=np.int32), 5, pipeline=True)
+        DETECT_PARTICLES.add_to(O, particles)
         O.add("success", success, 0, pipeline=True)        
-        out_package["5_detect"] = O.get_dict(self.conf["general"]["output_level"], self.pipeline_mode)
-        tmp_package["5_detect"] = O.get_dict(5, True)
+        out_package["5_detect"] = O.get_dict()
+        tmp_package["5_detect"] = O.get_all()
         return out_package, tmp_package
 
     def _work_analyse(self, work_package, tmp_package, out_package):
         i = work_package["i"]
-        O = OutputCollector()
+        O = OutputCollector(self.conf["general"]["output_level"], self.pipeline_mode)
         saturation_mask = tmp_package["1_raw"]["saturation_mask"] 
         image_processed = tmp_package["2_process"]["image"]
 
@@ -244,16 +380,11 @@ class Worker:
         log_info(logger, "(%i/%i) Analyse image at %i particle positions" % (i, self.N_arr, len(i_labels)))
         #if n_labels > self.n_particles_max:
         #    log_warning(logger, "(%i/%i) Too many particles (%i/%i) - skipping analysis for %i particles" % (i_image+1, self.N_arr, n_labels, self.n_particles_max, n_labels - self.n_particles_max))
-        O.add("peak_success", uniform_particle_array(peak_sum, n_max, bool, vinit=False), 0)
-        O.add("peak_sum", uniform_particle_array(peak_sum, n_max), 0, pipeline=True)
-        O.add("peak_mean", uniform_particle_array(peak_mean, n_max), 0)
-        O.add("peak_median", uniform_particle_array(peak_median, n_max), 0)
-        O.add("peak_min", uniform_particle_array(peak_min, n_max), 0)
-        O.add("peak_max", uniform_particle_array(peak_max, n_max), 0)
-        O.add("peak_size", uniform_particle_array(peak_size, n_max), 0)
-        O.add("peak_eccentricity", uniform_particle_array(peak_eccentricity, n_max), 0, pipeline=True)
-        O.add("peak_circumference", uniform_particle_array(peak_circumference, n_max), 0)
-        O.add("peak_saturated", uniform_particle_array(peak_saturated, n_max, np.int8, vinit=0), 0)
+        particles = ANALYSE_PARTICLES.new_record(n_max)
+        # peak_success flags particles with a non-zero sum
+        set_particle_values(particles, peak_success=peak_sum, peak_sum=peak_sum, peak_mean=peak_mean, peak_median=peak_median, peak_min=peak_min, peak_max=peak_max,
+                            peak_size=peak_size, peak_eccentricity=peak_eccentricity, peak_circumference=peak_circumference, peak_saturated=peak_saturated)
+        ANALYSE_PARTICLES.add_to(O, particles)
         if success:
             if self.conf["analyse"]["integration_mode"] == "windows":
                 s = self.conf["analyse"]["window_size"]
@@ -266,13 +397,13 @@ class Worker:
         if masked_image is not None and success:
             O.add("masked_image", np.asarray(masked_image), 3, pipeline=True)            
         else:
-            O.add("masked_image", np.zeros(shape=image.shape), 3, pipeline=True)
+            O.add("masked_image", np.zeros(shape=image_processed.shape), 3, pipeline=True)
         O.add("success", success, 0, pipeline=True)
-        out_package["6_analyse"] = O.get_dict(self.conf["general"]["output_level"], self.pipeline_mode)
-        tmp_package["6_analyse"] = O.get_dict(5, True)
+        out_package["6_analyse"] = O.get_dict()
+        tmp_package["6_analyse"] = O.get_all()
         return out_package, tmp_package
 
-    def _load_data(self, i, dataset_name, subtract_constant, xcmc, ycmc, saturation_level=None):
+    def _load_data(self, i, dataset_name, subtract_constant, xcmc, ycmc, saturation_level=None, background=None):
         # Load data from file at index "i"
         image = self._read_image(i, dataset_name, dtype=np.float32)
         if saturation_level is not None:
@@ -281,6 +412,8 @@ class Worker:
             saturation_mask = None
         if subtract_constant is not None:
             image -= subtract_constant
+        if background is not None:
+            image -= background
         if xcmc:
             med = np.median(image, axis=1)
             med_image = np.repeat(med, image.shape[1]).reshape(image.shape[0], image.shape[1])
@@ -291,6 +424,27 @@ class Worker:
             image -= np.asarray(med_image, dtype=image.dtype)
         return image, saturation_mask 
 
+    def _get_background(self):
+        # Per-pixel background of the processed images from a CXD file, shared with cxd_to_h5 through the calibration store
+        fn = self.conf["process"].get("background_filename")
+        if fn is None:
+            return None
+        n_frames = self.conf["process"].get("background_frames", 100)
+        bad_pixel_threshold = self.conf["process"].get("bad_pixel_threshold", 6.)
+        roi = (slice(self.conf["raw"]["ymin"], self.conf["raw"]["ymax"]), slice(self.conf["raw"]["xmin"], self.conf["raw"]["xmax"]))
+        key = (fn, n_frames, bad_pixel_threshold, self._get_full_filename(), roi)
+        if self._background_key != key:
+            store = spts.calibration.CalibrationStore(self.conf["process"].get("calibration_dir"))
+            bg = spts.calibration.get_background(fn, n_frames, bad_pixel_threshold, store=store)["bg"]
+            # Frames converted by cxd_to_h5 are cropped to the ROI that is stored in the file
+            with h5py.File(self._get_full_filename(), "r") as f:
+                if "/entry_1/image_1/roi" in f:
+                    ymin, ymax, xmin, xmax = [int(v) for v in f["/entry_1/image_1/roi"][()]]
+                    bg = bg[ymin:ymax, xmin:xmax]
+            self._background = np.asarray(bg[roi], dtype=np.float32)
+            self._background_key = key
+        return self._background
+
     def _get_full_filename(self): 
         if len(self.data_mount_prefix) == 0: 
             fn = self.conf["general"]["filename"]
@@ -298,44 +452,122 @@ class Worker:
             fn = "%s/%s" % (self.data_mount_prefix, self.conf["general"]["filename"])
         return fn
         
-    def _read_image(self, i, dataset_name, dtype=None, N=1):
+    def _get_reader(self, dataset_name):
+        # One open reader per dataset for the lifetime of the worker, replaced if file or ROI change
         fn = self._get_full_filename()
-        with h5py.File(fn, "r") as f:
-            if dataset_name not in f:
-                raise IOError("Cannot find dataset %s in %s." % (dataset_name, fn))
-            xmin = self.conf["raw"]["xmin"] if self.conf["raw"]["xmin"] is not None else 0
-            xmax = self.conf["raw"]["xmax"] if self.conf["raw"]["xmax"] is not None else Nx
-            ymin = self.conf["raw"]["ymin"] if self.conf["raw"]["ymin"] is not None else 0
-            ymax = self.conf["raw"]["ymax"] if self.conf["raw"]["ymax"] is not None else Ny
-            if N == 1:
-                return np.asarray(f[dataset_name][i,ymin:ymax,xmin:xmax], dtype=dtype)
-            else:
-                return np.asarray(f[dataset_name][i:i+N,ymin:ymax,xmin:xmax], dtype=dtype)
+        roi = (slice(self.conf["raw"]["ymin"], self.conf["raw"]["ymax"]), slice(self.conf["raw"]["xmin"], self.conf["raw"]["xmax"]))
+        R = self._readers.get(dataset_name)
+        if R is None or R.filename != fn or R.roi != roi:
+            if R is not None:
+                R.close()
+            R = spts.reader.H5FrameReader(fn, dataset_name, roi=roi, read_ahead=not self.pipeline_mode)
+            if self._read_ahead_limit is not None:
+                R.set_read_ahead_limit(*self._read_ahead_limit)
+            self._readers[dataset_name] = R
+        return R
+
+    def _read_image(self, i, dataset_name, dtype=None, N=1):
+        return self._get_reader(dataset_name).read(i, N=N, dtype=dtype)
+
+    def get_io_stats(self):
+        """
+        Return the number of bytes read, the time spent reading and the time spent waiting for reads, summed over
+        all datasets.
+        """
+        stats = {"bytes_read": 0, "time_read": 0., "time_blocked": 0.}
+        for R in self._readers.values():
+            for k, v in R.get_stats().items():
+                stats[k] += v
+        return stats
+
+    def close(self):
+        for R in self._readers.values():
+            R.close()
+        self._readers = {}
 
     def update(self):
-        fn = self._get_full_filename()
-        with h5py.File(fn, "r") as f:
-            self.N_arr = f[self.conf["raw"]["dataset_name"]].shape[0]  
+        # The file may still be growing (e.g. while it is converted), the readers reopen it to see new frames
+        for R in self._readers.values():
+            R.refresh()
+        self.N_arr = self._get_reader(self.conf["raw"]["dataset_name"]).shape[0]
         if self.conf["general"]["n_images"] is None or self.conf["general"]["n_images"] > 0:
             self.N = self.N_arr
         else:
             self.N = self.conf["general"]["n_images"]
             
 
-def uniform_particle_array(v, n_max, dtype=np.float64, vinit=-1):
-    n = min([n_max,len(v)])
-    A = np.zeros(n_max, dtype=dtype)
-    A[:] = vinit
-    for i in range(n):
-        if v[i] is not None:
-            A[i] = v[i]
-    return A
+class ParticleSchema:
+    """
+    Layout of the per-particle outputs of a stage. Every field is an array of length n_particles_max with a fixed dtype,
+    output level and pipeline flag. All fields of a frame are stored in one record that is allocated at once by copying
+    a prefilled template.
+    """
+    def __init__(self, fields):
+        # fields: list of (name, dtype, initial value, output level, pipeline)
+        self.fields = fields
+        self._templates = {}
+
+    def new_record(self, n_max):
+        T = self._templates.get(n_max)
+        if T is None:
+            T = np.zeros((), dtype=[(name, dtype, (n_max,)) for name, dtype, vinit, output_level, pipeline in self.fields])
+            for name, dtype, vinit, output_level, pipeline in self.fields:
+                T[name] = vinit
+            self._templates[n_max] = T
+        return T.copy()
+
+    def get_nbytes(self, n_max, output_level):
+        return sum([np.dtype(dtype).itemsize * n_max for name, dtype, vinit, l, pipeline in self.fields if l <= output_level])
+
+    def add_to(self, O, record):
+        # Fields are added as (contiguous) views of the record
+        for name, dtype, vinit, output_level, pipeline in self.fields:
+            O.add(name, record[name], output_level, pipeline=pipeline)
+
+# Bytes per pixel and output level of the images in the output of a frame (raw image, saturation mask, processed
+# image, denoised image, thresholded image, labels, masked image)
+OUTPUT_IMAGES = [(4, 5), (1, 5), (4, 2), (2, 4), (1, 3), (4, 5), (8, 3)]
+# Bytes of the scalars (index, success flags and counts) in the output of a frame
+OUTPUT_SCALARS_NBYTES = 128
 
+DETECT_PARTICLES = ParticleSchema([("x", np.float64, -1, 0, True),
+                                   ("y", np.float64, -1, 0, True),
+                                   ("peak_score", np.float64, -1, 0, False),
+                                   ("area", np.int32, -1, 0, False),
+                                   ("merged", np.int16, -1, 0, True),
+                                   ("dist_neighbor", np.float64, -1, 0, False),
+                                   ("i_labels", np.float64, -1, 5, True),
+                                   ("dislocation", np.float64, -1, 0, False)])
+
+ANALYSE_PARTICLES = ParticleSchema([("peak_success", bool, False, 0, False),
+                                    ("peak_sum", np.float64, -1, 0, True),
+                                    ("peak_mean", np.float64, -1, 0, False),
+                                    ("peak_median", np.float64, -1, 0, False),
+                                    ("peak_min", np.float64, -1, 0, False),
+                                    ("peak_max", np.float64, -1, 0, False),
+                                    ("peak_size", np.float64, -1, 0, False),
+                                    ("peak_eccentricity", np.float64, -1, 0, True),
+                                    ("peak_circumference", np.float64, -1, 0, False),
+                                    ("peak_saturated", np.int8, 0, 0, False)])
+
+def set_particle_values(record, **values):
+    # Values beyond the length of the record are dropped
+    for name, v in values.items():
+        A = record[name]
+        n = min([len(A), len(v)])
+        A[:n] = np.asarray(v[:n])
 
 class OutputCollector:
-    
-    def __init__(self):
+    """
+    Items of a stage with their output levels and pipeline flags. Items are sorted into the output dictionary
+    (output_level and pipeline of the collector) when they are added, such that no dictionary needs to be filtered
+    afterwards.
+    """
+    def __init__(self, output_level=0, pipeline=False):
+        self.output_level = output_level
+        self.pipeline = pipeline
         self._D = {}
+        self._D_out = {}
         self._D_output_level = {}
         self._D_pipeline = {}
 
@@ -343,6 +575,10 @@ class OutputCollector:
         self._D[name] = item
         self._D_output_level[name] = output_level
         self._D_pipeline[name] = pipeline
+        if output_level <= self.output_level or (pipeline and self.pipeline):
+            self._D_out[name] = item
+        else:
+            self._D_out.pop(name, None)
         
     def exists(self, name):
         return name in self._D
@@ -350,7 +586,16 @@ class OutputCollector:
     def get(self, name):
         return self._D[name]
         
-    def get_dict(self, output_level=0, pipeline=False):
+    def get_dict(self, output_level=None, pipeline=None):
+        """
+        Return the items up to output_level (and the pipeline items if pipeline is True), by default those of the
+        output level and pipeline flag of the collector. The returned dictionary is not a copy and is not the one
+        returned by get_all.
+        """
+        output_level = self.output_level if output_level is None else output_level
+        pipeline = self.pipeline if pipeline is None else pipeline
+        if output_level == self.output_level and pipeline == self.pipeline:
+            return self._D_out
         O = {}
         for k in self._D_output_level.keys():
             l = self._D_output_level[k]
@@ -358,6 +603,12 @@ class OutputCollector:
             if l <= output_level or (p and pipeline):
                 O[k] = self._D[k]
         return O
+
+    def get_all(self):
+        """
+        Return all items. The returned dictionary is not a copy.
+        """
+        return self._D
     
 
 def is_same_dicts(d1, d2):
@@ -0,0 +1,352 @@
+import os, time
+import numpy as np
+import h5py
+import h5writer
+import h5writer.h5writer
+
+import logging
+logger = logging.getLogger(__name__)
+
+import spts.log
+from spts.log import log_and_raise_error,log_warning,log_info,log_debug
+
+COMPRESSIONS = ["none", "lzf", "gzip"]
+
+# The number of frames that are safely on disk (n_frames_committed) is updated after this many frames or seconds
+CHECKPOINT_FRAMES = 1000
+CHECKPOINT_SECONDS = 60.
+
+# Number of frames at the end of the committed range that are read back before a run is resumed
+VERIFY_FRAMES = 10
+
+class _LayoutMixin:
+    """
+    Chunk shape and compression of the stacks written by h5writer.
+
+    chunk_frames:      Number of frames per chunk for stacks of images (2D or more per frame). 1 gives fast random
+                       access to single frames, larger values suit streaming. None keeps the default of h5writer.
+                       Stacks of scalars and 1D arrays always use the default chunking of h5writer.
+    compression:       None, "lzf" or "gzip"
+    compression_opts:  Compression level for gzip (default 1)
+    shuffle:           Apply the byte shuffle filter before compression
+    """
+    def _init_layout(self, chunk_frames=None, compression=None, compression_opts=None, shuffle=False):
+        if compression == "none":
+            compression = None
+        if compression is not None and compression not in COMPRESSIONS:
+            log_and_raise_error(logger, "Invalid compression %s (valid: %s)" % (compression, ", ".join(COMPRESSIONS)))
+        if compression == "gzip" and compression_opts is None:
+            compression_opts = 1
+        self._chunk_frames = chunk_frames
+        self._compression = compression
+        self._compression_opts = compression_opts
+        self._shuffle = shuffle
+        self._datasets = {}
+        self.bytes_written = 0
+        self.time_write = 0.
+
+    def _create_dataset(self, data, name):
+        data = np.asarray(data)
+        try:
+            h5py.h5t.py_create(data.dtype, logical=1)
+        except TypeError:
+            log_and_raise_error(logger, "Could not save dataset %s. Conversion to numpy array failed" % (name))
+            return 1
+        if data.nbytes == 0:
+            log_and_raise_error(logger, "Could not save dataset %s. Dataset is empty" % (name))
+            return 1
+        maxshape = tuple([None]+list(data.shape))
+        shape = tuple([self._stack_length]+list(data.shape))
+        dtype = data.dtype
+        kwargs = {}
+        if dtype.kind in "SU":
+            dtype = h5py.special_dtype(vlen=str)
+        elif self._compression is not None:
+            kwargs["compression"] = self._compression
+            if self._compression_opts is not None:
+                kwargs["compression_opts"] = self._compression_opts
+        if self._shuffle and "compression" in kwargs:
+            kwargs["shuffle"] = True
+        if self._chunk_frames is not None and data.ndim >= 2:
+            chunksize = self._chunk_frames
+        elif np.prod(shape) * dtype.itemsize > h5writer.h5writer.CHUNKSIZE_MIN_IN_BYTES:
+            chunksize = self._chunksize
+        else:
+            chunksize = int(np.ceil(float(h5writer.h5writer.CHUNKSIZE_MIN_IN_BYTES) / float(data.nbytes)))
+        chunksize = min([chunksize, h5writer.h5writer.CHUNKSIZE_MAX_IN_FRAMES])
+        chunks = tuple([chunksize]+list(data.shape))
+        # Frames are written one by one, the chunk that is being filled has to stay in the cache
+        kwargs["rdcc_nbytes"] = max([1<<20, 2 * int(np.prod(chunks)) * dtype.itemsize])
+        kwargs["rdcc_w0"] = 1.
+        ndim = data.ndim
+        axes = "experiment_identifier"
+        if ndim == 1: axes = axes + ":x"
+        elif ndim == 2: axes = axes + ":y:x"
+        elif ndim == 3: axes = axes + ":z:y:x"
+        log_debug(logger, "Create dataset %s [shape=%s, chunks=%s, dtype=%s, %s]" % (name, str(shape), str(chunks), str(dtype), str(kwargs)))
+        # The handle is kept open so that the chunk cache is not dropped between writes
+        self._datasets[name] = self._f.create_dataset(name, shape, maxshape=maxshape, dtype=dtype, chunks=chunks, **kwargs)
+        self._f[name].attrs.modify("axes", [np.bytes_(axes)])
+        return 0
+
+    def _write_group(self, D, group_prefix="/"):
+        if group_prefix != "/":
+            # Sub groups are measured as part of the top level group
+            return super()._write_group(D, group_prefix)
+        t0 = time.time()
+        super()._write_group(D, group_prefix)
+        self.time_write += time.time() - t0
+        self.bytes_written += _get_nbytes(D)
+
+    def get_stats(self):
+        """
+        Return the number of (uncompressed) bytes written as slices and the time spent writing them.
+        """
+        return {"bytes_written": self.bytes_written, "time_write": self.time_write}
+
+
+class H5Writer(_LayoutMixin, h5writer.H5Writer):
+    """
+    h5writer.H5Writer with configurable chunking and compression.
+
+    The file is marked as incomplete (attribute spts_status) until it is closed. The number of slices that have been
+    flushed to disk (attribute n_frames_committed) is updated every checkpoint_frames frames or checkpoint_seconds
+    seconds. With resume=True an incomplete file of an interrupted run is reopened and the next slice is written after
+    the committed ones (see resume_position).
+    """
+    def __init__(self, filename, chunksize=100, chunk_frames=None, compression=None, compression_opts=None, shuffle=False,
+                 resume=False, checkpoint_frames=CHECKPOINT_FRAMES, checkpoint_seconds=CHECKPOINT_SECONDS):
+        self._init_layout(chunk_frames, compression, compression_opts, shuffle)
+        self._checkpoint_frames = checkpoint_frames
+        self._checkpoint_seconds = checkpoint_seconds
+        self._t_checkpoint = time.time()
+        self.n_frames_committed = 0
+        filename = os.path.expandvars(filename)
+        status, n = get_output_status(filename) if resume else (None, 0)
+        if status == "incomplete" and n > 0:
+            h5writer.h5writer.AbstractH5Writer.__init__(self, filename, chunksize=chunksize, compression=None)
+            self._reopen()
+        else:
+            if resume:
+                log_warning(logger, "Cannot resume %s (status: %s, %i frames committed), starting from the beginning" % (filename, str(status), n))
+            h5writer.H5Writer.__init__(self, filename, chunksize=chunksize)
+            self._f.attrs["spts_status"] = "incomplete"
+            self._f.attrs["n_frames_committed"] = 0
+
+    def _reopen(self):
+        n = verify_output(self._filename)
+        rdcc_nbytes = 1<<20
+        with h5py.File(self._filename, "r") as f:
+            stacks = _get_stacks(f)
+            for name in stacks:
+                ds = f[name]
+                rdcc_nbytes = max([rdcc_nbytes, 2 * int(np.prod(ds.chunks)) * ds.dtype.itemsize])
+            self._stack_length = min([f[name].shape[0] for name in stacks])
+        self._f = h5py.File(self._filename, "r+", rdcc_nbytes=rdcc_nbytes, rdcc_w0=1.)
+        self._initialised = True
+        self._i = n - 1
+        self._i_max = n - 1
+        self.n_frames_committed = n
+        log_info(logger, "Resume writing to %s after %i committed frames" % (self._filename, n))
+
+    @property
+    def resume_position(self):
+        """
+        Number of slices in the file that are kept, writing continues with the slice after them.
+        """
+        return self._i_max + 1
+
+    def write_slice(self, data_dict):
+        h5writer.H5Writer.write_slice(self, data_dict)
+        # The first checkpoint makes the file readable with all datasets created
+        if (self.n_frames_committed == 0) or (self._i_max + 1 - self.n_frames_committed >= self._checkpoint_frames) or (time.time() - self._t_checkpoint >= self._checkpoint_seconds):
+            self.checkpoint()
+
+    def checkpoint(self):
+        """
+        Flush all slices written so far to disk and record their number in the file.
+        """
+        self._f.flush()
+        self._f.attrs["n_frames_committed"] = self._i_max + 1
+        self._f.flush()
+        self.n_frames_committed = self._i_max + 1
+        self._t_checkpoint = time.time()
+        log_debug(logger, "Checkpoint: %i frames committed to %s" % (self.n_frames_committed, self._filename))
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # A file that was not written to the end stays incomplete
+        self.close(complete=exc_type is None)
+
+    def close(self, complete=True):
+        """
+        Close the file. With complete=False the file stays marked as incomplete and can be resumed.
+        """
+        self._datasets = {}
+        self.n_frames_committed = self._i_max + 1
+        self._f.attrs["n_frames_committed"] = self.n_frames_committed
+        self._f.attrs["spts_status"] = "complete" if complete else "incomplete"
+        h5writer.H5Writer.close(self)
+
+
+class H5WriterMPISW(_LayoutMixin, h5writer.H5WriterMPISW):
+    """
+    h5writer.H5WriterMPISW with configurable chunking and compression. Note that the master process (rank 0) only
+    returns from the constructor after all other processes have closed the writer.
+    """
+    def __init__(self, filename, comm, chunksize=100, chunk_frames=None, compression=None, compression_opts=None, shuffle=False):
+        self._init_layout(chunk_frames, compression, compression_opts, shuffle)
+        h5writer.H5WriterMPISW.__init__(self, filename, comm=comm, chunksize=chunksize)
+
+    def _master_loop(self):
+        # Slices are written in order of arrival, there is no committed range that could be resumed
+        self._f.attrs["spts_status"] = "incomplete"
+        h5writer.H5WriterMPISW._master_loop(self)
+        self._datasets = {}
+        with h5py.File(self._filename, "r+") as f:
+            f.attrs["n_frames_committed"] = self._i_max + 1
+            f.attrs["spts_status"] = "complete"
+
+
+def _get_stacks(f):
+    stacks = []
+    def visit(name, obj):
+        if isinstance(obj, h5py.Dataset) and obj.ndim >= 1 and "axes" in obj.attrs:
+            stacks.append("/" + name)
+    f.visititems(visit)
+    return stacks
+
+def get_output_status(filename):
+    """
+    Return the status of an output file and the number of committed frames. The status is "complete", "incomplete"
+    (the run was interrupted or is still running), None for files written without status (by earlier versions), or
+    "invalid" if the file cannot be opened.
+    """
+    try:
+        with h5py.File(filename, "r") as f:
+            status = f.attrs.get("spts_status")
+            n = int(f.attrs.get("n_frames_committed", 0))
+    except (OSError, KeyError):
+        return "invalid", 0
+    if isinstance(status, bytes):
+        status = status.decode()
+    return status, n
+
+def is_output_complete(filename):
+    """
+    Return True if the output file exists, can be opened and was closed at the end of a run.
+    """
+    return get_output_status(filename)[0] in ["complete", None]
+
+def verify_output(filename, n_verify=VERIFY_FRAMES):
+    """
+    Check that all stacks of an incomplete output file hold the committed frames and that the last n_verify of them
+    can be read. Returns the number of committed frames.
+    """
+    status, n = get_output_status(filename)
+    if status != "incomplete":
+        log_and_raise_error(logger, "Cannot resume %s (status: %s)" % (filename, str(status)))
+    with h5py.File(filename, "r") as f:
+        stacks = _get_stacks(f)
+        if len(stacks) == 0:
+            log_and_raise_error(logger, "Cannot resume %s, the file contains no stacks" % filename)
+        for name in stacks:
+            ds = f[name]
+            if ds.shape[0] < n:
+                log_and_raise_error(logger, "Cannot resume %s, %s has %i frames but %i are committed" % (filename, name, ds.shape[0], n))
+            try:
+                ds[max([0, n - n_verify]):n]
+            except (OSError, RuntimeError) as e:
+                log_and_raise_error(logger, "Cannot resume %s, committed frames of %s cannot be read (%s)" % (filename, name, str(e)))
+    return n
+
+def get_resume_position(filename, i0):
+    """
+    Return the number of frames that an interrupted run committed to the output file. Raises an error if the frame
+    indices of the committed frames do not continue from i0.
+    """
+    n = verify_output(filename)
+    with h5py.File(filename, "r") as f:
+        if "i" in f and n > 0 and f["i"][n-1] != i0 + n - 1:
+            log_and_raise_error(logger, "Cannot resume %s, frame %i has index %i instead of %i (different configuration?)" % (filename, n-1, f["i"][n-1], i0 + n - 1))
+    return n
+
+def _get_nbytes(D):
+    n = 0
+    for v in D.values():
+        if isinstance(v, dict):
+            n += _get_nbytes(v)
+        else:
+            n += np.asarray(v).nbytes
+    return n
+
+
+def add_layout_arguments(parser):
+    """
+    Add the command line options for the output layout to an argparse parser.
+    """
+    parser.add_argument('--chunk-frames', dest='chunk_frames', type=int, default=None,
+                        help='Number of frames per chunk for image stacks (1: fast access to single frames; default: chunks of about 16 MB).')
+    parser.add_argument('--compression', dest='compression', choices=COMPRESSIONS, default="none",
+                        help='Lossless compression of the output datasets.')
+    parser.add_argument('--compression-level', dest='compression_level', type=int, default=None,
+                        help='Compression level for gzip (default 1).')
+    parser.add_argument('--shuffle', dest='shuffle', action='store_true', default=False,
+                        help='Apply the byte shuffle filter before compression.')
+    parser.add_argument('--layout-report', dest='layout_report', action='store_true', default=False,
+                        help='Report file size and read/write throughput of the output file.')
+
+def get_layout_kwargs(args):
+    """
+    Return the keyword arguments for the writer classes from the parsed command line options.
+    """
+    return {"chunk_frames": args.chunk_frames, "compression": args.compression,
+            "compression_opts": args.compression_level, "shuffle": args.shuffle}
+
+
+def get_layout_report(filename, stats=None, n_read=100, seed=0):
+    """
+    Measure size and read throughput of the largest stack in the file. The read throughput is measured for single
+    frames at random positions (as read by the GUI) and for all frames in order. If the writer statistics are given the
+    write throughput is reported as well.
+    """
+    R = {"file_size": os.path.getsize(filename)}
+    stacks = []
+    with h5py.File(filename, "r") as f:
+        def visit(name, obj):
+            if isinstance(obj, h5py.Dataset) and obj.ndim >= 1 and "axes" in obj.attrs:
+                stacks.append((obj.size * obj.dtype.itemsize, name))
+        f.visititems(visit)
+        R["data_size"] = sum([s for s, name in stacks])
+        R["compression_ratio"] = R["data_size"] / float(R["file_size"]) if R["file_size"] > 0 else 0.
+        if len(stacks) > 0:
+            nbytes, name = max(stacks)
+            ds = f[name]
+            R["dataset"] = name
+            R["chunks"] = ds.chunks
+            R["compression"] = ds.compression
+            N = ds.shape[0]
+            frame_nbytes = nbytes // N if N > 0 else 0
+            indices = np.random.default_rng(seed).integers(0, N, min([n_read, N])) if N > 0 else []
+            t0 = time.time()
+            for i in indices:
+                ds[i]
+            t = time.time() - t0
+            R["random_frames_per_second"] = len(indices) / t if t > 0 else 0.
+            t0 = time.time()
+            step = ds.chunks[0] if ds.chunks is not None else 1
+            for i in range(0, N, step):
+                ds[i:i+step]
+            t = time.time() - t0
+            R["sequential_read_MBps"] = nbytes / t / 1.E6 if t > 0 else 0.
+            R["frame_size"] = frame_nbytes
+    if stats is not None:
+        R["write_MBps"] = stats["bytes_written"] / stats["time_write"] / 1.E6 if stats["time_write"] > 0 else 0.
+    return R
+
+def format_layout_report(R):
+    lines = ["File size %.1f MB (data %.1f MB, ratio %.2f)" % (R["file_size"]/1.E6, R["data_size"]/1.E6, R["compression_ratio"])]
+    if "write_MBps" in R:
+        lines.append("Writing %.1f MB/s (uncompressed)" % R["write_MBps"])
+    if "dataset" in R:
+        lines.append("Reading %s [chunks=%s, compression=%s]: %.1f random frames/s, %.1f MB/s sequential" % (R["dataset"], str(R["chunks"]), str(R["compression"]), R["random_frames_per_second"], R["sequential_read_MBps"]))
+    return lines